@@ -0,0 +1,177 @@
+"""
+Image analysis: a configurable set of features computed in a single pass over the decoded image.
+
+The image is walked in strips (see stats.regions) and every feature updates its accumulator
+from the same pixels, so the image is decoded once whatever the number of features:
+* mean: average color (always computed)
+* histogram: per-channel 256-bin histogram of the 8-bit values
+* median: per-channel median color, read from the histogram
+* brightness: relative luminance of the average color (Rec. 601), 0-1
+* palette: dominant colors, k-means on a strided subsample of the pixels
+"""
+import time
+from typing import NamedTuple
+
+import numpy
+from PIL import Image as PImage
+
+from app import get_logger, stats
+
+log = get_logger(__name__)
+
+
+MEAN = "mean"
+HISTOGRAM = "histogram"
+MEDIAN = "median"
+BRIGHTNESS = "brightness"
+PALETTE = "palette"
+FEATURES = (MEAN, HISTOGRAM, MEDIAN, BRIGHTNESS, PALETTE)
+
+LUMA = numpy.array([0.299, 0.587, 0.114])
+KMEANS_ITERATIONS = 10
+
+
+class AnalysisError(Exception):
+    pass
+
+
+class Result(NamedTuple):
+    """Result of an image computation, features and timings only if more than the mean was computed."""
+    rgb: str
+    format: str
+    width: int
+    height: int
+    features: dict = None
+    timings: dict = None  # milliseconds per feature (and decoding)
+
+
+def parse_features(value: str) -> tuple:
+    """Features from a comma separated list, the mean is always included."""
+    features = [name.strip().lower() for name in (value or "").split(",") if name.strip()]
+    unknown = set(features) - set(FEATURES)
+    if unknown:
+        raise AnalysisError(f"Unknown features: {', '.join(sorted(unknown))}")
+    return tuple(name for name in FEATURES if name == MEAN or name in features)
+
+
+def to_8bit(pixels: numpy.ndarray, maximum: int) -> numpy.ndarray:
+    if maximum == 255:
+        return pixels.astype(numpy.uint8, copy=False)
+    return (pixels >> 8).astype(numpy.uint8)
+
+
+class Histogram:
+    """Per-channel counts of the 8-bit values."""
+
+    def __init__(self) -> None:
+        self.counts = numpy.zeros((3, 256), dtype=numpy.int64)
+
+    def update(self, pixels: numpy.ndarray) -> None:
+        for channel in range(3):
+            self.counts[channel] += numpy.bincount(pixels[:, :, channel].ravel(), minlength=256)
+
+    def median(self) -> numpy.ndarray:
+        cumulative = self.counts.cumsum(axis=1)
+        middle = (cumulative[:, -1] + 1) // 2
+        return numpy.array([numpy.searchsorted(cumulative[c], middle[c]) for c in range(3)])
+
+
+class Sample:
+    """Every `step`-th pixel of the image, the stride continues across the strips."""
+
+    def __init__(self, pixel_count: int, size: int) -> None:
+        self.step = max(1, pixel_count // max(1, size))
+        self.offset = 0
+        self.parts = []
+
+    def update(self, pixels: numpy.ndarray) -> None:
+        flat = pixels.reshape(-1, 3)
+        self.parts.append(flat[self.offset::self.step].astype(numpy.float32))
+        self.offset = (self.offset - len(flat)) % self.step
+
+    def pixels(self) -> numpy.ndarray:
+        return numpy.concatenate(self.parts) if self.parts else numpy.zeros((0, 3), numpy.float32)
+
+
+def kmeans(pixels: numpy.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> tuple:
+    """Return (centers, counts) of k-means clusters of the pixels, k-means++ initialization."""
+    rng = numpy.random.default_rng(seed)
+    k = min(k, len(pixels))
+    centers = pixels[[rng.integers(len(pixels))]]
+    while len(centers) < k:
+        distances = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        total = distances.sum()
+        if not total:
+            break  # fewer distinct colors than k
+        centers = numpy.vstack([centers, pixels[rng.choice(len(pixels), p=distances / total)]])
+
+    for _ in range(iterations):
+        labels = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        updated = numpy.array([
+            pixels[labels == i].mean(axis=0) if numpy.any(labels == i) else centers[i]
+            for i in range(len(centers))
+        ])
+        if numpy.allclose(updated, centers):
+            break
+        centers = updated
+    labels = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+    return centers, numpy.bincount(labels, minlength=len(centers))
+
+
+def palette(pixels: numpy.ndarray, size: int) -> list:
+    """Dominant colors, the most frequent first: [{'rgb': hex, 'share': fraction of the pixels}]."""
+    if not len(pixels):
+        return []
+    centers, counts = kmeans(pixels, size)
+    order = numpy.argsort(-counts, kind="stable")
+    return [
+        {"rgb": color, "share": round(float(counts[i]) / len(pixels), 4)}
+        for i, color in zip(order, stats.to_hex(centers[order]))
+    ]
+
+
+def analyze(image: PImage.Image, open_image, features: tuple, palette_size: int = 5,
+            palette_sample: int = 4096, strip_bytes: int = 16 * 1024 * 1024) -> tuple:
+    """
+    Return (features, timings) of the image, features maps the name to the value
+    and timings the name (and 'decode') to the milliseconds spent on it.
+    `open_image` has to return a new, not yet loaded, instance of the same image (see stats.regions).
+    """
+    timings = {name: 0.0 for name in ("decode",) + tuple(features)}
+    sums = stats.ChannelSums()
+    histogram = Histogram() if HISTOGRAM in features or MEDIAN in features else None
+    histogram_timing = HISTOGRAM if HISTOGRAM in features else MEDIAN
+    sample = Sample(image.width * image.height, palette_sample) if PALETTE in features else None
+
+    def timed(name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[name] += time.perf_counter() - started
+        return result
+
+    started = time.perf_counter()
+    for region in stats.regions(image, open_image, strip_bytes):
+        pixels, maximum = stats.to_rgb_array(region)
+        timings["decode"] += time.perf_counter() - started
+
+        timed(MEAN, sums.update, pixels, maximum)
+        if histogram is not None or sample is not None:
+            pixels = to_8bit(pixels, maximum)
+        if histogram is not None:
+            timed(histogram_timing, histogram.update, pixels)
+        if sample is not None:
+            timed(PALETTE, sample.update, pixels)
+        started = time.perf_counter()
+
+    mean = timed(MEAN, sums.mean)
+    values = {MEAN: stats.to_hex(mean[None, :])[0]}
+    if HISTOGRAM in features:
+        values[HISTOGRAM] = histogram.counts.tolist()
+    if MEDIAN in features:
+        values[MEDIAN] = timed(MEDIAN, lambda: stats.to_hex(histogram.median()[None, :])[0])
+    if BRIGHTNESS in features:
+        values[BRIGHTNESS] = timed(BRIGHTNESS, lambda: round(float(mean @ LUMA) / 255, 4))
+    if PALETTE in features:
+        values[PALETTE] = timed(PALETTE, palette, sample.pixels(), palette_size)
+
+    return values, {name: round(seconds * 1000, 3) for name, seconds in timings.items()}
@@ -0,0 +1,118 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from app import get_logger
+from app.analysis import Result
+
+log = get_logger(__name__)
+
+
+ENTRY_OVERHEAD = 200  # approximate memory of a cache entry besides its strings
+
+
+class ResultCache:
+    """
+    Computation results keyed by the sha256 of the image content (the same hash the blob store
+    uses, so a blob reference needs no hashing at all).
+
+    Results are kept in an in-memory LRU limited to `max_bytes`, optionally backed by an SQLite
+    file which survives restarts. Hits and misses are counted. Timings are not cached.
+    """
+
+    def __init__(self, max_bytes: int, path: str = None) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, rgb TEXT, format TEXT, width INTEGER, height INTEGER, "
+                "features TEXT)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(results)")}
+            for column, column_type in (("width", "INTEGER"), ("height", "INTEGER"),
+                                        ("features", "TEXT")):
+                if column not in columns:
+                    # files written by older versions
+                    self._db.execute(f"ALTER TABLE results ADD COLUMN {column} {column_type}")
+            self._db.commit()
+
+    @staticmethod
+    def key(image_data=None, sha256: str = None, variant: str = "") -> str:
+        """Cache key of the image content, `variant` tells apart results computed differently."""
+        if sha256 is None:
+            sha256 = hashlib.sha256(image_data).hexdigest()
+        return f"{sha256}:{variant}"
+
+    @staticmethod
+    def _entry_size(key: str, value: Result) -> int:
+        return ENTRY_OVERHEAD + len(key) + sum(len(str(item)) for item in value)
+
+    def _remember(self, key: str, value: Result) -> None:
+        if key in self._entries:
+            self.size -= self._entry_size(key, self._entries.pop(key))
+        self._entries[key] = value
+        self.size += self._entry_size(key, value)
+        while self.size > self.max_bytes and self._entries:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.size -= self._entry_size(evicted_key, evicted)
+
+    def get(self, key: str):
+        """Return the cached Result or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT rgb, format, width, height, features FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value = Result(*row[:4], features=json.loads(row[4]) if row[4] else None)
+                    self._remember(key, value)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key: str, value: Result) -> None:
+        value = Result(*value)._replace(timings=None)
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                features = json.dumps(value.features) if value.features else None
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, rgb, format, width, height, features) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, *value[:4], features)
+                )
+                self._db.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "size": self.size,
+        }
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
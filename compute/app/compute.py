@@ -1,11 +1,19 @@
+import collections
 import json
 import os
+import time
+from concurrent.futures import Future
 from contextlib import contextmanager
 
 import pika
 
-from app import get_logger
+from app import analysis, envelope, get_logger, pool, stats
+from app.analysis import AnalysisError, Result
+from app.blobstore import Blob, BlobStore
+from app.cache import ResultCache
+from app.envelope import EnvelopeError
 from app.image import Image
+from app.pool import ComputePool, average_blob, average_bytes
 
 
 log = get_logger(__name__)
@@ -26,8 +34,56 @@ class Compute:
         self.broker_port = os.environ.get("BROKER_PORT") or 5672
         self.input_exchange = os.environ.get("INPUT_EXCHANGE")
         self.input_routing_key = os.environ.get("INPUT_ROUTING_KEY") or "compute"
+        self.work_queue = os.environ.get("WORK_QUEUE")  # shared by all instances if set
+        self.prefetch_count = int(os.environ.get("PREFETCH_COUNT") or 1)
+        self.workers = int(os.environ.get("COMPUTE_WORKERS") or 0)
+        self.pool_kind = (os.environ.get("COMPUTE_POOL") or pool.THREAD).lower()
+        self.average_mode = (os.environ.get("AVERAGE_MODE") or "exact").lower()
+        self.average_options = {
+            "fast": self.average_mode == "fast",
+            "max_scale": int(os.environ.get("FAST_MAX_SCALE") or 8),
+            "min_size": int(os.environ.get("FAST_MIN_SIZE") or 64),
+            "tolerance": float(os.environ.get("FAST_TOLERANCE") or 2),
+            "max_pixels": int(os.environ.get("MAX_IMAGE_PIXELS") or 100_000_000),
+            "memory_budget": int(os.environ.get("MEMORY_BUDGET_MB") or 512) * 2 ** 20,
+        }
+        try:
+            self.features = analysis.parse_features(os.environ.get("FEATURES"))
+        except AnalysisError as e:
+            raise ComputeError(e)
+        if self.features != (analysis.MEAN,):
+            self.average_options.update({
+                "features": self.features,
+                "palette_size": int(os.environ.get("PALETTE_SIZE") or 5),
+                "palette_sample": int(os.environ.get("PALETTE_SAMPLE") or 4096),
+            })
+        self.batch_size = int(os.environ.get("BATCH_SIZE") or 0)
+        self.batch_wait = int(os.environ.get("BATCH_WAIT_MS") or 20) / 1000
+        self.batch_thumbnail = int(os.environ.get("BATCH_THUMBNAIL_SIZE") or 64)
+        self.cache_memory = float(os.environ.get("CACHE_MEMORY_MB") or 16) * 2 ** 20
+        self.cache_file = os.environ.get("CACHE_FILE")
+        self.cache_stats_every = int(os.environ.get("CACHE_STATS_EVERY") or 100)
+        self.cache = None
+        if self.cache_memory > 0 or self.cache_file:
+            self.cache = ResultCache(max_bytes=self.cache_memory, path=self.cache_file)
         self.output_exchange = os.environ.get('OUTPUT_EXCHANGE')
         self.output_routing_key = os.environ.get('OUTPUT_ROUTING_KEY') or "computed"
+        self.blob_store = BlobStore.from_env()
+        self.message_format = (os.environ.get("MESSAGE_FORMAT") or envelope.JSON).lower()
+        self.result_output = (os.environ.get("RESULT_OUTPUT") or "auto").lower()
+
+        if self.message_format not in envelope.FORMATS:
+            raise ComputeError(f"Unknown message format: {self.message_format}")
+        if self.pool_kind not in (pool.THREAD, pool.PROCESS):
+            raise ComputeError(f"Unknown compute pool: {self.pool_kind}")
+        if self.average_mode not in ("exact", "fast"):
+            raise ComputeError(f"Unknown average mode: {self.average_mode}")
+        if self.result_output not in ("auto", "result", "echo"):
+            raise ComputeError(f"Unknown result output: {self.result_output}")
+        if self.batch_size > 1 and self.workers:
+            raise ComputeError("BATCH_SIZE and COMPUTE_WORKERS can't be used together.")
+        if self.batch_size > 1 and self.features != (analysis.MEAN,):
+            raise ComputeError("The batch mode computes only the mean, FEATURES can't be used with it.")
 
     @contextmanager
     def connection(self) -> pika.BlockingConnection:
@@ -47,41 +103,346 @@ class Compute:
 
     @staticmethod
     def _validate(body):
-        required_fields = ("id", "image")
         try:
             body = json.loads(body)
         except Exception as e:
             raise ComputeError(e)
 
-        for field in required_fields:
-            if not body.get(field):
-                raise ComputeError(f"'{field}' field missing in message body: {body}")
+        if not body.get("id"):
+            raise ComputeError(f"'id' field missing in message body: {body}")
+        if not body.get("image") and not body.get("blob"):
+            raise ComputeError(f"Neither 'image' nor 'blob' field in message body: {body}")
         return body
 
-    def compute_callback(self, channel, method, properties, body):
-        """Compute the average color and forward to the 'computed' exchange."""
-        body = self._validate(body)
-        image_uuid = body['id']
+    def _read_message(self, body, properties) -> tuple:
+        """Return (message fields, image bytes or None if it is in the blob store)."""
+        if envelope.is_envelope(properties):
+            try:
+                message, payload = envelope.decode(body, properties)
+            except EnvelopeError as e:
+                raise ComputeError(e)
+            if not payload and not message.get("blob"):
+                raise ComputeError(f"Neither image data nor 'blob' header in message: {message}")
+            return message, payload or None
 
-        # get a new logger for each 'compute task'
-        logger = get_logger(image_uuid)
-        image = Image.from_b64(body['image'])
+        message = self._validate(body)
+        image_b64 = message.pop("image", None)
+        return message, Image.from_b64(image_b64).image_data if image_b64 else None
+
+    def _blob(self, message: dict):
+        """Return the blob reference of a message (claim-check) or None if the image is inline."""
+        if not message.get('blob'):
+            return None
+        if self.blob_store is None:
+            raise ComputeError("Received a blob reference, but BLOB_STORE_DIR is not configured.")
+        return Blob.from_dict(message['blob'])
+
+    def _cache_key(self, message: dict, image_bytes) -> str:
+        """Results differ between the average modes, they are cached separately."""
+        options = self.average_options
+        if self.batch_size > 1:
+            variant = f"batch-{self.batch_thumbnail}"
+        elif options["fast"]:
+            variant = "fast-{max_scale}-{min_size}-{tolerance}".format(**options)
+        else:
+            variant = "exact"
+        if "features" in options:
+            variant += "+" + "+".join(options["features"][1:])
+            if analysis.PALETTE in options["features"]:
+                variant += "-{palette_size}-{palette_sample}".format(**options)
+        if message.get('blob'):
+            return ResultCache.key(sha256=message['blob']['sha256'], variant=variant)
+        return ResultCache.key(image_bytes, variant=variant)
+
+    def _cached(self, key: str):
+        """Return the cached Result or None, log the cache statistics now and then."""
+        result = self.cache.get(key)
+        stats = self.cache.stats()
+        if (stats["hits"] + stats["misses"]) % self.cache_stats_every == 0:
+            log.info(f"Result cache: {stats}")
+        return result
+
+    def _output_image(self, message: dict, image_bytes) -> tuple:
+        """
+        Return (blob reference, image bytes) passed on with the result. A blob stays in the
+        blob store and only its reference is passed on. An inline image is echoed back only
+        in the 'echo' mode, or in the 'auto' mode when there is no blob store to put it in.
+        """
+        if message.get('blob'):
+            return message['blob'], None
+        if self.result_output == "echo" or (self.result_output == "auto" and self.blob_store is None):
+            return None, image_bytes
+        if self.blob_store is not None:
+            return self.blob_store.put(image_bytes).to_dict(), None
+        return None, None
+
+    def _encode_output(self, message: dict, image_bytes) -> tuple:
+        """Return (body, properties) of the result message in the configured format."""
+        if self.message_format == envelope.BINARY:
+            # AMQP headers have no floats, the features and their timings travel as JSON
+            message = {
+                name: json.dumps(value) if name in ('features', 'feature_ms') and value is not None else value
+                for name, value in message.items()
+            }
+            return envelope.encode(image_bytes, **message)
 
-        logger.info(f"Processing image {len(image.image_data) / 1000} kB")
-        computed_average_color = image.get_average_rgb()
+        output = {name: value for name, value in message.items() if value is not None}
+        if image_bytes is not None:
+            output['image'] = Image(image_bytes).to_b64_string()
+        return json.dumps(output).encode(), None
+
+    def _reply(self, channel, fields: dict, properties) -> None:
+        """Answer a request with a reply queue (e.g. RabbitMQ's direct reply-to), the fields only."""
+        body, reply_properties = self._encode_output(fields, None)
+        reply_properties = reply_properties or pika.BasicProperties()
+        reply_properties.correlation_id = properties.correlation_id or fields['id']
+        channel.basic_publish(
+            exchange="", routing_key=properties.reply_to, body=body, properties=reply_properties
+        )
+        get_logger(fields['id']).debug(f"Reply sent, queue={properties.reply_to}")
+
+    def _publish_result(self, channel, message: dict, image_bytes, result: Result, started: float,
+                        properties=None) -> None:
+        """Publish the result to the output exchange (and reply to the request if it asks for it)."""
+        computed_average_color = result.rgb
+        image_uuid = message['id']
+        logger = get_logger(image_uuid)
         logger.info(f"Image processed, result:  {computed_average_color}")
 
+        blob, output_image = self._output_image(message, image_bytes)
+        fields = {
+            'id': image_uuid,
+            'rgb': computed_average_color,
+            'format': result.format,
+            'width': result.width,
+            'height': result.height,
+            'size': message['blob'].get('size') if message.get('blob') else len(image_bytes),
+            'compute_ms': round((time.perf_counter() - started) * 1000),  # AMQP headers have no floats
+            'features': result.features,
+            'feature_ms': result.timings,
+            'blob': blob,
+        }
+        output_body, output_properties = self._encode_output(fields, output_image)
+        if output_properties is None:
+            # sorters partitioned by color hash the 'rgb' header, binary results carry it already
+            output_properties = pika.BasicProperties(headers={'rgb': computed_average_color})
         routing_key = ".".join([image_uuid, self.output_routing_key])
         channel.basic_publish(
             exchange=self.output_exchange,
             routing_key=routing_key,
-            body=json.dumps({
-                'id': image_uuid,
-                'image': image.to_b64_string(),
-                'rgb': computed_average_color
-            }).encode()
+            body=output_body,
+            properties=output_properties,
         )
         logger.debug(f"Message sent, exchange={self.output_exchange}, key={routing_key}")
+        if getattr(properties, "reply_to", None):
+            self._reply(channel, fields, properties)
+
+    def _compute(self, message: dict, image_bytes) -> tuple:
+        """Return the Result of a single image."""
+        blob = self._blob(message)
+        logger = get_logger(message['id'])
+        if blob is not None:
+            logger.info(f"Processing image {blob.size / 1000} kB (blob {blob.key})")
+            return average_blob(self.blob_store.root, blob, **self.average_options)
+        logger.info(f"Processing image {len(image_bytes) / 1000} kB")
+        return average_bytes(image_bytes, **self.average_options)
+
+    def compute_callback(self, channel, method, properties, body):
+        """Compute the average color and forward to the 'computed' exchange."""
+        started = time.perf_counter()
+        message, image_bytes = self._read_message(body, properties)
+
+        # get a new logger for each 'compute task'
+        logger = get_logger(message['id'])
+        cache_key = self._cache_key(message, image_bytes) if self.cache else None
+        result = self._cached(cache_key) if cache_key else None
+        if result is not None:
+            logger.info("Result found in the cache")
+        else:
+            result = self._compute(message, image_bytes)
+            if cache_key:
+                self.cache.put(cache_key, result)
+        self._publish_result(channel, message, image_bytes, result, started, properties)
+
+    def _thumbnail(self, message: dict, image_bytes) -> tuple:
+        """Return (thumbnail array or None if the image has to be averaged on its own, Image)."""
+        options = {
+            "max_pixels": self.average_options["max_pixels"],
+            "memory_budget": self.average_options["memory_budget"],
+        }
+        blob = self._blob(message)
+        if blob is None:
+            image = Image(image_bytes)
+            return image.get_thumbnail(self.batch_thumbnail, **options), image
+        with self.blob_store.open(blob) as data:
+            image = Image(data)
+            return image.get_thumbnail(self.batch_thumbnail, **options), image
+
+    def compute_batch(self, channel, deliveries: list) -> None:
+        """
+        Compute the average colors of a batch of (method, properties, body) deliveries
+        in one vectorized pass over their thumbnails, publish the results and acknowledge
+        the messages, the whole batch at once if none of them failed.
+        """
+        started = time.perf_counter()
+        items = {}  # delivery index: (message, image bytes, result)
+        pending = []  # (delivery index, Image, cache key) of the thumbnails
+        thumbnails = []
+        for index, (method, properties, body) in enumerate(deliveries):
+            try:
+                message, image_bytes = self._read_message(body, properties)
+                cache_key = self._cache_key(message, image_bytes) if self.cache else None
+                result = self._cached(cache_key) if cache_key else None
+                if result is not None:
+                    get_logger(message['id']).info("Result found in the cache")
+                else:
+                    thumbnail, image = self._thumbnail(message, image_bytes)
+                    if thumbnail is None:
+                        result = self._compute(message, image_bytes)
+                        if cache_key:
+                            self.cache.put(cache_key, result)
+                    else:
+                        thumbnails.append(thumbnail)
+                        pending.append((index, image, cache_key))
+                items[index] = (message, image_bytes, result)
+            except Exception as e:
+                log.error("Message handling failed.", exc_info=e)
+
+        if thumbnails:
+            colors = stats.to_hex(stats.batch_average(thumbnails))
+            for (index, image, cache_key), color in zip(pending, colors):
+                message, image_bytes, _ = items[index]
+                result = Result(color, image.format, *image.size)
+                items[index] = (message, image_bytes, result)
+                if cache_key:
+                    self.cache.put(cache_key, result)
+
+        for index in sorted(items):
+            message, image_bytes, result = items[index]
+            try:
+                properties = deliveries[index][1]
+                self._publish_result(channel, message, image_bytes, result, started, properties)
+            except Exception as e:
+                log.error("Message handling failed.", exc_info=e)
+                del items[index]
+
+        # acknowledge only once the results are published, a crash means a redelivery
+        if len(items) == len(deliveries):
+            channel.basic_ack(delivery_tag=deliveries[-1][0].delivery_tag, multiple=True)
+        else:
+            for index, (method, _, _) in enumerate(deliveries):
+                if index in items:
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+                else:
+                    channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        log.debug(
+            f"Batch of {len(deliveries)} messages processed in "
+            f"{(time.perf_counter() - started) * 1000:.1f} ms, {len(thumbnails)} thumbnails averaged"
+        )
+
+    def _consume_in_batches(self, connection, channel):
+        """
+        Return a message callback which collects up to BATCH_SIZE messages (or what arrives
+        within BATCH_WAIT_MS of the first one) and processes them together (compute_batch).
+        """
+        batch = []
+        timer = None
+
+        def flush():
+            nonlocal timer
+            if timer is not None:
+                connection.remove_timeout(timer)
+                timer = None
+            deliveries = batch[:]
+            batch.clear()
+            if deliveries:
+                self.compute_batch(channel, deliveries)
+
+        def on_timeout():
+            nonlocal timer
+            timer = None
+            flush()
+
+        def callback(ch, method, properties, body):
+            nonlocal timer
+            batch.append((method, properties, body))
+            if len(batch) >= self.batch_size:
+                flush()
+            elif timer is None:
+                timer = connection.call_later(self.batch_wait, on_timeout)
+
+        return callback
+
+    def _consume_with_pool(self, connection, channel):
+        """
+        Return a message callback which hands the computation over to a worker pool,
+        the results are published (and messages acknowledged) on the connection thread
+        in the order in which the messages arrived.
+        """
+        pool = ComputePool(
+            self.workers, kind=self.pool_kind, blob_store=self.blob_store, options=self.average_options
+        )
+        # (delivery tag, message, image bytes, future, cache key, start, properties)
+        in_flight = collections.deque()
+
+        def drain():
+            while in_flight and in_flight[0][3].done():
+                delivery_tag, message, image_bytes, future, cache_key, started, properties = (
+                    in_flight.popleft()
+                )
+                try:
+                    result = future.result()
+                    if cache_key:
+                        self.cache.put(cache_key, result)
+                    self._publish_result(channel, message, image_bytes, result, started, properties)
+                except Exception as e:
+                    log.error("Message handling failed.", exc_info=e)
+                    channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+                    continue
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+        def callback(ch, method, properties, body):
+            started = time.perf_counter()
+            cache_key = None
+            try:
+                message, image_bytes = self._read_message(body, properties)
+                cached = None
+                if self.cache:
+                    cache_key = self._cache_key(message, image_bytes)
+                    cached = self._cached(cache_key)
+                if cached is None:
+                    future = pool.submit(image_bytes=image_bytes, blob=self._blob(message))
+                    get_logger(message['id']).info("Processing image (queued to the pool)")
+                else:
+                    # still goes through the queue, so that the results stay in order
+                    future, cache_key = Future(), None
+                    future.set_result(cached)
+                    get_logger(message['id']).info("Result found in the cache")
+            except Exception as e:
+                log.error("Message handling failed.", exc_info=e)
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
+            in_flight.append(
+                (method.delivery_tag, message, image_bytes, future, cache_key, started, properties)
+            )
+            # the channel may only be used from the connection thread
+            future.add_done_callback(lambda _: connection.add_callback_threadsafe(drain))
+
+        return callback, pool
+
+    def _consume_one_by_one(self):
+        """Return a message callback computing each image on the connection thread."""
+        def callback(ch, method, properties, body):
+            try:
+                self.compute_callback(ch, method, properties, body)
+            except Exception as e:
+                # log the exception, drop the message (it would fail again) and carry on
+                log.error("Message handling failed.", exc_info=e)
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
+            # acknowledge only once the result is published, a crash means a redelivery
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+        return callback
 
     def start_listening(self):
         with self.connection() as conn:
@@ -89,7 +450,11 @@ class Compute:
 
             # 1) setup
             channel.exchange_declare(exchange=self.input_exchange, exchange_type='direct')
-            result = channel.queue_declare(queue="", exclusive=True)
+            if self.work_queue:
+                # competing consumers: every instance takes its share of one durable queue
+                result = channel.queue_declare(queue=self.work_queue, durable=True)
+            else:
+                result = channel.queue_declare(queue="", exclusive=True)
             self.queue_name = result.method.queue
             channel.queue_bind(
                 exchange=self.input_exchange,
@@ -97,24 +462,32 @@ class Compute:
                 routing_key=self.input_routing_key
             )
             channel.exchange_declare(exchange=self.output_exchange, exchange_type='topic')
+            # keep at least one message per worker (or a whole batch) in flight
+            prefetch_count = max(self.prefetch_count, self.workers, self.batch_size)
+            channel.basic_qos(prefetch_count=prefetch_count)
 
-            def callback(ch, method, properties, body):
-                try:
-                    return self.compute_callback(ch, method, properties, body)
-                except Exception as e:
-                    # log the exception and carry on
-                    log.error("Message handling failed.", exc_info=e)
+            compute_pool = None
+            if self.workers:
+                callback, compute_pool = self._consume_with_pool(conn, channel)
+            elif self.batch_size > 1:
+                callback = self._consume_in_batches(conn, channel)
+            else:
+                callback = self._consume_one_by_one()
 
             # 2) start listening
             log.info("Waiting for images to be processed... To exit press CTRL+C")
             log.debug(
                 f"Consuming: exchange={self.input_exchange}, "
                 f"key={self.input_routing_key}, "
-                f"queue={self.queue_name}."
+                f"queue={self.queue_name}, prefetch={prefetch_count}."
             )
             channel.basic_consume(
                 queue=self.queue_name,
                 on_message_callback=callback,
-                auto_ack=True
+                auto_ack=False
             )
-            channel.start_consuming()
+            try:
+                channel.start_consuming()
+            finally:
+                if compute_pool is not None:
+                    compute_pool.shutdown()
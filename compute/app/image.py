@@ -1,10 +1,10 @@
 import base64
 import io
+import mmap
 
 from PIL import Image as PImage, UnidentifiedImageError
-from numpy import asarray, mean
 
-from app import get_logger
+from app import analysis, get_logger, stats
 
 log = get_logger(__name__)
 
@@ -13,10 +13,51 @@ class ImageError(Exception):
     pass
 
 
+class BufferReader(io.RawIOBase):
+    """
+    A seekable file-like object reading a buffer (e.g. a memoryview of shared memory) in place,
+    io.BytesIO would copy it whole first. Only temporary views are taken, so the buffer can be
+    released as soon as the image is computed.
+    """
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        with self.buffer[self.position:self.position + len(target)] as chunk:
+            size = len(chunk)
+            target[:size] = chunk
+        self.position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+
 class Image:
 
     def __init__(self, image_data: bytes) -> None:
+        # bytes, a (read-only) mmap of a stored blob or a memoryview of shared memory
         self.image_data = image_data
+        self.format = None  # known once the image is loaded
+        self.size = None  # (width, height), known once the image is loaded
 
     @staticmethod
     def rgb_to_hex(rgb: list) -> str:
@@ -45,17 +86,165 @@ class Image:
     def to_b64_string(self) -> str:
         return base64.b64encode(self.image_data).decode()
 
-    def get_average_rgb(self):
-        stream = io.BytesIO(self.image_data)
+    def _stream(self):
+        if isinstance(self.image_data, mmap.mmap):
+            # mmap is file-like, PIL can read it directly without copying it to bytes first
+            self.image_data.seek(0)
+            return self.image_data
+        if isinstance(self.image_data, memoryview):
+            return BufferReader(self.image_data)
+        return io.BytesIO(self.image_data)
+
+    @staticmethod
+    def _reduction_error(size: tuple, scale: int) -> float:
+        """
+        The worst-case error (per channel, 0-255) of the average color at a reduced scale:
+        1 for the rounding, and the last row/column of blocks covers fewer pixels than the others
+        while it weighs as much.
+        """
+        if scale == 1:
+            return 0.0
+        error = 1.0
+        for side in size:
+            blocks, remainder = -(-side // scale), side % scale
+            if remainder:
+                error += 255 * abs(1 / blocks - remainder / side)
+        return error
+
+    @classmethod
+    def _reduction_factor(cls, image: PImage.Image, max_scale: int, min_size: int,
+                          tolerance: float = None) -> int:
+        """
+        The largest power of 2 (up to max_scale) keeping the shorter side at least min_size
+        and the error of the average within tolerance (see _reduction_error, None for any).
+        """
+        scale = 1
+        while scale * 2 <= max_scale and min(image.size) // (scale * 2) >= min_size:
+            if tolerance is not None and cls._reduction_error(image.size, scale * 2) > tolerance:
+                break
+            scale *= 2
+        return scale
+
+    def _reduce(self, image: PImage.Image, max_scale: int, min_size: int,
+                tolerance: float = None) -> PImage.Image:
+        """
+        Decode the image at a reduced resolution. JPEG images are decoded directly
+        at 1/2-1/8 scale (DCT scaling), other formats are box-filtered after decoding.
+        Both preserve the average color up to rounding.
+        """
+        scale = self._reduction_factor(image, max_scale, min_size, tolerance)
+        if scale == 1:
+            return image
+        width, height = image.size
+        if image.format == "JPEG":
+            image.draft(image.mode, (width // scale, height // scale))
+        elif image.mode in ("L", "LA", "RGB", "RGBA", "CMYK"):
+            image = image.reduce(scale)
+        log.debug(f"Image reduced {width}x{height} -> {image.width}x{image.height}")
+        return image
+
+    def _open(self) -> PImage.Image:
         try:
-            image = PImage.open(stream)
-        except UnidentifiedImageError as e:
+            return PImage.open(self._stream())
+        except (UnidentifiedImageError, PImage.DecompressionBombError) as e:
             raise ImageError("Invalid image data", e)
 
+    @staticmethod
+    def _fit_memory_budget(image: PImage.Image, memory_budget: int, reduce: bool = False) -> PImage.Image:
+        """
+        Make sure the decoded image fits in the memory budget. Streamed images always fit,
+        JPEG images are decoded at a reduced scale if that is allowed (the fast mode),
+        anything else is rejected - the exact mode never silently averages fewer pixels.
+        """
+        if not memory_budget or stats.streaming_mode(image):
+            return image
+        if stats.decoded_size(image) > memory_budget and image.format == "JPEG" and reduce:
+            scale = 2
+            while scale < 8 and stats.decoded_size(image) / scale ** 2 > memory_budget:
+                scale *= 2
+            log.warning(f"Image {image.width}x{image.height} over the memory budget, decoding at 1/{scale}")
+            image.draft(image.mode, (image.width // scale, image.height // scale))
+        if stats.decoded_size(image) > memory_budget:
+            raise ImageError(
+                f"Image {image.width}x{image.height} {image.mode} needs "
+                f"{stats.decoded_size(image) // 2 ** 20} MB, the memory budget is {memory_budget // 2 ** 20} MB"
+            )
+        return image
+
+    def _load(self, max_pixels: int = None) -> PImage.Image:
+        """Open the image (only the header is read) and check its size."""
+        image = self._open()
         log.debug(f"'{image.format}' image loaded: {image.height}x{image.width}")
+        self.format = image.format
+        self.size = image.size
+        if max_pixels and image.width * image.height > max_pixels:
+            raise ImageError(
+                f"Image {image.width}x{image.height} is over the limit of {max_pixels} pixels"
+            )
+        return image
+
+    def get_thumbnail(self, size: int = 64, max_pixels: int = None, memory_budget: int = None):
+        """
+        Return the image box-filtered to a size x size array (see stats.thumbnail), JPEG images
+        are decoded directly at a reduced scale. Returns None if the decoded image would not fit
+        in the memory budget, such images have to be averaged on their own (get_average_rgb).
+        """
+        image = self._load(max_pixels)
+        if image.format == "JPEG":
+            image.draft(image.mode, (size, size))
+        if memory_budget and stats.decoded_size(image) > memory_budget:
+            return None
+        try:
+            return stats.thumbnail(image, size)
+        except (OSError, ValueError) as e:
+            raise ImageError("Invalid image data", e)
 
-        result = mean(asarray(image), axis=(0, 1))
+    def _prepare(self, fast: bool, max_scale: int, min_size: int, tolerance: float, max_pixels: int,
+                 memory_budget: int) -> PImage.Image:
+        """Open the image and set up its decoding for the fast mode and the memory budget."""
+        image = self._load(max_pixels)
+        if fast and image.format == "JPEG":
+            # only changes the decoder config
+            image = self._reduce(image, max_scale, min_size, tolerance)
+        image = self._fit_memory_budget(image, memory_budget, reduce=fast)
+        if fast and image.format != "JPEG":
+            image = self._reduce(image, max_scale, min_size, tolerance)
+        return image
+
+    def get_average_rgb(self, fast: bool = False, max_scale: int = 8, min_size: int = 64,
+                        tolerance: float = None, max_pixels: int = None, memory_budget: int = None):
+        """
+        Return the average color as a hex string. In the fast mode the image is decoded
+        at a reduced resolution (see _reduce), as far as the color error stays within tolerance
+        (per channel, see _reduction_factor), the exact mode uses every pixel.
+        Images over max_pixels are rejected before decoding, the memory used for decoding
+        is kept under memory_budget (bytes, see _fit_memory_budget).
+        """
+        image = self._prepare(fast, max_scale, min_size, tolerance, max_pixels, memory_budget)
+        try:
+            result = stats.average(image, self._open)
+        except stats.StatsError as e:
+            raise ImageError(e)
         result_hex = self.rgb_to_hex(list(result))
         log.debug(f"Image processed, result mean: RGB{result}, HEX[{result_hex}]")
 
         return result_hex
+
+    def analyze(self, features: tuple, fast: bool = False, max_scale: int = 8, min_size: int = 64,
+                tolerance: float = None, max_pixels: int = None, memory_budget: int = None,
+                palette_size: int = 5, palette_sample: int = 4096) -> analysis.Result:
+        """
+        Decode the image once and compute the features (see analysis.FEATURES) in a single pass,
+        the options are the same as for get_average_rgb.
+        """
+        image = self._prepare(fast, max_scale, min_size, tolerance, max_pixels, memory_budget)
+        try:
+            values, timings = analysis.analyze(
+                image, self._open, features, palette_size=palette_size, palette_sample=palette_sample
+            )
+        except stats.StatsError as e:
+            raise ImageError(e)
+        log.debug(f"Image analyzed: {', '.join(values)} in {sum(timings.values()):.1f} ms")
+
+        rgb = values.pop(analysis.MEAN)
+        return analysis.Result(rgb, self.format, *self.size, features=values, timings=timings)
@@ -0,0 +1,97 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from app import analysis, get_logger
+from app.analysis import Result
+from app.blobstore import Blob, BlobStore
+from app.image import Image
+
+log = get_logger(__name__)
+
+
+THREAD = "thread"
+PROCESS = "process"
+
+
+class PoolError(Exception):
+    pass
+
+
+# Worker functions, module level so that they can be used by a process pool.
+# Each of them returns an analysis.Result, keyword arguments are passed on to
+# Image.get_average_rgb, or to Image.analyze if more features than the mean are requested.
+
+def average_bytes(image_data, features: tuple = None, **options) -> Result:
+    image = Image(image_data)
+    if features and tuple(features) != (analysis.MEAN,):
+        return image.analyze(features, **options)
+    return Result(image.get_average_rgb(**options), image.format, *image.size)
+
+
+def average_blob(blob_store_root: str, blob: Blob, **options) -> Result:
+    with BlobStore(blob_store_root).open(blob) as data:
+        return average_bytes(data, **options)
+
+
+def average_shared(name: str, size: int, **options) -> Result:
+    try:
+        shm = SharedMemory(name=name, track=False)  # python 3.13+
+    except TypeError:
+        # the workers share the resource tracker of the submitting process, which owns
+        # (and unlinks) the block, registering it again is a no-op
+        shm = SharedMemory(name=name)
+    data = shm.buf[:size]
+    try:
+        return average_bytes(data, **options)  # decoded in place, not copied out (see BufferReader)
+    finally:
+        data.release()  # the segment can't be closed while it is exported
+        shm.close()
+
+
+class ComputePool:
+    """
+    Runs the image computations in a pool of threads (decoding in PIL releases the GIL)
+    or processes. Images are handed over to worker processes in shared memory,
+    blob store images are opened by the workers themselves.
+    """
+
+    def __init__(self, workers: int, kind: str = THREAD, blob_store: BlobStore = None,
+                 options: dict = None) -> None:
+        if kind not in (THREAD, PROCESS):
+            raise PoolError(f"Unknown pool kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.blob_store = blob_store
+        self.options = options or {}
+        executor_class = ProcessPoolExecutor if kind == PROCESS else ThreadPoolExecutor
+        self.executor = executor_class(max_workers=workers)
+        log.info(f"Compute pool started, {workers} {kind} workers.")
+
+    def submit(self, image_bytes: bytes = None, blob: Blob = None) -> Future:
+        if blob is not None:
+            if self.blob_store is None:
+                raise PoolError("Received a blob reference, but BLOB_STORE_DIR is not configured.")
+            return self.executor.submit(average_blob, self.blob_store.root, blob, **self.options)
+        if self.kind == THREAD:
+            return self.executor.submit(average_bytes, image_bytes, **self.options)
+
+        shm = SharedMemory(create=True, size=len(image_bytes))
+        try:
+            shm.buf[:len(image_bytes)] = image_bytes
+            future = self.executor.submit(
+                average_shared, shm.name, len(image_bytes), **self.options
+            )
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+
+        def release(_):
+            shm.close()
+            shm.unlink()
+
+        future.add_done_callback(release)
+        return future
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,199 @@
+"""
+Bounded-memory image statistics.
+
+The image is walked in horizontal strips (or in its own tiles) and integer per-channel sums
+are accumulated, so apart from the decoded image the extra memory is a single strip.
+Uncompressed images whose data is laid out row by row (e.g. raw TIFF, PPM) and multi-tile
+images are decoded strip by strip / tile by tile, they are never held in memory as a whole.
+"""
+import math
+
+import numpy
+from PIL import Image as PImage
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+# bytes per row of the raw (uncompressed) data of the given width
+RAW_ROW_BYTES = {
+    "1": lambda width: math.ceil(width / 8),
+    "L": lambda width: width,
+    "P": lambda width: width,
+    "LA": lambda width: width * 2,
+    "I;16": lambda width: width * 2,
+    "I;16B": lambda width: width * 2,
+    "RGB": lambda width: width * 3,
+    "RGBA": lambda width: width * 4,
+    "CMYK": lambda width: width * 4,
+}
+SIXTEEN_BIT_MODES = ("I", "I;16", "I;16L", "I;16B", "I;16N")
+
+
+class StatsError(Exception):
+    pass
+
+
+def decoded_size(image: PImage.Image) -> int:
+    """Estimate of the memory PIL needs to hold the decoded image."""
+    if image.mode in ("1", "L", "P"):
+        pixel_size = 1
+    elif image.mode.startswith("I;16"):
+        pixel_size = 2
+    else:
+        pixel_size = 4  # multi-band images are stored 4 bytes per pixel, so are I and F
+    return image.width * image.height * pixel_size
+
+
+def to_rgb_array(region: PImage.Image) -> tuple:
+    """
+    Return (pixels, maximum) where pixels is a (height, width, 3) integer array of the region
+    and maximum is the value of the full intensity (255, or 65535 for 16-bit images).
+    The alpha channel is ignored, palette, grayscale and other color spaces are converted to RGB.
+    """
+    if region.mode in SIXTEEN_BIT_MODES:
+        pixels = numpy.asarray(region, dtype=numpy.uint32)
+        pixels = numpy.clip(pixels, 0, 65535)
+        return numpy.repeat(pixels[:, :, None], 3, axis=2), 65535
+    if region.mode == "F":
+        region = region.convert("L")
+    if region.mode != "RGB":
+        region = region.convert("RGB")
+    return numpy.asarray(region), 255
+
+
+class ChannelSums:
+    """Integer per-channel sums, no float up-casting of the whole image."""
+
+    def __init__(self) -> None:
+        self.sums = numpy.zeros(3, dtype=numpy.uint64)
+        self.count = 0
+        self.maximum = 255
+
+    def update(self, pixels: numpy.ndarray, maximum: int) -> None:
+        self.sums += pixels.sum(axis=(0, 1), dtype=numpy.uint64)
+        self.count += pixels.shape[0] * pixels.shape[1]
+        self.maximum = maximum
+
+    def mean(self) -> numpy.ndarray:
+        if not self.count:
+            raise StatsError("Empty image.")
+        return self.sums / self.count * (255 / self.maximum)
+
+
+def _raw_args(tile) -> tuple:
+    """(rawmode, stride, orientation) of a 'raw' tile."""
+    args = tile[3]
+    if isinstance(args, str):
+        return args, 0, 1
+    return (tuple(args) + (0, 1))[:3]
+
+
+def streaming_mode(image: PImage.Image):
+    """
+    'raw' if the image can be decoded strip by strip, 'tiles' if tile by tile,
+    None if it has to be decoded as a whole.
+    """
+    tiles = getattr(image, "tile", None) or []
+    if len(tiles) == 1 and tiles[0][0] == "raw" and tuple(tiles[0][1]) == (0, 0, *image.size):
+        rawmode, _, orientation = _raw_args(tiles[0])
+        if rawmode == image.mode and rawmode in RAW_ROW_BYTES and orientation in (1, -1):
+            return "raw"
+    if len(tiles) > 1 and all(tile[0] != "libtiff" for tile in tiles):
+        return "tiles"
+    return None
+
+
+def _raw_strips(image: PImage.Image, open_image, strip_rows: int):
+    """Yield strips of an uncompressed image, decoding only the rows of each strip."""
+    tile = image.tile[0]
+    rawmode, stride, orientation = _raw_args(tile)
+    width, height = image.size
+    row_bytes = stride or RAW_ROW_BYTES[rawmode](width)
+
+    for top in range(0, height, strip_rows):
+        rows = min(strip_rows, height - top)
+        # bottom-up images (orientation -1) store the last row first
+        first_row = top if orientation > 0 else height - top - rows
+        part = open_image()
+        part._size = (width, rows)
+        part.tile = [(tile[0], (0, 0, width, rows), tile[2] + first_row * row_bytes, tile[3])]
+        part.load()
+        yield part
+
+
+def _tiles(image: PImage.Image, open_image):
+    """Yield the tiles of a multi-tile image, decoded one by one."""
+    for tile in image.tile:
+        x0, y0, x1, y1 = tile[1]
+        part = open_image()
+        part._size = (x1 - x0, y1 - y0)
+        part.tile = [(tile[0], (0, 0, x1 - x0, y1 - y0), tile[2], tile[3])]
+        part.load()
+        yield part
+
+
+def _strips(image: PImage.Image, strip_rows: int):
+    image.load()
+    for top in range(0, image.height, strip_rows):
+        yield image.crop((0, top, image.width, min(image.height, top + strip_rows)))
+
+
+def regions(image: PImage.Image, open_image, strip_bytes: int):
+    """
+    Yield parts of the image, each of them at most ~strip_bytes when decoded (tiles excepted).
+    `open_image` has to return a new, not yet loaded, instance of the same image.
+    """
+    row_size = max(1, decoded_size(image) // max(1, image.height))
+    strip_rows = max(1, strip_bytes // row_size)
+    mode = streaming_mode(image)
+    if mode == "raw":
+        log.debug(f"Streaming raw image in strips of {strip_rows} rows")
+        return _raw_strips(image, open_image, strip_rows)
+    if mode == "tiles":
+        log.debug(f"Streaming image tile by tile ({len(image.tile)} tiles)")
+        return _tiles(image, open_image)
+    return _strips(image, strip_rows)
+
+
+def average(image: PImage.Image, open_image, strip_bytes: int = 16 * 1024 * 1024) -> numpy.ndarray:
+    """Average RGB of the image in the 0-255 range."""
+    sums = ChannelSums()
+    for region in regions(image, open_image, strip_bytes):
+        pixels, maximum = to_rgb_array(region)
+        sums.update(pixels, maximum)
+    return sums.mean()
+
+
+def thumbnail(image: PImage.Image, size: int) -> numpy.ndarray:
+    """
+    Return a (size, size, 3) float32 array of the image box-filtered down to size x size,
+    in the 0-255 range. The box filter keeps the average color up to rounding,
+    thumbnails of different images can be stacked and averaged together (see batch_average).
+    """
+    if image.mode in SIXTEEN_BIT_MODES:
+        image, maximum = image.convert("I").convert("F"), 65535
+    elif image.mode == "F":
+        image, maximum = image, 255
+    else:
+        image, maximum = image.convert("RGB"), 255
+    pixels = numpy.asarray(image.resize((size, size), PImage.BOX), dtype=numpy.float32)
+    if pixels.ndim == 2:
+        pixels = numpy.repeat(pixels[:, :, None], 3, axis=2)
+    if maximum != 255:
+        pixels *= 255 / maximum
+    return numpy.clip(pixels, 0, 255)
+
+
+def batch_average(thumbnails: list) -> numpy.ndarray:
+    """(N, 3) average colors of N thumbnails of the same size, computed in one pass."""
+    if not thumbnails:
+        raise StatsError("Empty batch.")
+    return numpy.stack(thumbnails).mean(axis=(1, 2), dtype=numpy.float64)
+
+
+def to_hex(colors: numpy.ndarray) -> list:
+    """Hex strings of (N, 3) colors in the 0-255 range, rounded the same way as Image.rgb_to_hex."""
+    values = numpy.clip(numpy.rint(colors), 0, 255).astype(numpy.uint8)
+    return ["#" + row.tobytes().hex() for row in values]
@@ -3,7 +3,8 @@
 Compute component of the sorting system
 * Waits for an image file to appear in the queue
 * Computes the average RGB
-* Sends back both the image and the RGB
+* Sends back the RGB (and the other configured features), the image dimensions
+  and the blob store reference of the image
 
 Modify behavior using these environment variables:
 * LOG_LEVEL
@@ -12,8 +13,42 @@ Modify behavior using these environment variables:
 * BROKER_PORT (defaults to 5672)
 * INPUT_EXCHANGE: where to listen for incoming compute tasks
 * INPUT_ROUTING_KEY (defaults to 'compute')
+* WORK_QUEUE: name of a durable queue shared by all compute instances (competing consumers),
+              by default each instance gets its own exclusive queue
+* PREFETCH_COUNT: number of unacknowledged messages per instance (defaults to 1)
+* COMPUTE_WORKERS: number of images processed in parallel by a worker pool,
+                   0 (default) processes them one by one on the connection thread
+* COMPUTE_POOL: 'thread' (default) or 'process' workers
+* AVERAGE_MODE: 'exact' (default, every pixel) or 'fast' (decoded at a reduced resolution)
+* FAST_MAX_SCALE: the largest reduction in the fast mode, 2, 4 or 8 (defaults to 8)
+* FAST_MIN_SIZE: the fast mode never reduces the shorter side below this (defaults to 64)
+* FAST_TOLERANCE: the largest error of the average color in the fast mode, per channel (0-255),
+                  images are reduced less if their reduction could exceed it (defaults to 2)
+* MAX_IMAGE_PIXELS: larger images are rejected before decoding (defaults to 100000000)
+* MEMORY_BUDGET_MB: max memory for a decoded image (defaults to 512), uncompressed/tiled images
+                    are streamed, larger JPEG images are decoded at a reduced scale in the fast mode,
+                    other images (any larger JPEG in the exact mode) are rejected
+* FEATURES: comma separated features computed in a single pass over the image besides the mean:
+            histogram, median, brightness, palette (dominant colors), by default only the mean
+            (binary results carry them, and their timings, as JSON headers)
+* PALETTE_SIZE: number of dominant colors (defaults to 5)
+* PALETTE_SAMPLE: number of pixels sampled for the dominant colors (defaults to 4096)
+* BATCH_SIZE: process up to N messages together (defaults to 0, disabled), the average colors
+              are computed in one pass over BATCH_THUMBNAIL_SIZE thumbnails of the images
+              (AVERAGE_MODE is ignored), can't be combined with COMPUTE_WORKERS or FEATURES
+* BATCH_WAIT_MS: a batch is processed at the latest this long after its first message (defaults to 20)
+* BATCH_THUMBNAIL_SIZE: side of the thumbnails in the batch mode (defaults to 64)
 * OUTPUT_EXCHANGE: where to send the computation results
 * OUTPUT_ROUTING_KEY: (defaults to 'computed')
+* MESSAGE_FORMAT: 'json' (base64 image) or 'binary' (raw image body, fields in headers),
+                  defaults to 'json', both formats are always accepted
+* RESULT_OUTPUT: 'auto' (default), 'result' or 'echo'. Inline images are put in the blob store
+                 and only the results are published, 'echo' sends the image back with the result
+                 (the legacy behavior), 'auto' does so only when BLOB_STORE_DIR is not configured
+* CACHE_MEMORY_MB: size of the in-memory result cache, keyed by image content (defaults to 16, 0 disables it)
+* CACHE_FILE: SQLite file backing the result cache, survives restarts (by default there is none)
+* CACHE_STATS_EVERY: log cache hits/misses every N lookups (defaults to 100)
+* BLOB_STORE_DIR: shared directory with images referenced by the messages (claim-check)
 
 """
 import time
@@ -1,5 +1,6 @@
 import os
 
+import pika
 import pytest
 
 
@@ -18,3 +19,13 @@ def image(request, test_data_dir):
     with open(os.path.join(test_data_dir, request.param), "rb") as img:
         image_bytes = img.read()
     return image_bytes, expected_avg
+
+
+@pytest.fixture
+def over_the_wire():
+    """Encode message properties as they are sent to the broker and decode them back."""
+    def send(properties):
+        received = pika.BasicProperties()
+        received.decode(b"".join(properties.encode()))
+        return received
+    return send
@@ -0,0 +1,130 @@
+import base64
+import io
+import json
+
+import mock
+import numpy
+import pytest
+from PIL import Image as PImage
+
+from app import analysis, envelope
+from app.analysis import AnalysisError, Result
+from app.compute import Compute, ComputeError
+from app.image import Image
+
+ALL_FEATURES = analysis.FEATURES
+
+
+def encode(pixels: numpy.ndarray, image_format: str = "PNG") -> bytes:
+    stream = io.BytesIO()
+    PImage.fromarray(pixels).save(stream, image_format)
+    return stream.getvalue()
+
+
+@pytest.fixture
+def two_colors():
+    """3/4 of the image red, 1/4 blue."""
+    pixels = numpy.zeros((80, 60, 3), dtype=numpy.uint8)
+    pixels[:60] = (255, 0, 0)
+    pixels[60:] = (0, 0, 255)
+    return pixels
+
+
+def test_parse_features():
+    assert analysis.parse_features(None) == ("mean",)
+    assert analysis.parse_features("palette, Histogram") == ("mean", "histogram", "palette")
+    with pytest.raises(AnalysisError):
+        analysis.parse_features("mean,mode")
+
+
+def test_analyze(two_colors):
+    result = Image(encode(two_colors)).analyze(ALL_FEATURES)
+    assert result.rgb == "#bf0040"
+    assert (result.format, result.width, result.height) == ("PNG", 60, 80)
+    assert result.features["median"] == "#ff0000"
+    assert result.features["brightness"] == pytest.approx((0.299 * 191.25 + 0.114 * 63.75) / 255, abs=1e-4)
+    histogram = numpy.array(result.features["histogram"])
+    assert histogram.shape == (3, 256)
+    assert histogram[0, 255] == 3600 and histogram[0, 0] == 1200
+    assert result.features["palette"] == [
+        {"rgb": "#ff0000", "share": 0.75}, {"rgb": "#0000ff", "share": 0.25}
+    ]
+    assert set(result.timings) == {"decode", *ALL_FEATURES}
+
+
+def test_single_pass_over_strips():
+    """Test that the features computed strip by strip match the whole image."""
+    pixels = numpy.random.default_rng(1).integers(0, 256, (300, 200, 3), dtype=numpy.uint8)
+    image_bytes = encode(pixels, "TIFF")
+    values, _ = analysis.analyze(
+        PImage.open(io.BytesIO(image_bytes)), lambda: PImage.open(io.BytesIO(image_bytes)),
+        ALL_FEATURES, palette_sample=1000, strip_bytes=10_000,
+    )
+    expected = [numpy.bincount(pixels[:, :, c].ravel(), minlength=256).tolist() for c in range(3)]
+    assert values["histogram"] == expected
+    median = numpy.median(pixels.reshape(-1, 3), axis=0)
+    assert numpy.allclose([int(values["median"][i:i + 2], 16) for i in (1, 3, 5)], median, atol=1)
+    assert sum(color["share"] for color in values["palette"]) == pytest.approx(1, abs=1e-3)
+
+
+def test_sample_stride_across_strips():
+    sample = analysis.Sample(pixel_count=100, size=10)
+    pixels = numpy.arange(300).reshape(100, 1, 3)
+    for top in range(0, 100, 7):
+        sample.update(pixels[top:top + 7])
+    assert sample.pixels()[:, 0].tolist() == list(range(0, 300, 30))
+
+
+def test_kmeans_fewer_colors_than_clusters():
+    pixels = numpy.array([[10, 20, 30]] * 50, dtype=numpy.float32)
+    assert analysis.palette(pixels, 5) == [{"rgb": "#0a141e", "share": 1.0}]
+
+
+def test_compute_publishes_features(monkeypatch, two_colors):
+    monkeypatch.setenv("FEATURES", "median,palette")
+    compute = Compute()
+    body = json.dumps({"id": "1234", "image": base64.b64encode(encode(two_colors)).decode()})
+    channel = mock.MagicMock()
+    compute.compute_callback(channel=channel, method=None, properties=None, body=body)
+
+    sent = json.loads(channel.basic_publish.call_args.kwargs["body"])
+    assert sent["rgb"] == "#bf0040"
+    assert sent["features"]["median"] == "#ff0000"
+    assert len(sent["features"]["palette"]) == 2
+    assert set(sent["feature_ms"]) == {"decode", "mean", "median", "palette"}
+
+    # the features are cached, but not the timings
+    compute.compute_callback(channel=channel, method=None, properties=None, body=body)
+    sent = json.loads(channel.basic_publish.call_args.kwargs["body"])
+    assert sent["features"]["median"] == "#ff0000" and "feature_ms" not in sent
+    assert compute.cache.hits == 1
+
+
+def test_compute_publishes_features_binary(monkeypatch, two_colors, over_the_wire):
+    monkeypatch.setenv("FEATURES", "histogram,median,brightness,palette")
+    monkeypatch.setenv("MESSAGE_FORMAT", "binary")
+    body, properties = envelope.encode(encode(two_colors), id="1234")
+    channel = mock.MagicMock()
+    Compute().compute_callback(channel=channel, method=None, properties=properties, body=body)
+
+    sent = channel.basic_publish.call_args.kwargs
+    headers, _ = envelope.decode(sent["body"], over_the_wire(sent["properties"]))
+    features = json.loads(headers["features"])
+    assert features["median"] == "#ff0000" and len(features["palette"]) == 2
+    assert features["brightness"] == pytest.approx((0.299 * 191.25 + 0.114 * 63.75) / 255, abs=1e-4)
+    assert set(json.loads(headers["feature_ms"])) == {"decode", "mean", "histogram", "median", "brightness",
+                                                      "palette"}
+
+
+def test_mean_only_by_default(image):
+    image_bytes, expected_hex = image
+    assert "features" not in Compute().average_options
+    assert Image(image_bytes).analyze(("mean",)) == Result(expected_hex, "JPEG", 219, 228, {}, mock.ANY)
+
+
+@pytest.mark.parametrize("variables", [{"FEATURES": "mode"}, {"FEATURES": "median", "BATCH_SIZE": "8"}])
+def test_invalid_configuration(monkeypatch, variables):
+    for name, value in variables.items():
+        monkeypatch.setenv(name, value)
+    with pytest.raises(ComputeError):
+        Compute()
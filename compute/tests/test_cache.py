@@ -0,0 +1,93 @@
+import base64
+import json
+import sqlite3
+
+import mock
+
+from app.analysis import Result
+from app.blobstore import BlobStore
+from app.cache import ResultCache
+from app.compute import Compute
+
+
+def test_lru_eviction():
+    entry_size = ResultCache._entry_size(ResultCache.key(b"0"), Result("#000000", "JPEG", 64, 48))
+    cache = ResultCache(max_bytes=entry_size * 2)
+    keys = [ResultCache.key(str(i).encode()) for i in range(3)]
+    cache.put(keys[0], Result("#000000", "JPEG", 64, 48))
+    cache.put(keys[1], Result("#111111", "JPEG", 64, 48))
+    assert cache.get(keys[0]) == Result("#000000", "JPEG", 64, 48)  # keys[1] is now the least recently used
+
+    cache.put(keys[2], Result("#222222", "JPEG", 64, 48))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) and cache.get(keys[2])
+    assert cache.stats()["entries"] == 2
+    assert cache.size <= cache.max_bytes
+
+
+def test_counters():
+    cache = ResultCache(max_bytes=2 ** 20)
+    key = ResultCache.key(b"image")
+    assert cache.get(key) is None
+    cache.put(key, Result("#ffffff", "PNG", 64, 48))
+    assert cache.get(key) == Result("#ffffff", "PNG", 64, 48)
+    assert cache.stats() == {
+        "hits": 1, "misses": 1, "hit_ratio": 0.5, "entries": 1, "size": cache.size
+    }
+
+
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "cache" / "results.sqlite")
+    key = ResultCache.key(b"image", variant="exact")
+    cache = ResultCache(max_bytes=2 ** 20, path=path)
+    cache.put(key, Result("#ffffff", "PNG", 64, 48))
+    cache.close()
+
+    restarted = ResultCache(max_bytes=2 ** 20, path=path)
+    assert restarted.get(key) == Result("#ffffff", "PNG", 64, 48)
+    assert restarted.get(ResultCache.key(b"image", variant="fast")) is None
+
+
+def test_disk_tier_migration(tmp_path):
+    """Cache files written before the dimensions were cached are still used."""
+    path = str(tmp_path / "results.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE results (key TEXT PRIMARY KEY, rgb TEXT, format TEXT)")
+    db.execute("INSERT INTO results VALUES ('old', '#ffffff', 'PNG')")
+    db.commit()
+    db.close()
+
+    cache = ResultCache(max_bytes=2 ** 20, path=path)
+    assert cache.get("old") == Result("#ffffff", "PNG", None, None)
+    cache.put("new", Result("#000000", "JPEG", 64, 48))
+    assert ResultCache(max_bytes=2 ** 20, path=path).get("new") == Result("#000000", "JPEG", 64, 48)
+
+
+def test_features_cached_without_timings(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    features = {"median": "#808080", "histogram": [[1, 2], [3, 4], [5, 6]]}
+    ResultCache(max_bytes=2 ** 20, path=path).put(
+        "key", Result("#7f7f7f", "PNG", 64, 48, features, timings={"median": 0.1})
+    )
+    assert ResultCache(max_bytes=2 ** 20, path=path).get("key") == Result("#7f7f7f", "PNG", 64, 48, features)
+
+
+def test_key_matches_blob_key(tmp_path):
+    blob = BlobStore(str(tmp_path)).put(b"image")
+    assert ResultCache.key(b"image") == ResultCache.key(sha256=blob.sha256)
+
+
+def test_repeated_image_is_not_decoded(image):
+    image_bytes, expected_hex = image
+    compute = Compute()
+    channel = mock.MagicMock()
+    body = json.dumps({"id": "1234", "image": base64.b64encode(image_bytes).decode()})
+
+    compute.compute_callback(channel=channel, method=None, properties=None, body=body)
+    with mock.patch("app.compute.average_bytes") as average:
+        compute.compute_callback(channel=channel, method=None, properties=None, body=body)
+    average.assert_not_called()
+
+    results = [json.loads(call.kwargs["body"])["rgb"] for call in channel.basic_publish.call_args_list]
+    assert results == [expected_hex, expected_hex]
+    assert compute.cache.hits == 1 and compute.cache.misses == 1
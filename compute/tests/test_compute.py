@@ -2,8 +2,11 @@ import base64
 import json
 
 import mock
+import pytest
 
-from app.compute import Compute
+from app import envelope
+from app.blobstore import Blob
+from app.compute import Compute, ComputeError
 
 
 def test_compute_callback(image):
@@ -15,7 +18,7 @@ def test_compute_callback(image):
         'image': base64.b64encode(image_bytes).decode()
     })
 
-    def assert_body(exchange=None, routing_key=None, body=None):
+    def assert_body(exchange=None, routing_key=None, body=None, properties=None):
         sent_body = json.loads(body)
         assert sent_body.get("id"), "image id missing"
         assert sent_body.get("image"), "image data missing"
@@ -30,3 +33,256 @@ def test_compute_callback(image):
         body=test_body
     )
     mocked_channel.basic_publish.assert_called_once()
+
+
+def test_compute_callback_blob(image, tmp_path, monkeypatch):
+    """Test that an image referenced in the blob store is read from there and not echoed back."""
+    image_bytes, expected_hex = image
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path))
+    compute = Compute()
+    blob = compute.blob_store.put(image_bytes)
+
+    mocked_channel = mock.MagicMock()
+    compute.compute_callback(
+        channel=mocked_channel,
+        method=None,
+        properties=None,
+        body=json.dumps({'id': '1234', 'blob': blob.to_dict()})
+    )
+    sent_body = json.loads(mocked_channel.basic_publish.call_args.kwargs["body"])
+    assert sent_body.pop('compute_ms') >= 0
+    assert sent_body == {
+        'id': '1234', 'rgb': expected_hex, 'format': 'JPEG', 'width': 219, 'height': 228,
+        'size': len(image_bytes), 'blob': blob.to_dict(),
+    }
+
+
+def test_compute_callback_binary(image, monkeypatch, over_the_wire):
+    """Test that a binary envelope is understood and answered in the binary format."""
+    image_bytes, expected_hex = image
+    monkeypatch.setenv("MESSAGE_FORMAT", "binary")
+    compute = Compute()
+    body, properties = envelope.encode(image_bytes, id="1234")
+
+    mocked_channel = mock.MagicMock()
+    compute.compute_callback(channel=mocked_channel, method=None, properties=properties, body=body)
+
+    sent = mocked_channel.basic_publish.call_args.kwargs
+    headers, payload = envelope.decode(sent["body"], over_the_wire(sent["properties"]))
+    assert isinstance(headers.pop("compute_ms"), int)
+    assert headers == {
+        "id": "1234", "rgb": expected_hex, "format": "JPEG", "width": 219, "height": 228,
+        "size": len(image_bytes),
+    }
+    assert payload == image_bytes  # no blob store, the image is echoed back for the sorter
+
+
+@pytest.mark.parametrize("message_format", ["json", "binary"])
+def test_compute_callback_reply_to(image, monkeypatch, message_format, over_the_wire):
+    """Test that a request with a reply queue is answered there too, without the image."""
+    image_bytes, expected_hex = image
+    monkeypatch.setenv("MESSAGE_FORMAT", message_format)
+    body, properties = envelope.encode(image_bytes, id="1234")
+    properties.reply_to, properties.correlation_id = "amq.rabbitmq.reply-to.abc", "1234"
+
+    mocked_channel = mock.MagicMock()
+    Compute().compute_callback(channel=mocked_channel, method=None, properties=properties, body=body)
+
+    published, reply = [call.kwargs for call in mocked_channel.basic_publish.call_args_list]
+    assert published["routing_key"] == "1234.computed"
+    assert (reply["exchange"], reply["routing_key"]) == ("", "amq.rabbitmq.reply-to.abc")
+    assert reply["properties"].correlation_id == "1234"
+    if message_format == "binary":
+        headers, payload = envelope.decode(reply["body"], over_the_wire(reply["properties"]))
+        assert headers["rgb"] == expected_hex and payload == b""
+    else:
+        sent = json.loads(reply["body"])
+        assert sent["rgb"] == expected_hex and "image" not in sent
+
+
+@pytest.mark.parametrize("result_output,echoed", [("auto", False), ("result", False), ("echo", True)])
+def test_result_output_with_blob_store(image, tmp_path, monkeypatch, result_output, echoed):
+    """Test that an inline image is put in the blob store instead of being echoed back."""
+    image_bytes, expected_hex = image
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path))
+    monkeypatch.setenv("RESULT_OUTPUT", result_output)
+    compute = Compute()
+    body = json.dumps({'id': '1234', 'image': base64.b64encode(image_bytes).decode()})
+
+    mocked_channel = mock.MagicMock()
+    compute.compute_callback(channel=mocked_channel, method=None, properties=None, body=body)
+
+    sent_body = json.loads(mocked_channel.basic_publish.call_args.kwargs["body"])
+    assert sent_body["rgb"] == expected_hex
+    assert ("image" in sent_body) is echoed
+    if not echoed:
+        with compute.blob_store.open(Blob.from_dict(sent_body["blob"])) as data:
+            assert data[:] == image_bytes
+
+
+def test_result_output_only(image, monkeypatch):
+    image_bytes, _ = image
+    monkeypatch.setenv("RESULT_OUTPUT", "result")
+    body = json.dumps({'id': '1234', 'image': base64.b64encode(image_bytes).decode()})
+
+    mocked_channel = mock.MagicMock()
+    Compute().compute_callback(channel=mocked_channel, method=None, properties=None, body=body)
+    sent_body = json.loads(mocked_channel.basic_publish.call_args.kwargs["body"])
+    assert "image" not in sent_body and "blob" not in sent_body
+
+
+def test_unknown_result_output(monkeypatch):
+    monkeypatch.setenv("RESULT_OUTPUT", "everything")
+    with pytest.raises(ComputeError):
+        Compute()
+
+
+def test_compute_callback_binary_to_json(image):
+    """Test that during the migration binary messages are accepted by a JSON speaking service."""
+    image_bytes, expected_hex = image
+    compute = Compute()
+    body, properties = envelope.encode(image_bytes, id="1234")
+
+    mocked_channel = mock.MagicMock()
+    compute.compute_callback(channel=mocked_channel, method=None, properties=properties, body=body)
+
+    sent = mocked_channel.basic_publish.call_args.kwargs
+    assert sent["properties"].content_type is None and sent["properties"].headers == {"rgb": expected_hex}
+    sent_body = json.loads(sent["body"])
+    assert sent_body["rgb"] == expected_hex
+    assert base64.b64decode(sent_body["image"]) == image_bytes
+
+
+@pytest.mark.parametrize("content_type", [
+    "application/x-image-envelope; version=2",
+    "application/x-image-envelope; version=x",
+])
+def test_compute_callback_unsupported_envelope(image, content_type):
+    image_bytes, _ = image
+    body, properties = envelope.encode(image_bytes, id="1234")
+    properties.content_type = content_type
+    with pytest.raises(ComputeError):
+        Compute().compute_callback(
+            channel=mock.MagicMock(), method=None, properties=properties, body=body
+        )
+
+
+@pytest.fixture
+def listening_channel():
+    """Run start_listening against a mocked connection and return the channel."""
+    with mock.patch.object(Compute, "connection") as mocked_connection:
+        with mocked_connection() as conn:
+            channel = conn.channel()
+        channel.queue_declare.return_value.method.queue = "amq.gen-queue"
+
+        def start(compute):
+            compute.start_listening()
+            return channel
+        yield start
+
+
+def test_start_listening_exclusive(listening_channel):
+    channel = listening_channel(Compute())
+    channel.queue_declare.assert_called_once_with(queue="", exclusive=True)
+    channel.basic_qos.assert_called_once_with(prefetch_count=1)
+    assert channel.basic_consume.call_args.kwargs["auto_ack"] is False
+
+
+def test_start_listening_work_queue(listening_channel, monkeypatch):
+    monkeypatch.setenv("WORK_QUEUE", "compute")
+    monkeypatch.setenv("PREFETCH_COUNT", "8")
+    channel = listening_channel(Compute())
+    channel.queue_declare.assert_called_once_with(queue="compute", durable=True)
+    channel.basic_qos.assert_called_once_with(prefetch_count=8)
+    assert channel.queue_bind.call_args.kwargs["queue"] == "amq.gen-queue"
+
+
+def test_ack_after_publish(listening_channel, image):
+    image_bytes, _ = image
+    channel = listening_channel(Compute())
+    callback = channel.basic_consume.call_args.kwargs["on_message_callback"]
+    body, properties = envelope.encode(image_bytes, id="1234")
+    method = mock.MagicMock(delivery_tag=42)
+
+    channel.basic_publish.side_effect = lambda **_: channel.basic_ack.assert_not_called()
+    callback(channel, method, properties, body)
+    channel.basic_publish.assert_called_once()
+    channel.basic_ack.assert_called_once_with(delivery_tag=42)
+
+
+def test_nack_on_failure(listening_channel):
+    channel = listening_channel(Compute())
+    callback = channel.basic_consume.call_args.kwargs["on_message_callback"]
+    callback(channel, mock.MagicMock(delivery_tag=42), None, b"not a valid message")
+    channel.basic_nack.assert_called_once_with(delivery_tag=42, requeue=False)
+    channel.basic_ack.assert_not_called()
+
+
+@pytest.fixture
+def batch_consumer(monkeypatch):
+    """Start listening in the batch mode and return (connection, channel, message callback)."""
+    monkeypatch.setenv("BATCH_SIZE", "3")
+    with mock.patch.object(Compute, "connection") as mocked_connection:
+        with mocked_connection() as conn:
+            channel = conn.channel()
+        Compute().start_listening()
+    callback = channel.basic_consume.call_args.kwargs["on_message_callback"]
+    return conn, channel, callback
+
+
+def test_batch_full(batch_consumer, test_data_dir):
+    conn, channel, callback = batch_consumer
+    channel.basic_qos.assert_called_once_with(prefetch_count=3)
+    colors = ["#000000", "#c0c0c0", "#000000"]
+    for tag, color in enumerate(colors, start=1):
+        with open(f"{test_data_dir}/{color}.jpg", "rb") as f:
+            body, properties = envelope.encode(f.read(), id=str(tag))
+        callback(channel, mock.MagicMock(delivery_tag=tag), properties, body)
+        if tag < len(colors):
+            channel.basic_publish.assert_not_called()
+
+    # the first message started the timer, the full batch cancelled it
+    conn.call_later.assert_called_once()
+    conn.remove_timeout.assert_called_once_with(conn.call_later.return_value)
+    sent = [json.loads(call.kwargs["body"]) for call in channel.basic_publish.call_args_list]
+    assert [(message["id"], message["rgb"]) for message in sent] == [
+        ("1", "#000000"), ("2", "#c0c0c0"), ("3", "#000000")
+    ]
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+def test_batch_timeout(batch_consumer, image):
+    image_bytes, expected_hex = image
+    conn, channel, callback = batch_consumer
+    body, properties = envelope.encode(image_bytes, id="1")
+    callback(channel, mock.MagicMock(delivery_tag=7), properties, body)
+    channel.basic_publish.assert_not_called()
+
+    delay, on_timeout = conn.call_later.call_args.args
+    assert delay == 0.02
+    on_timeout()
+    assert json.loads(channel.basic_publish.call_args.kwargs["body"])["rgb"] == expected_hex
+    channel.basic_ack.assert_called_once_with(delivery_tag=7, multiple=True)
+    conn.remove_timeout.assert_not_called()
+
+
+def test_batch_partial_failure(batch_consumer, image):
+    image_bytes, expected_hex = image
+    conn, channel, callback = batch_consumer
+    body, properties = envelope.encode(image_bytes, id="1")
+    callback(channel, mock.MagicMock(delivery_tag=1), properties, body)
+    callback(channel, mock.MagicMock(delivery_tag=2), None, b"not a valid message")
+    callback(channel, mock.MagicMock(delivery_tag=3), properties, body)
+
+    assert channel.basic_publish.call_count == 2
+    assert channel.basic_ack.call_args_list == [
+        mock.call(delivery_tag=1), mock.call(delivery_tag=3)
+    ]
+    channel.basic_nack.assert_called_once_with(delivery_tag=2, requeue=False)
+
+
+def test_batch_and_workers(monkeypatch):
+    monkeypatch.setenv("BATCH_SIZE", "8")
+    monkeypatch.setenv("COMPUTE_WORKERS", "2")
+    with pytest.raises(ComputeError):
+        Compute()
@@ -1,6 +1,9 @@
+import io
 import os
 
+import numpy
 import pytest
+from PIL import Image as PImage
 
 from app.image import Image, ImageError
 
@@ -43,3 +46,57 @@ def test_invalid_image(invalid_image):
     test_image = Image(invalid_image)
     with pytest.raises(ImageError):
         test_image.get_average_rgb()
+
+
+def photo(image_format: str, size=(1200, 800)) -> bytes:
+    """A synthetic 'photo': color gradients with noise."""
+    width, height = size
+    rng = numpy.random.default_rng(42)
+    y, x = numpy.mgrid[0:height, 0:width]
+    pixels = numpy.stack([x * 255 // width, y * 255 // height, (x + y) * 127 // (width + height)], -1)
+    pixels = numpy.clip(pixels + rng.integers(-40, 40, pixels.shape), 0, 255).astype(numpy.uint8)
+    stream = io.BytesIO()
+    PImage.fromarray(pixels).save(stream, image_format)
+    return stream.getvalue()
+
+
+def hex_to_rgb(hex_color: str) -> numpy.ndarray:
+    return numpy.array([int(hex_color[i:i + 2], 16) for i in (1, 3, 5)])
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+@pytest.mark.parametrize("size", [(1200, 800), (1201, 799), (333, 250)])
+@pytest.mark.parametrize("max_scale", [2, 4, 8])
+@pytest.mark.parametrize("tolerance", [1, 2])
+def test_fast_mode_error(image_format, size, max_scale, tolerance):
+    """Measure the color error of the fast (reduced resolution) mode against the exact mode."""
+    image_bytes = photo(image_format, size)
+    exact = Image(image_bytes).get_average_rgb()
+    fast = Image(image_bytes).get_average_rgb(fast=True, max_scale=max_scale, tolerance=tolerance)
+    error = numpy.abs(hex_to_rgb(fast) - hex_to_rgb(exact)).max()
+    assert error <= tolerance, f"exact={exact}, fast={fast}"
+
+
+@pytest.mark.parametrize("size,min_size,expected", [
+    ((1200, 800), 64, 8),
+    ((1200, 800), 200, 4),
+    ((1200, 800), 800, 1),
+    ((100, 100), 64, 1),
+])
+def test_reduction_factor(size, min_size, expected):
+    assert Image._reduction_factor(PImage.new("RGB", size), 8, min_size) == expected
+
+
+@pytest.mark.parametrize("size,tolerance,expected", [
+    ((1200, 800), 1, 8),  # whole blocks, only rounding
+    ((1201, 799), 2, 4),
+    ((1201, 799), 1, 1),
+    ((333, 250), 0.5, 1),
+])
+def test_reduction_factor_tolerance(size, tolerance, expected):
+    assert Image._reduction_factor(PImage.new("RGB", size), 8, 64, tolerance) == expected
+
+
+def test_fast_mode_small_image(image):
+    image_bytes, expected_avg = image
+    assert Image(image_bytes).get_average_rgb(fast=True) == expected_avg
@@ -0,0 +1,109 @@
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+
+import mock
+import pytest
+
+from app import envelope
+from app.analysis import Result
+from app.blobstore import BlobStore
+from app.compute import Compute
+from app.pool import ComputePool, PoolError, PROCESS, THREAD, average_bytes, average_shared
+
+
+@pytest.mark.parametrize("kind", [THREAD, PROCESS])
+def test_pool(kind, image):
+    image_bytes, expected_hex = image
+    pool = ComputePool(2, kind=kind)
+    try:
+        result = pool.submit(image_bytes=image_bytes).result(timeout=30)
+        assert result == Result(expected_hex, "JPEG", 219, 228)
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.parametrize("kind", [THREAD, PROCESS])
+def test_pool_blob(kind, image, tmp_path):
+    image_bytes, expected_hex = image
+    store = BlobStore(str(tmp_path))
+    pool = ComputePool(2, kind=kind, blob_store=store)
+    try:
+        future = pool.submit(blob=store.put(image_bytes))
+        assert future.result(timeout=30)[:2] == (expected_hex, "JPEG")
+    finally:
+        pool.shutdown()
+
+
+def test_pool_blob_not_configured(image, tmp_path):
+    image_bytes, _ = image
+    pool = ComputePool(1)
+    with pytest.raises(PoolError):
+        pool.submit(blob=BlobStore(str(tmp_path)).put(image_bytes))
+    pool.shutdown()
+
+
+def test_pool_releases_shared_memory(image):
+    image_bytes, _ = image
+    created = []
+
+    def create(*args, **kwargs):
+        shm = SharedMemory(*args, **kwargs)
+        created.append(shm.name)
+        return shm
+
+    pool = ComputePool(1, kind=PROCESS)
+    with mock.patch("app.pool.SharedMemory", side_effect=create):
+        pool.submit(image_bytes=image_bytes).result(timeout=30)
+    pool.shutdown()
+
+    assert len(created) == 1
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=created[0])
+
+
+@pytest.mark.parametrize("features", [None, ("mean", "histogram", "palette")])
+def test_shared_memory_decoded_in_place(image, features):
+    image_bytes, expected_hex = image
+    shm = SharedMemory(create=True, size=len(image_bytes) + 100)  # the block may be larger
+    try:
+        shm.buf[:len(image_bytes)] = image_bytes
+        with mock.patch("app.pool.average_bytes", wraps=average_bytes) as averaged:
+            result = average_shared(shm.name, len(image_bytes), features=features)
+        assert result.rgb == expected_hex and isinstance(averaged.call_args.args[0], memoryview)
+    finally:
+        shm.close()  # nothing of the block is exported anymore
+        shm.unlink()
+
+
+def test_results_published_in_order(image, monkeypatch):
+    """Test that results finishing out of order are published and acknowledged in order."""
+    image_bytes, expected_hex = image
+    monkeypatch.setenv("COMPUTE_WORKERS", "2")
+    futures = [Future(), Future()]
+    scheduled = []
+
+    with mock.patch.object(Compute, "connection") as mocked_connection, \
+            mock.patch("app.compute.ComputePool") as mocked_pool:
+        with mocked_connection() as conn:
+            channel = conn.channel()
+        conn.add_callback_threadsafe.side_effect = scheduled.append
+        mocked_pool.return_value.submit.side_effect = futures
+        Compute().start_listening()
+
+    channel.basic_qos.assert_called_once_with(prefetch_count=2)
+    callback = channel.basic_consume.call_args.kwargs["on_message_callback"]
+    for tag in (1, 2):
+        body, properties = envelope.encode(image_bytes, id=f"image-{tag}")
+        callback(channel, mock.MagicMock(delivery_tag=tag), properties, body)
+
+    futures[1].set_result(Result(expected_hex, "JPEG", 219, 228))
+    for drain in scheduled:
+        drain()
+    channel.basic_publish.assert_not_called()
+
+    futures[0].set_result(Result(expected_hex, "JPEG", 219, 228))
+    for drain in scheduled:
+        drain()
+    routing_keys = [call.kwargs["routing_key"] for call in channel.basic_publish.call_args_list]
+    assert routing_keys == ["image-1.computed", "image-2.computed"]
+    assert [call.kwargs["delivery_tag"] for call in channel.basic_ack.call_args_list] == [1, 2]
@@ -0,0 +1,122 @@
+import io
+
+import numpy
+import pytest
+from PIL import Image as PImage
+
+from app import stats
+from app.image import Image, ImageError
+
+
+def encode(image: PImage.Image, image_format: str = "PNG", **params) -> bytes:
+    stream = io.BytesIO()
+    image.save(stream, image_format, **params)
+    return stream.getvalue()
+
+
+def opener(image_bytes: bytes):
+    return lambda: PImage.open(io.BytesIO(image_bytes))
+
+
+@pytest.fixture
+def pixels():
+    rng = numpy.random.default_rng(1)
+    return rng.integers(0, 256, (300, 200, 3), dtype=numpy.uint8)
+
+
+@pytest.mark.parametrize("mode,color,expected", [
+    ("L", 128, "#808080"),
+    ("1", 1, "#ffffff"),
+    ("RGBA", (10, 20, 30, 0), "#0a141e"),  # alpha is ignored
+    ("CMYK", (0, 255, 255, 0), "#ff0000"),
+    ("I;16", 32896, "#808080"),  # 16-bit values are scaled to 8 bits
+    ("I", 65535, "#ffffff"),
+])
+def test_modes(mode, color, expected):
+    image = PImage.new(mode, (50, 40), color)
+    image_format = "TIFF" if mode in ("CMYK", "I") else "PNG"
+    assert Image(encode(image, image_format)).get_average_rgb() == expected
+
+
+def test_palette():
+    image = PImage.new("P", (50, 40), 1)
+    image.putpalette([0, 0, 0, 200, 100, 50] + [0] * 762)
+    assert Image(encode(image)).get_average_rgb() == "#c86432"
+
+
+@pytest.mark.parametrize("image_format", ["TIFF", "PPM", "BMP", "PNG"])
+def test_strips_match_exact_mean(pixels, image_format):
+    image_bytes = encode(PImage.fromarray(pixels), image_format)
+    image = PImage.open(io.BytesIO(image_bytes))
+    strips = list(stats.regions(image, opener(image_bytes), strip_bytes=10_000))
+    assert len(strips) > 1
+    assert sum(strip.height for strip in strips) == pixels.shape[0]
+
+    result = stats.average(PImage.open(io.BytesIO(image_bytes)), opener(image_bytes), strip_bytes=10_000)
+    assert numpy.allclose(result, pixels.mean(axis=(0, 1)))
+
+
+def test_raw_images_are_streamed(pixels):
+    image_bytes = encode(PImage.fromarray(pixels), "TIFF")
+    assert stats.streaming_mode(PImage.open(io.BytesIO(image_bytes))) == "raw"
+    assert stats.streaming_mode(PImage.open(io.BytesIO(encode(PImage.fromarray(pixels))))) is None
+
+
+def test_max_pixels(pixels):
+    image_bytes = encode(PImage.fromarray(pixels))
+    with pytest.raises(ImageError):
+        Image(image_bytes).get_average_rgb(max_pixels=300 * 200 - 1)
+
+
+def test_memory_budget(pixels):
+    budget = 300 * 200 * 4 - 1
+    with pytest.raises(ImageError):
+        Image(encode(PImage.fromarray(pixels))).get_average_rgb(memory_budget=budget)
+    # streamed images fit, JPEG images are reduced only in the fast mode
+    assert Image(encode(PImage.fromarray(pixels), "TIFF")).get_average_rgb(memory_budget=budget)
+    jpeg = encode(PImage.fromarray(pixels), "JPEG")
+    with pytest.raises(ImageError):
+        Image(jpeg).get_average_rgb(memory_budget=budget)
+    assert Image(jpeg).get_average_rgb(fast=True, max_scale=1, memory_budget=budget)
+
+
+@pytest.mark.parametrize("mode,color,expected", [
+    ("L", 128, "#808080"),
+    ("RGBA", (10, 20, 30, 0), "#0a141e"),
+    ("I;16", 32896, "#808080"),
+])
+def test_thumbnail_modes(mode, color, expected):
+    thumbnail = Image(encode(PImage.new(mode, (50, 40), color))).get_thumbnail(16)
+    assert thumbnail.shape == (16, 16, 3)
+    assert stats.to_hex(stats.batch_average([thumbnail])) == [expected]
+
+
+def test_batch_average(pixels):
+    images = [pixels, pixels[::2], numpy.zeros_like(pixels)]
+    thumbnails = [Image(encode(PImage.fromarray(image))).get_thumbnail(64) for image in images]
+    result = stats.batch_average(thumbnails)
+    assert result.shape == (3, 3)
+    for image, mean in zip(images, result):
+        assert numpy.allclose(mean, image.mean(axis=(0, 1)), atol=0.5)
+
+
+def test_batch_average_empty():
+    with pytest.raises(stats.StatsError):
+        stats.batch_average([])
+
+
+def test_to_hex():
+    colors = numpy.array([[0, 127.5, 255.4], [-3, 300, 16.49], [192, 192, 192]])
+    expected = [Image.rgb_to_hex(list(color)) for color in colors]
+    assert stats.to_hex(colors) == expected == ["#0080ff", "#00ff10", "#c0c0c0"]
+
+
+def test_thumbnail_memory_budget(pixels):
+    image_bytes = encode(PImage.fromarray(pixels))
+    assert Image(image_bytes).get_thumbnail(16, memory_budget=300 * 200 * 4 - 1) is None
+    # JPEG images are decoded at a reduced scale
+    assert Image(encode(PImage.fromarray(pixels), "JPEG")).get_thumbnail(
+        16, memory_budget=300 * 200 * 4 - 1
+    ) is not None
+    with pytest.raises(ImageError):
+        Image(image_bytes).get_thumbnail(16, max_pixels=300 * 200 - 1)
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+class IngestIndex:
+    """
+    Persistent record of already published files, keyed by path and (inode, size, mtime).
+
+    A file is considered new when its path is unknown or its stat signature changed.
+    If a content hash was recorded, a changed signature with identical content
+    (e.g. a touched or restored file) is not reported as new again (see is_new).
+
+    Records are committed every `checkpoint_every` additions, so a crash loses
+    at most one checkpoint worth of bookkeeping (and those files get re-sent).
+    """
+
+    def __init__(self, path: str = ":memory:", checkpoint_every: int = 100) -> None:
+        self.path = path
+        self.checkpoint_every = max(1, checkpoint_every)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS published ("
+            " path TEXT PRIMARY KEY,"
+            " inode INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " sha256 TEXT"
+            ")"
+        )
+        self._db.commit()
+        log.info(f"Ingest index {path} loaded, {len(self)} published files.")
+
+    @staticmethod
+    def signature(stat: os.stat_result) -> tuple:
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, path: str):
+        """Return (inode, size, mtime_ns, sha256) of a published file or None."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT inode, size, mtime_ns, sha256 FROM published WHERE path = ?", (path,)
+            ).fetchone()
+
+    @staticmethod
+    def file_digest(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_new(self, path: str, stat: os.stat_result) -> bool:
+        record = self.lookup(path)
+        if record is None:
+            return True
+        if tuple(record[:3]) == self.signature(stat):
+            return False
+        sha256 = record[3]
+        if sha256 and self.file_digest(path) == sha256:
+            # same content, only the metadata changed - remember the new signature
+            self.add(path, stat, sha256)
+            return False
+        return True
+
+    def add(self, path: str, stat: os.stat_result, sha256: str = None) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO published (path, inode, size, mtime_ns, sha256)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (path, *self.signature(stat), sha256)
+            )
+            self._pending += 1
+            if self._pending >= self.checkpoint_every:
+                self._commit()
+
+    def checkpoint(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def _commit(self) -> None:
+        if self._pending:
+            self._db.commit()
+            log.debug(f"Ingest index checkpoint, {self._pending} new records.")
+            self._pending = 0
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._db.close()
+
+    def __contains__(self, path: str) -> bool:
+        return self.lookup(path) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM published").fetchone()[0]
@@ -0,0 +1,130 @@
+import time
+from contextlib import ExitStack
+
+import pika
+import pika.exceptions
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+class PublisherError(Exception):
+    pass
+
+
+class Publisher:
+    """
+    Publishes messages over a single long-lived connection and channel.
+
+    Messages are buffered and sent in batches of `batch_size`, or once the oldest
+    buffered message waited for `linger` seconds. With `confirm` enabled a batch
+    is acknowledged by the broker before its `on_sent` callbacks are invoked:
+    single-message batches use publisher confirms, larger batches are wrapped
+    in a transaction, so the whole batch costs a single broker round-trip.
+    If the connection drops, it is re-opened and the pending batch is re-sent.
+    """
+
+    def __init__(self, connection_factory, exchange: str, routing_key: str,
+                 batch_size: int = 1, linger: float = 0.0, confirm: bool = True,
+                 retries: int = 3) -> None:
+        self.connection_factory = connection_factory
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self.confirm = confirm
+        self.retries = retries
+
+        self.pending = []  # (body, properties, on_sent)
+        self.first_pending_at = None
+        self.published_count = 0
+
+        self._stack = None
+        self._connection = None
+        self._channel = None
+
+    @property
+    def channel(self):
+        if self._channel is None:
+            self._open()
+        return self._channel
+
+    def _open(self) -> None:
+        self._stack = ExitStack()
+        self._connection = self._stack.enter_context(self.connection_factory())
+        self._channel = self._connection.channel()
+        if self.confirm:
+            if self.batch_size > 1:
+                self._channel.tx_select()
+            else:
+                self._channel.confirm_delivery()
+
+    def close(self) -> None:
+        if self._stack is not None:
+            try:
+                self._stack.close()
+            except pika.exceptions.AMQPError as e:
+                log.debug(f"Closing a broken connection failed: {e}")
+        self._stack = self._connection = self._channel = None
+
+    def publish(self, body: bytes, properties: pika.BasicProperties = None, on_sent=None) -> None:
+        if not self.pending:
+            self.first_pending_at = time.monotonic()
+        self.pending.append((body, properties, on_sent))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def time_to_flush(self):
+        """Seconds until the pending batch is due, None if there is nothing pending."""
+        if not self.pending:
+            return None
+        return max(0.0, self.first_pending_at + self.linger - time.monotonic())
+
+    def tick(self) -> None:
+        """Flush the pending batch if it lingered long enough and keep the connection alive."""
+        if self.pending and self.time_to_flush() == 0:
+            self.flush()
+        elif self._connection is not None:
+            try:
+                self._connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError as e:
+                log.warning(f"Broker connection lost while idle: {e}")
+                self.close()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        for attempt in range(1, self.retries + 1):
+            try:
+                self._send(batch)
+                break
+            except (pika.exceptions.AMQPConnectionError,
+                    pika.exceptions.AMQPChannelError,
+                    pika.exceptions.NackError) as e:
+                log.warning(f"Publishing failed (attempt {attempt}/{self.retries}): {e}")
+                self.close()
+                if attempt == self.retries:
+                    self.pending = batch + self.pending
+                    raise PublisherError(f"Could not publish {len(batch)} messages", e)
+
+        self.published_count += len(batch)
+        for _, _, on_sent in batch:
+            if on_sent is not None:
+                on_sent()
+
+    def _send(self, batch: list) -> None:
+        channel = self.channel
+        for body, properties, _ in batch:
+            kwargs = {"properties": properties} if properties is not None else {}
+            channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=self.routing_key,
+                body=body,
+                **kwargs
+            )
+        if self.confirm and self.batch_size > 1:
+            channel.tx_commit()
+        log.debug(f"Sent {len(batch)} messages, exchange={self.exchange}, key={self.routing_key}")
@@ -1,13 +1,22 @@
 import base64
+import functools
+import hashlib
 import json
 import os
+import tempfile
 import threading
 import time
 from contextlib import contextmanager
 
 import pika
 
-from app import get_logger, generate_uuid
+from app import envelope, get_logger, generate_uuid
+from app.blobstore import BlobStore
+from app.index import IngestIndex
+from app.publisher import Publisher
+from app.watcher import (
+    DirectoryWatcher, WatcherError, IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, IN_MOVED_TO, IN_Q_OVERFLOW
+)
 
 log = get_logger(__name__)
 
@@ -19,19 +28,44 @@ class ScannerError(Exception):
 class Scanner:
 
     def __init__(self) -> None:
-        self.watch_dir = os.environ.get("WATCH_DIR")
+        self.watch_dirs = [d for d in (os.environ.get("WATCH_DIR") or "").split(os.pathsep) if d]
+        self.recursive = (os.environ.get("SCAN_RECURSIVE") or "1") not in ("0", "false", "no")
         self.scan_interval = int(os.environ.get("SCAN_INTERVAL_SECS") or 5)
+        self.watch_mode = (os.environ.get("WATCH_MODE") or "auto").lower()
+        self.index_file = os.environ.get("INDEX_FILE") or os.path.join(
+            tempfile.gettempdir(), "scanner", "index.sqlite"
+        )
+        self.index_checkpoint = int(os.environ.get("INDEX_CHECKPOINT") or 100)
+        self.index_hash = (os.environ.get("INDEX_HASH") or "0") not in ("0", "false", "no")
 
         self.broker_host = os.environ.get("BROKER_HOST")
         self.broker_port = os.environ.get("BROKER_PORT") or 5672
         self.output_exchange = os.environ.get('OUTPUT_EXCHANGE')
         self.output_routing_key = os.environ.get('OUTPUT_ROUTING_KEY') or "compute"
+        self.publish_batch_size = int(os.environ.get("PUBLISH_BATCH_SIZE") or 50)
+        self.publish_linger = int(os.environ.get("PUBLISH_LINGER_MS") or 50) / 1000
+        self.publish_confirm = (os.environ.get("PUBLISH_CONFIRM") or "1") not in ("0", "false", "no")
 
         self.exit_event = threading.Event()
-        self.published_images = set()
+        self.in_flight = {}  # path -> signature of the files published but not sent yet
+        self.blob_store = BlobStore.from_env()
+        self.message_format = (os.environ.get("MESSAGE_FORMAT") or envelope.JSON).lower()
 
-        if not self.watch_dir:
+        if not self.watch_dirs:
             raise ScannerError("Directories to be scanned not configured.")
+        if self.watch_mode not in ("auto", "inotify", "poll"):
+            raise ScannerError(f"Unknown watch mode: {self.watch_mode}")
+        if self.message_format not in envelope.FORMATS:
+            raise ScannerError(f"Unknown message format: {self.message_format}")
+        self.index = IngestIndex(self.index_file, checkpoint_every=self.index_checkpoint)
+        self.publisher = Publisher(
+            lambda: self.connection(),
+            exchange=self.output_exchange,
+            routing_key=self.output_routing_key,
+            batch_size=self.publish_batch_size,
+            linger=self.publish_linger,
+            confirm=self.publish_confirm,
+        )
 
     @contextmanager
     def connection(self) -> pika.BlockingConnection:
@@ -49,56 +83,193 @@ class Scanner:
         finally:
             connection.close()
 
+    def _walk(self, directory: str):
+        """Stream (path, stat) of all files under the directory."""
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            yield entry.path, entry.stat()
+                        elif self.recursive and entry.is_dir(follow_symlinks=False):
+                            yield from self._walk(entry.path)
+                    except FileNotFoundError:
+                        continue  # removed while scanning
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+            log.warning(f"Can not scan {directory}: {e}")
+
+    def _is_new(self, path: str, stat: os.stat_result) -> bool:
+        """A file is new unless it is being sent or the index knows it (see IngestIndex.is_new)."""
+        if self.in_flight.get(path) == IngestIndex.signature(stat):
+            return False
+        return self.index.is_new(path, stat)
+
     def scan(self, directory: str) -> set:
-        # TODO: scan recursively
-        files = {os.path.join(directory, file) for file in os.listdir(directory)}
-        files = {file for file in files if os.path.isfile(file)}
-        return files.difference(self.published_images)
+        """Return files under the directory which were not published yet."""
+        return {path for path, stat in self._walk(directory) if self._is_new(path, stat)}
+
+    def scan_all(self) -> set:
+        new_images = set()
+        for directory in self.watch_dirs:
+            new_images.update(self.scan(directory))
+        return new_images
 
     def publish_image(self, image_path: str) -> None:
         image_id = generate_uuid()
         log.debug(f"Reading image {image_path}")
+        blob = image_bytes = None
         with open(image_path, 'rb') as image:
-            f = image.read()
-            image_bytes = bytearray(f)
+            stat = os.fstat(image.fileno())
+            if self.blob_store is not None:
+                blob = self.blob_store.put_stream(image)
+                sha256 = blob.sha256
+            else:
+                image_bytes = image.read()
+                sha256 = hashlib.sha256(image_bytes).hexdigest() if self.index_hash else None
 
-        log.debug(f"Publishing image id={image_id}")
-        with self.connection() as conn:
-            channel = conn.channel()
-            channel.basic_publish(
-                exchange=self.output_exchange,
-                routing_key=self.output_routing_key,
-                body=json.dumps({
-                    'id': image_id,
-                    'image': base64.b64encode(image_bytes).decode(),
-                }).encode(),
+        if self.message_format == envelope.BINARY:
+            body, properties = envelope.encode(
+                image_bytes,
+                id=image_id,
+                size=stat.st_size,
+                blob=blob.to_dict() if blob else None,
             )
-        log.debug(f"Sent, exchange={self.output_exchange}, key={self.output_routing_key}")
-        self.published_images.add(image_path)
+        else:
+            message = {'id': image_id}
+            if blob:
+                message['blob'] = blob.to_dict()
+            else:
+                message['image'] = base64.b64encode(image_bytes).decode()
+            body, properties = json.dumps(message).encode(), None
 
-    def start_scanning(self):
-        # 1) setup output exchange
-        with self.connection() as conn:
-            channel = conn.channel()
-            channel.exchange_declare(exchange=self.output_exchange, exchange_type='direct')
+        log.debug(f"Publishing image id={image_id}")
+        self.in_flight[image_path] = IngestIndex.signature(stat)
+        self.publisher.publish(
+            body=body,
+            properties=properties,
+            # only remember the file once the broker has taken over the message
+            on_sent=functools.partial(self._sent, image_path, stat, sha256),
+        )
 
-        # 2) Start the loop
-        log.info("Scanning loop started. To exit press CTRL+C")
-        no_new_images_msg_displayed = False
-        while True:
-            # TODO: scan more than 1 directory
-            new_images = self.scan(self.watch_dir)
+    def _sent(self, image_path: str, stat: os.stat_result, sha256: str = None) -> None:
+        self.index.add(image_path, stat, sha256)
+        if self.in_flight.get(image_path) == IngestIndex.signature(stat):
+            del self.in_flight[image_path]  # unless a newer version of it is being sent
+
+    def flush(self) -> None:
+        self.publisher.flush()
+        self.index.checkpoint()
+
+    def _create_watcher(self):
+        """Return an inotify watcher for the watched directory or None to use polling."""
+        if self.watch_mode == "poll":
+            return None
+        watcher = None
+        try:
+            watcher = DirectoryWatcher()
+            for directory in self.watch_dirs:
+                self._add_watch(watcher, directory)
+            return watcher
+        except WatcherError as e:
+            if watcher is not None:
+                watcher.close()
+            if self.watch_mode == "inotify":
+                raise ScannerError(e)
+            log.warning(f"inotify not available ({e}), falling back to polling.")
+            return None
+
+    def _add_watch(self, watcher: DirectoryWatcher, directory: str) -> None:
+        watcher.add(directory, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if not self.recursive:
+            return
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self._add_watch(watcher, entry.path)
 
-            if new_images:
-                log.info(f"New images found: {new_images}")
-                no_new_images_msg_displayed = False
-            elif not no_new_images_msg_displayed:
-                log.info(f"No new images ({self.watch_dir})")
-                no_new_images_msg_displayed = True
+    def _publish_new(self, new_images: set, report_idle: bool) -> bool:
+        """Publish new images, return whether the 'no new images' message was displayed."""
+        if new_images:
+            log.info(f"New images found: {new_images}")
+            report_idle = False
+        elif not report_idle:
+            log.info(f"No new images ({', '.join(self.watch_dirs)})")
+            report_idle = True
 
+        if new_images:
+            start = time.monotonic()
             for image in new_images:
                 self.publish_image(image)
+            self.publisher.flush()  # report the files sent, not the ones buffered
+            elapsed = time.monotonic() - start
+            log.info(
+                f"Published {len(new_images)} images in {elapsed:.3f}s "
+                f"({len(new_images) / max(elapsed, 1e-6):.1f} files/s)"
+            )
+        return report_idle
 
+    def _poll(self):
+        no_new_images_msg_displayed = False
+        while True:
+            new_images = self.scan_all()
+            no_new_images_msg_displayed = self._publish_new(new_images, no_new_images_msg_displayed)
+            self.flush()
+
+            self.publisher.tick()
             time.sleep(self.scan_interval)
             if self.exit_event.is_set():
                 break
+
+    def _watch(self, watcher: DirectoryWatcher):
+        # the watch is already registered, so nothing created during the initial scan is missed
+        no_new_images_msg_displayed = self._publish_new(self.scan_all(), False)
+        while not self.exit_event.is_set():
+            time_to_flush = self.publisher.time_to_flush()
+            events = watcher.read(
+                timeout=self.scan_interval if time_to_flush is None else time_to_flush
+            )
+            self.publisher.tick()
+            if not events:
+                self.index.checkpoint()
+                continue
+            if any(mask & IN_Q_OVERFLOW for _, mask in events):
+                log.warning("inotify queue overflow, rescanning.")
+                new_images = self.scan_all()
+            else:
+                new_images = set()
+                for path, mask in events:
+                    if mask & IN_ISDIR:
+                        if self.recursive:
+                            # files may have landed in the directory before it got watched
+                            try:
+                                self._add_watch(watcher, path)
+                            except (WatcherError, FileNotFoundError) as e:
+                                log.warning(f"Can not watch {path}: {e}")
+                            new_images.update(self.scan(path))
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        try:
+                            if self._is_new(path, os.stat(path)):
+                                new_images.add(path)
+                        except FileNotFoundError:
+                            continue
+            no_new_images_msg_displayed = self._publish_new(new_images, no_new_images_msg_displayed)
+
+    def start_scanning(self):
+        try:
+            # 1) setup output exchange
+            self.publisher.channel.exchange_declare(
+                exchange=self.output_exchange, exchange_type='direct'
+            )
+
+            # 2) Start the loop
+            watcher = self._create_watcher()
+            if watcher is None:
+                log.info("Scanning loop started (polling). To exit press CTRL+C")
+                self._poll()
+            else:
+                log.info("Scanning loop started (inotify). To exit press CTRL+C")
+                with watcher:
+                    self._watch(watcher)
+            self.flush()
+        finally:
+            self.publisher.close()
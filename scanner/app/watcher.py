@@ -0,0 +1,99 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+# see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class WatcherError(Exception):
+    pass
+
+
+class DirectoryWatcher:
+    """
+    A minimal inotify wrapper reporting files which were either closed after
+    writing or moved into a watched directory. Linux only, no extra dependencies.
+    """
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise WatcherError("libc not found, inotify is not available.")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise WatcherError("inotify is not supported on this platform.")
+
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherError(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self.watches = dict()  # watch descriptor -> directory
+
+    def add(self, directory: str, mask: int = IN_CLOSE_WRITE | IN_MOVED_TO) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise WatcherError(
+                f"Can not watch {directory}: {os.strerror(ctypes.get_errno())}"
+            )
+        self.watches[wd] = directory
+        log.debug(f"Watching {directory} (wd={wd})")
+
+    def read(self, timeout: float) -> list:
+        """
+        Block for at most `timeout` seconds and return a list of (path, mask) tuples.
+        On a queue overflow a single (None, IN_Q_OVERFLOW) event is reported,
+        the caller is expected to fall back to a full scan.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                return [(None, IN_Q_OVERFLOW)]
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            events.append((os.path.join(directory, os.fsdecode(name)), mask))
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,18 +1,30 @@
 #! /usr/bin/env python3
 """
 Generator component of the sorting system
-* Scans a given directory for file changes
+* Watches a given directory for new files (inotify, periodic scan as a fallback)
 * On a 'change detected' reads the image and sends it to the broker
 
 Modify behavior using these environment variables:
 * LOG_LEVEL
 * LOG_FILE
-* WATCH_DIR: directory to be periodically scanned for new images
+* WATCH_DIR: directories to be watched for new images, separated by ':'
+* SCAN_RECURSIVE: scan sub-directories as well (defaults to 1)
 * SCAN_INTERVAL_SECS (defaults to 5)
+* WATCH_MODE: 'inotify', 'poll' or 'auto' (defaults to 'auto', inotify with polling as a fallback)
+* INDEX_FILE: SQLite file recording already published files, so that they are not sent again after
+              a restart (defaults to one in the temporary directory)
+* INDEX_CHECKPOINT: commit the index every N published files (defaults to 100)
+* INDEX_HASH: record a sha256 of published files, so touched/restored files are not re-sent (defaults to 0)
+* MESSAGE_FORMAT: 'json' (base64 image) or 'binary' (raw image body, fields in headers),
+                  defaults to 'json'
+* BLOB_STORE_DIR: shared directory, when set images are stored there and only referenced in messages
 * BROKER_HOST
 * BROKER_PORT (defaults to 5672)
 * OUTPUT_EXCHANGE: where to send the computation results
 * OUTPUT_ROUTING_KEY: (defaults to 'compute')
+* PUBLISH_BATCH_SIZE: number of images sent per broker round-trip (defaults to 50)
+* PUBLISH_LINGER_MS: max time an image waits for its batch to fill up (defaults to 50)
+* PUBLISH_CONFIRM: wait for the broker to confirm published batches (defaults to 1)
 
 """
 import time
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def index_file(tmp_path_factory, monkeypatch):
+    """Keep the scanners' ingest index out of its persistent default location (and the watched dirs)."""
+    index_file = tmp_path_factory.mktemp("state") / "index.sqlite"
+    monkeypatch.setenv("INDEX_FILE", str(index_file))
+    return index_file
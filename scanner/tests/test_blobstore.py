@@ -0,0 +1,82 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from app.blobstore import Blob, BlobStore, BlobStoreError
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"))
+
+
+def test_put_and_open(store):
+    blob = store.put(b"image data")
+    assert blob.key == blob.sha256 == hashlib.sha256(b"image data").hexdigest()
+    assert blob.size == len(b"image data")
+    with store.open(blob) as data:
+        assert data[:] == b"image data"
+
+
+def test_put_is_idempotent(store):
+    assert store.put(b"image data") == store.put_stream(io.BytesIO(b"image data"))
+
+
+def test_put_stream_limit(store):
+    with pytest.raises(BlobStoreError):
+        store.put_stream(io.BytesIO(b"x" * 3_000_000), max_size=2_000_000)
+    assert [name for name in os.listdir(store.root)] == []
+    assert store.put_stream(io.BytesIO(b"image data"), max_size=10).size == 10
+
+
+def test_put_file(store, tmp_path):
+    source = tmp_path / "image.jpg"
+    source.write_bytes(b"x" * 3_000_000)
+    blob = store.put_file(str(source))
+    assert blob.size == 3_000_000
+    with store.open(blob) as data:
+        assert len(data) == 3_000_000
+
+
+def test_blob_reference():
+    blob = Blob(key="a" * 64, size=1, sha256="a" * 64)
+    assert Blob.from_dict(blob.to_dict()) == blob
+
+
+@pytest.mark.parametrize("reference", [
+    {"key": "../../etc/passwd", "size": 1, "sha256": "a" * 64},
+    {"key": "a" * 64, "size": "not a number", "sha256": "a" * 64},
+    {"key": "a" * 64},
+    None,
+])
+def test_invalid_blob_reference(reference):
+    with pytest.raises(BlobStoreError):
+        Blob.from_dict(reference)
+
+
+def test_open_missing_or_corrupted(store):
+    blob = store.put(b"image data")
+    with pytest.raises(BlobStoreError):
+        with store.open(blob._replace(size=1)):
+            pass
+    with pytest.raises(BlobStoreError):
+        with store.open(Blob(key="b" * 64, size=1, sha256="b" * 64)):
+            pass
+
+
+def test_gc(store):
+    old, reused, new = store.put(b"old"), store.put(b"reused"), store.put(b"new")
+    for blob in (old, reused):
+        os.utime(store.path(blob.key), (0, 0))
+    with open(os.path.join(store.root, ".tmp-abandoned"), "wb") as f:
+        f.write(b"partial")
+    os.utime(f.name, (0, 0))
+    store.put(b"reused")  # stored again, kept as long as a new one
+
+    assert store.gc(3600, dry_run=True) == (2, len(b"old") + len(b"partial"))
+    assert store.exists(old.key)
+    assert store.gc(3600) == (2, len(b"old") + len(b"partial"))
+    assert not store.exists(old.key) and store.exists(reused.key) and store.exists(new.key)
+    assert not os.path.exists(f.name)
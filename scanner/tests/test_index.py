@@ -0,0 +1,107 @@
+import os
+
+import mock
+import pytest
+
+from app.index import IngestIndex
+from app.scanner import Scanner
+
+
+@pytest.fixture
+def watched_dir(tmp_path, monkeypatch):
+    watched = tmp_path / "watched"
+    (watched / "nested" / "deeper").mkdir(parents=True)
+    (watched / "a.jpg").write_bytes(b"a")
+    (watched / "nested" / "b.jpg").write_bytes(b"b")
+    (watched / "nested" / "deeper" / "c.jpg").write_bytes(b"c")
+    monkeypatch.setenv("WATCH_DIR", str(watched))
+    monkeypatch.setenv("INDEX_FILE", str(tmp_path / "state" / "index.sqlite"))
+    return watched
+
+
+def test_index_signature(tmp_path):
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"data")
+    index = IngestIndex()
+    assert index.is_new(str(image), os.stat(image))
+
+    index.add(str(image), os.stat(image))
+    assert str(image) in index
+    assert not index.is_new(str(image), os.stat(image))
+
+    image.write_bytes(b"modified data")
+    assert index.is_new(str(image), os.stat(image))
+
+
+def test_scan_recursive(watched_dir):
+    scanner = Scanner()
+    assert {os.path.relpath(path, watched_dir) for path in scanner.scan_all()} == {
+        "a.jpg", os.path.join("nested", "b.jpg"), os.path.join("nested", "deeper", "c.jpg")
+    }
+
+
+def test_scan_not_recursive(watched_dir, monkeypatch):
+    monkeypatch.setenv("SCAN_RECURSIVE", "0")
+    scanner = Scanner()
+    assert scanner.scan_all() == {str(watched_dir / "a.jpg")}
+
+
+def test_scan_multiple_directories(watched_dir, tmp_path, monkeypatch):
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "d.jpg").write_bytes(b"d")
+    monkeypatch.setenv("WATCH_DIR", os.pathsep.join([str(watched_dir), str(other)]))
+    scanner = Scanner()
+    assert len(scanner.scan_all()) == 4
+
+
+@mock.patch.object(Scanner, "connection")
+def test_restart_does_not_republish(mock_conn, watched_dir):
+    scanner = Scanner()
+    for image in scanner.scan_all():
+        scanner.publish_image(image)
+    scanner.flush()
+    scanner.index.close()
+
+    restarted = Scanner()
+    assert len(restarted.index) == 3
+    assert restarted.scan_all() == set()
+
+    (watched_dir / "new.jpg").write_bytes(b"new")
+    assert restarted.scan_all() == {str(watched_dir / "new.jpg")}
+
+
+@mock.patch.object(Scanner, "connection")
+def test_touched_file_with_same_content(mock_conn, watched_dir, monkeypatch):
+    monkeypatch.setenv("INDEX_HASH", "1")
+    image = watched_dir / "a.jpg"
+    scanner = Scanner()
+    scanner.publish_image(str(image))
+    scanner.flush()
+
+    os.utime(image, ns=(0, 0))
+    assert str(image) not in scanner.scan_all()
+
+    image.write_bytes(b"other content")
+    assert str(image) in scanner.scan_all()
+
+
+def test_index_content_hash(tmp_path):
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"data")
+    index = IngestIndex()
+    index.add(str(image), os.stat(image), IngestIndex.file_digest(str(image)))
+
+    os.utime(image, ns=(0, 0))  # touched, the same content
+    assert not index.is_new(str(image), os.stat(image))
+    assert tuple(index.lookup(str(image))[:3]) == IngestIndex.signature(os.stat(image))
+
+
+def test_index_on_disk_by_default(tmp_path, monkeypatch, watched_dir):
+    monkeypatch.delenv("INDEX_FILE")
+    monkeypatch.setattr("tempfile.tempdir", str(tmp_path))
+    scanner = Scanner()
+    assert scanner.index_file == str(tmp_path / "scanner" / "index.sqlite")
+    scanner.index.add(str(watched_dir / "a.jpg"), os.stat(watched_dir / "a.jpg"))
+    scanner.index.close()
+    assert str(watched_dir / "a.jpg") not in Scanner().scan_all()  # restart-safe
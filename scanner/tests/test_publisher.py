@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+
+import mock
+import pika.exceptions
+import pytest
+
+from app.publisher import Publisher, PublisherError
+
+
+@pytest.fixture
+def connection():
+    return mock.MagicMock()
+
+
+@pytest.fixture
+def connection_factory(connection):
+    factory = mock.MagicMock()
+
+    @contextmanager
+    def connect():
+        factory()
+        yield connection
+
+    return connect, factory
+
+
+def test_single_connection(connection, connection_factory):
+    connect, factory = connection_factory
+    publisher = Publisher(connect, "exchange", "key", batch_size=1)
+    for i in range(5):
+        publisher.publish(f"message-{i}".encode())
+
+    factory.assert_called_once()
+    channel = connection.channel()
+    channel.confirm_delivery.assert_called_once()
+    assert channel.basic_publish.call_count == 5
+
+
+def test_batching(connection, connection_factory):
+    connect, _ = connection_factory
+    sent = []
+    publisher = Publisher(connect, "exchange", "key", batch_size=3, linger=60)
+    for i in range(4):
+        publisher.publish(f"message-{i}".encode(), on_sent=lambda i=i: sent.append(i))
+
+    channel = connection.channel()
+    channel.tx_select.assert_called_once()
+    assert channel.basic_publish.call_count == 3
+    channel.tx_commit.assert_called_once()
+    assert sent == [0, 1, 2]
+
+    publisher.tick()  # linger not expired yet
+    assert len(publisher.pending) == 1
+
+    publisher.flush()
+    assert sent == [0, 1, 2, 3]
+    assert channel.tx_commit.call_count == 2
+
+
+def test_linger(connection, connection_factory):
+    connect, _ = connection_factory
+    publisher = Publisher(connect, "exchange", "key", batch_size=10, linger=0)
+    publisher.publish(b"message")
+    assert publisher.time_to_flush() == 0
+    publisher.tick()
+    assert not publisher.pending
+    connection.channel().basic_publish.assert_called_once()
+
+
+def test_reconnect(connection, connection_factory):
+    connect, factory = connection_factory
+    channel = connection.channel()
+    channel.basic_publish.side_effect = [pika.exceptions.StreamLostError("lost"), None]
+    sent = []
+    publisher = Publisher(connect, "exchange", "key")
+    publisher.publish(b"message", on_sent=lambda: sent.append(True))
+
+    assert factory.call_count == 2
+    assert channel.basic_publish.call_count == 2
+    assert sent == [True]
+
+
+def test_give_up(connection, connection_factory):
+    connect, _ = connection_factory
+    connection.channel().basic_publish.side_effect = pika.exceptions.StreamLostError("lost")
+    sent = []
+    publisher = Publisher(connect, "exchange", "key", retries=2)
+    with pytest.raises(PublisherError):
+        publisher.publish(b"message", on_sent=lambda: sent.append(True))
+    assert len(publisher.pending) == 1, "unsent messages are kept"
+    assert not sent
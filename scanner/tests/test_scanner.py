@@ -5,6 +5,7 @@ import threading
 import mock
 import pytest
 
+from app import envelope
 from app.scanner import Scanner
 
 
@@ -76,3 +77,53 @@ def test_scanner_publish(test_dir):
         thread.join()
         with scanner.connection() as conn:
             assert conn.channel().basic_publish.call_count == len(test_dir)
+
+
+def test_scanner_publish_blob_reference(tmp_path, monkeypatch, test_dir):
+    """Test that with a blob store configured only a reference to the stored image is sent."""
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path))
+    scanner = Scanner()
+    with mock.patch.object(scanner, "connection"):
+        for file in test_dir:
+            scanner.publish_image(os.path.join(TEST_DATA_PATH, file))
+        scanner.flush()
+        with scanner.connection() as conn:
+            calls = conn.channel().basic_publish.call_args_list
+
+    assert len(calls) == len(test_dir)
+    for call in calls:
+        body = json.loads(call.kwargs["body"])
+        assert "image" not in body
+        assert scanner.blob_store.exists(body["blob"]["key"])
+
+
+def test_scanner_publish_binary(monkeypatch, test_dir):
+    """Test that in the binary format the raw image is the body and the id is a header."""
+    monkeypatch.setenv("MESSAGE_FORMAT", "binary")
+    image_path = os.path.join(TEST_DATA_PATH, test_dir[0])
+    scanner = Scanner()
+    with mock.patch.object(scanner, "connection"):
+        scanner.publish_image(image_path)
+        scanner.flush()
+        with scanner.connection() as conn:
+            sent = conn.channel().basic_publish.call_args.kwargs
+
+    headers, payload = envelope.decode(sent["body"], sent["properties"])
+    with open(image_path, "rb") as image:
+        assert payload == image.read()
+    assert headers["id"]
+    assert headers["size"] == len(payload)
+
+
+def test_in_flight_not_published_again(monkeypatch, test_dir):
+    """Test that a file waiting in a batch is not found new again before the batch is sent."""
+    monkeypatch.setenv("PUBLISH_BATCH_SIZE", "100")
+    image_path = os.path.join(TEST_DATA_PATH, test_dir[0])
+    scanner = Scanner()
+    with mock.patch.object(scanner, "connection"):
+        scanner.publish_image(image_path)
+        assert image_path not in scanner.index and image_path not in scanner.scan(TEST_DATA_PATH)
+
+        scanner._publish_new(scanner.scan(TEST_DATA_PATH), False)  # the batch is sent before the report
+        assert not scanner.publisher.pending and not scanner.in_flight
+    assert image_path in scanner.index and scanner.scan(TEST_DATA_PATH) == set()
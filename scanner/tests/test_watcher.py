@@ -0,0 +1,78 @@
+import os
+import shutil
+import threading
+
+import mock
+import pytest
+
+from app.scanner import Scanner
+from app.watcher import DirectoryWatcher, IN_CLOSE_WRITE, IN_MOVED_TO
+
+
+@pytest.fixture
+def watched_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("WATCH_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_watcher_reports_written_files(watched_dir):
+    with DirectoryWatcher() as watcher:
+        watcher.add(str(watched_dir))
+        (watched_dir / "image.jpg").write_bytes(b"data")
+        events = watcher.read(timeout=1)
+    assert (str(watched_dir / "image.jpg"), IN_CLOSE_WRITE) in events
+
+
+def test_watcher_reports_moved_files(watched_dir, tmp_path_factory):
+    source = tmp_path_factory.mktemp("source") / "image.jpg"
+    source.write_bytes(b"data")
+    with DirectoryWatcher() as watcher:
+        watcher.add(str(watched_dir))
+        shutil.move(str(source), str(watched_dir / "image.jpg"))
+        events = watcher.read(timeout=1)
+    assert [(str(watched_dir / "image.jpg"), IN_MOVED_TO)] == events
+
+
+def test_watcher_idle(watched_dir):
+    with DirectoryWatcher() as watcher:
+        watcher.add(str(watched_dir))
+        assert watcher.read(timeout=0.1) == []
+
+
+@mock.patch.object(Scanner, "connection")
+def test_scanner_watch_mode(mock_connection, watched_dir, monkeypatch):
+    """Test that a file dropped into the watched directory is published without a rescan."""
+    monkeypatch.setenv("WATCH_MODE", "inotify")
+    scanner = Scanner()
+    published = threading.Event()
+
+    def publish_image(path):
+        scanner.index.add(path, os.stat(path))
+        published.set()
+        scanner.exit_event.set()
+
+    scanner.publish_image = mock.MagicMock(side_effect=publish_image)
+    scanner.scan = mock.MagicMock(wraps=scanner.scan)
+    thread = threading.Thread(target=scanner.start_scanning, daemon=True)
+    thread.start()
+
+    (watched_dir / "image.jpg").write_bytes(b"data")
+    assert published.wait(timeout=5)
+    thread.join(timeout=5)
+
+    scanner.publish_image.assert_called_once_with(os.path.join(str(watched_dir), "image.jpg"))
+    scanner.scan.assert_called_once()  # only the initial catch-up scan
+
+
+@mock.patch.object(Scanner, "connection")
+def test_scanner_poll_mode(mock_connection, watched_dir, monkeypatch):
+    monkeypatch.setenv("WATCH_MODE", "poll")
+    monkeypatch.setenv("SCAN_INTERVAL_SECS", "0")
+    (watched_dir / "image.jpg").write_bytes(b"data")
+    scanner = Scanner()
+    scanner.publish_image = mock.MagicMock()
+    with mock.patch("app.scanner.DirectoryWatcher") as mock_watcher:
+        scanner.exit_event.set()
+        scanner.start_scanning()
+    mock_watcher.assert_not_called()
+    scanner.publish_image.assert_called_once_with(os.path.join(str(watched_dir), "image.jpg"))
@@ -0,0 +1,187 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+MAX_DISTANCE = 400.0  # more than the distance of any two colors in the Lab space
+START_RADIUS = 4.0
+
+
+class ColorIndexError(Exception):
+    pass
+
+
+def hex_to_rgb(color: str) -> tuple:
+    value = (color or "").lstrip("#")
+    try:
+        if len(value) != 6:
+            raise ValueError(value)
+        return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        raise ColorIndexError(f"Invalid color: {color}")
+
+
+def rgb_to_lab(rgb: tuple) -> tuple:
+    """CIE L*a*b* (D65) of an sRGB color, distances in Lab roughly follow the perceived difference."""
+    def linear(channel):
+        channel /= 255
+        return channel / 12.92 if channel <= 0.04045 else ((channel + 0.055) / 1.055) ** 2.4
+
+    r, g, b = (linear(channel) for channel in rgb)
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+
+    def f(t):
+        return t ** (1 / 3) if t > 216 / 24389 else (24389 / 27 * t + 16) / 116
+
+    fx, fy, fz = f(x), f(y), f(z)
+    return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+
+class ColorIndex:
+    """
+    Sorted images and their colors in an SQLite file, queried by the nearest color.
+
+    Colors are indexed in the Lab space in an R*Tree (a box around the color is searched,
+    growing until enough images are found), plain indexed columns are used if SQLite
+    is built without the R*Tree module. Writes are committed every `commit_every` images.
+    """
+
+    def __init__(self, path: str, readonly: bool = False, commit_every: int = 100) -> None:
+        self.path = path
+        self.readonly = readonly
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+        if readonly:
+            if not os.path.isfile(path):
+                raise ColorIndexError(f"Color index {path} does not exist")
+            self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            self.rtree = bool(self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'colors_rtree'"
+            ).fetchone())
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "id TEXT UNIQUE, rgb TEXT, l REAL, a REAL, b REAL, "
+            "path TEXT, size INTEGER, format TEXT, sorted_at REAL)"
+        )
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS colors_rtree "
+                "USING rtree(id, l0, l1, a0, a1, b0, b1)"
+            )
+            self.rtree = True
+        except sqlite3.OperationalError:
+            log.warning("SQLite has no R*Tree module, using plain indexes")
+            self._db.execute("CREATE INDEX IF NOT EXISTS images_lab ON images (l, a, b)")
+            self.rtree = False
+        self._db.commit()
+
+    def _insert(self, image_id: str, color: str, path: str, size: int, image_format: str,
+                sorted_at: float) -> None:
+        l, a, b = rgb_to_lab(hex_to_rgb(color))
+        self._db.execute(
+            "INSERT INTO images (id, rgb, l, a, b, path, size, format, sorted_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+            "rgb = excluded.rgb, l = excluded.l, a = excluded.a, b = excluded.b, "
+            "path = excluded.path, size = excluded.size, format = excluded.format, "
+            "sorted_at = excluded.sorted_at",
+            (image_id, color.lower(), l, a, b, path, size, image_format, sorted_at)
+        )
+        if self.rtree:
+            rowid = self._db.execute("SELECT rowid FROM images WHERE id = ?", (image_id,)).fetchone()[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO colors_rtree VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (rowid, l, l, a, a, b, b)
+            )
+
+    def add(self, image_id: str, color: str, path: str, size: int, image_format: str,
+            sorted_at: float = None) -> None:
+        with self._lock:
+            self._insert(image_id, color, path, size, image_format, sorted_at or time.time())
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._commit()
+
+    def _commit(self) -> None:
+        self._db.commit()
+        self._uncommitted = 0
+
+    def commit(self) -> None:
+        with self._lock:
+            if self._uncommitted:
+                self._commit()
+
+    def rebuild(self, entries) -> int:
+        """Replace the content of the index with the (id, rgb, path, size, format, sorted_at) entries."""
+        with self._lock:
+            self._db.execute("DELETE FROM images")
+            if self.rtree:
+                self._db.execute("DELETE FROM colors_rtree")
+            count = 0
+            for entry in entries:
+                self._insert(*entry)
+                count += 1
+            self._commit()
+        return count
+
+    def _candidates(self, lab: tuple, radius: float) -> list:
+        l, a, b = lab
+        box = (l - radius, l + radius, a - radius, a + radius, b - radius, b + radius)
+        if self.rtree:
+            query = (
+                "SELECT images.id, rgb, l, a, b, path, size, format, sorted_at FROM colors_rtree "
+                "JOIN images ON images.rowid = colors_rtree.id "
+                "WHERE l1 >= ? AND l0 <= ? AND a1 >= ? AND a0 <= ? AND b1 >= ? AND b0 <= ?"
+            )
+        else:
+            query = (
+                "SELECT id, rgb, l, a, b, path, size, format, sorted_at FROM images "
+                "WHERE l BETWEEN ? AND ? AND a BETWEEN ? AND ? AND b BETWEEN ? AND ?"
+            )
+        return self._db.execute(query, box).fetchall()
+
+    def nearest(self, color: str, limit: int = 10, max_distance: float = MAX_DISTANCE) -> list:
+        """The images closest to the color (CIE76 distance in Lab), the closest first."""
+        lab = rgb_to_lab(hex_to_rgb(color))
+        radius = min(START_RADIUS, max_distance)
+        with self._lock:
+            while True:
+                found = []
+                for row in self._candidates(lab, radius):
+                    image_id, rgb, l, a, b, path, size, image_format, sorted_at = row
+                    distance = math.dist(lab, (l, a, b))
+                    if distance <= radius:
+                        found.append({
+                            "id": image_id, "rgb": rgb, "path": path, "size": size,
+                            "format": image_format, "sorted_at": sorted_at, "distance": round(distance, 3),
+                        })
+                # any image closer than the radius is in the box, those found are the closest
+                if len(found) >= limit or radius >= max_distance:
+                    break
+                radius = min(radius * 2, max_distance)
+        return sorted(found, key=lambda image: (image["distance"], image["id"]))[:limit]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if not self.readonly:
+                self._db.commit()
+            self._db.close()
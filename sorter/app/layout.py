@@ -0,0 +1,155 @@
+import collections
+import os
+import re
+import threading
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+FLAT = "flat"
+SHARDED = "sharded"
+LAYOUTS = (FLAT, SHARDED)
+
+HEX_COLOR = re.compile(r"^#?([0-9a-fA-F]{6})$")
+
+
+class LayoutError(Exception):
+    pass
+
+
+def parse_color(color: str) -> tuple:
+    match = HEX_COLOR.match(color or "")
+    if not match:
+        raise LayoutError(f"Invalid color: {color}")
+    value = match.group(1)
+    return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+
+
+class Layout:
+    """
+    Directory of an image in the output tree based on its color.
+
+    The color is quantized to `bits` per channel (each bucket is named after its lowest color,
+    8 bits keep the exact color). The 'flat' layout has one directory per bucket ('#c0c0c0',
+    up to 16M siblings), the 'sharded' one a level per channel ('c0/c0/c0', at most 256 entries
+    in any directory).
+    """
+
+    def __init__(self, kind: str = FLAT, bits: int = 8) -> None:
+        if kind not in LAYOUTS:
+            raise LayoutError(f"Unknown layout: {kind}")
+        if not 1 <= bits <= 8:
+            raise LayoutError(f"Bits per channel have to be between 1 and 8, not {bits}")
+        self.kind = kind
+        self.bits = bits
+        self.mask = (0xff << (8 - bits)) & 0xff
+
+    def bucket(self, color: str) -> tuple:
+        return tuple(channel & self.mask for channel in parse_color(color))
+
+    def directory(self, color: str) -> str:
+        """Path of the color's directory, relative to the root of the output tree."""
+        r, g, b = self.bucket(color)
+        if self.kind == SHARDED:
+            return os.path.join(f"{r:02x}", f"{g:02x}", f"{b:02x}")
+        return f"#{r:02x}{g:02x}{b:02x}"
+
+    def color_of(self, directory: str):
+        """The (bucket) color of a directory relative to the root of the tree, None if it isn't one."""
+        parts = directory.split(os.sep)
+        if self.kind == SHARDED:
+            if len(parts) != 3 or not all(re.match(r"^[0-9a-f]{2}$", part) for part in parts):
+                return None
+            return "#" + "".join(parts)
+        if len(parts) != 1 or not HEX_COLOR.match(parts[0]) or not parts[0].startswith("#"):
+            return None
+        return parts[0].lower()
+
+
+def sorted_images(root: str, layout: Layout):
+    """Yield (id, color, path relative to root, size, format, modified) of the images in the tree."""
+    for path, directories, names in os.walk(root):
+        directories[:] = [name for name in directories if not name.startswith(".")]
+        color = layout.color_of(os.path.relpath(path, root))
+        if color is None:
+            continue
+        for name in names:
+            if name.startswith("."):
+                continue  # temporary files
+            image_id, _, image_format = name.rpartition(".")
+            image_path = os.path.join(path, name)
+            stat = os.stat(image_path)
+            relative_path = os.path.relpath(image_path, root)
+            yield image_id, color, relative_path, stat.st_size, image_format, stat.st_mtime
+
+
+class DirectoryCache:
+    """Directories known to exist, so that they are not created (stat-ed) for every image."""
+
+    def __init__(self, max_entries: int = 65536) -> None:
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def ensure(self, path: str) -> str:
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return path
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._entries[path] = True
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return path
+
+    def discard(self, path: str) -> None:
+        """Forget a directory, e.g. removed behind our back."""
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def migrate(source_root: str, layout: Layout, target_root: str = None, dry_run: bool = False) -> int:
+    """
+    Re-file an output tree with one directory per exact color ('#c0c0c0/<image>', the original
+    layout) into the given layout, in place or into target_root (on the same filesystem,
+    files are renamed). Emptied directories are removed. Returns the number of moved files.
+    """
+    target_root = target_root or source_root
+    directories = DirectoryCache()
+    moved = 0
+    with os.scandir(source_root) as entries:
+        color_dirs = [entry for entry in entries if entry.is_dir() and HEX_COLOR.match(entry.name)]
+
+    for color_dir in sorted(color_dirs, key=lambda entry: entry.name):
+        target_dir = os.path.join(target_root, layout.directory(color_dir.name))
+        if os.path.abspath(target_dir) == os.path.abspath(color_dir.path):
+            continue
+        with os.scandir(color_dir.path) as entries:
+            files = [entry for entry in entries if entry.is_file()]
+        for entry in files:
+            target_path = os.path.join(target_dir, entry.name)
+            if os.path.exists(target_path):
+                log.warning(f"{target_path} already exists, {entry.path} left in place")
+                continue
+            if dry_run:
+                log.info(f"Would move {entry.path} -> {target_path}")
+            else:
+                directories.ensure(target_dir)
+                os.rename(entry.path, target_path)
+            moved += 1
+        if not dry_run:
+            try:
+                os.rmdir(color_dir.path)
+            except OSError:
+                log.warning(f"{color_dir.path} not empty, left in place")
+    log.info(f"{moved} files {'to be ' if dry_run else ''}moved from {len(color_dirs)} directories")
+    return moved
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import time
+import uuid
+
+from app import get_logger
+from app.writer import NONE, FileWriter, fsync_dir
+
+log = get_logger(__name__)
+
+
+FILES = "files"
+DEDUP = "dedup"
+STORAGES = (FILES, DEDUP)
+
+OBJECTS_DIR = ".objects"  # hidden, skipped when walking the output tree
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+class ObjectStore:
+    """
+    Sorted images stored once per content: each unique image is an object named by its sha256
+    and every sorted image is a hardlink to it, so readers of the output tree see plain files.
+    The object's link count is its reference count, an object linked from nowhere (st_nlink == 1)
+    is garbage (see gc). The objects have to be on the same filesystem as the output tree.
+    """
+
+    def __init__(self, root: str, writer: FileWriter) -> None:
+        if writer.link:
+            raise ObjectStoreError("Objects are copied, linked source files would count as references.")
+        self.root = root
+        self.writer = writer
+        self.skipped = 0  # writes of already stored objects
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def references(self, sha256: str) -> int:
+        """Number of sorted images sharing the object."""
+        try:
+            return os.stat(self.path(sha256)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def _link(self, object_path: str, final_path: str) -> None:
+        """Atomically (re)place the final path by a link to the object."""
+        try:
+            if os.path.samefile(object_path, final_path):
+                return
+        except FileNotFoundError:
+            pass
+        tmp_path = os.path.join(os.path.dirname(final_path), f".tmp-{uuid.uuid4().hex}")
+        os.link(object_path, tmp_path)
+        os.replace(tmp_path, final_path)
+        if self.writer.fsync != NONE:
+            fsync_dir(os.path.dirname(final_path))
+
+    def write(self, final_path: str, data=None, source_path: str = None, sha256: str = None,
+              on_durable=None, on_failed=None) -> str:
+        """
+        Store the image (bytes or a source file) unless its object exists and link it to the final path.
+        The link is made (and `on_durable` called) once the object is durable, see FileWriter
+        (`on_failed` is called instead if that fails).
+        Returns the path of the object.
+        """
+        if sha256 is None:
+            if data is None:
+                raise ObjectStoreError("The hash of a source file has to be known.")
+            sha256 = hashlib.sha256(data).hexdigest()
+        object_path = self.path(sha256)
+
+        def link():
+            self._link(object_path, final_path)
+            if on_durable is not None:
+                on_durable()
+
+        if os.path.isfile(object_path):
+            try:
+                link()
+                self.skipped += 1
+                log.debug(f"Object {sha256} already stored, linked it")
+                return object_path
+            except FileNotFoundError:
+                if os.path.isfile(object_path):
+                    raise  # the target directory is missing
+                log.debug(f"Object {sha256} collected meanwhile, storing it again")
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        # a concurrent write of the same new content replaces the object, the earlier links
+        # keep the previous copy, which is then stored twice (but never lost)
+        self.writer.write(
+            object_path, data=data, source_path=source_path, on_durable=link, on_failed=on_failed
+        )
+        return object_path
+
+    def stats(self) -> dict:
+        """Number of objects and of the images linking them, bytes stored and bytes the images take."""
+        stats = {"objects": 0, "references": 0, "stored_bytes": 0, "referenced_bytes": 0}
+        for path, _, names in os.walk(self.root):
+            for name in names:
+                if name.startswith("."):
+                    continue
+                stat = os.stat(os.path.join(path, name))
+                stats["objects"] += 1
+                stats["references"] += stat.st_nlink - 1
+                stats["stored_bytes"] += stat.st_size
+                stats["referenced_bytes"] += stat.st_size * (stat.st_nlink - 1)
+        return stats
+
+    def gc(self, min_age: float = 3600, dry_run: bool = False) -> tuple:
+        """
+        Remove the objects no sorted image links to and the abandoned temporary files,
+        younger ones are kept (an object is linked only after it is written).
+        Returns (number of removed files, bytes freed).
+        """
+        deadline = time.time() - min_age
+        removed, freed = 0, 0
+        for path, _, names in os.walk(self.root):
+            for name in names:
+                file_path = os.path.join(path, name)
+                stat = os.stat(file_path)
+                if stat.st_mtime > deadline or (stat.st_nlink > 1 and not name.startswith(".")):
+                    continue
+                if dry_run:
+                    log.info(f"Would remove {file_path}")
+                else:
+                    os.unlink(file_path)
+                removed += 1
+                freed += stat.st_size
+        log.info(f"{removed} unreferenced files ({freed}B) {'to be ' if dry_run else ''}removed")
+        return removed, freed
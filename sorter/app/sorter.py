@@ -1,13 +1,23 @@
 import base64
+import functools
 import io
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from typing import NamedTuple
 
 import pika as pika
 from PIL import Image, UnidentifiedImageError
 
-from app import get_logger
+from app import envelope, get_logger, writer
+from app.blobstore import Blob, BlobStore
+from app.colorindex import ColorIndex, ColorIndexError
+from app.envelope import EnvelopeError
+from app.layout import DirectoryCache, Layout, LayoutError
+from app.objects import OBJECTS_DIR, STORAGES, ObjectStore, ObjectStoreError
+from app.writer import FileWriter, WriterError
 
 log = get_logger(__name__)
 
@@ -16,6 +26,24 @@ class SorterError(Exception):
     pass
 
 
+EXCLUSIVE = "exclusive"
+SHARED = "shared"
+PARTITIONED = "partitioned"
+SCALE_MODES = (EXCLUSIVE, SHARED, PARTITIONED)
+
+BLOB_GC_INTERVAL = 3600  # seconds between the sweeps of the blob store
+
+
+class SortJob(NamedTuple):
+    """A validated image, ready to be written."""
+    image_id: str
+    color: str
+    image: Image.Image
+    image_data: bytes = None
+    source_path: str = None
+    sha256: str = None
+
+
 class Sorter:
 
     def __init__(self) -> None:
@@ -26,8 +54,56 @@ class Sorter:
         self.broker_port = os.environ.get("BROKER_PORT") or 5672
         self.input_exchange = os.environ.get("INPUT_EXCHANGE")
         self.topic = "#"  # handle all messages from the exchange
+        self.scale_mode = (os.environ.get("SCALE_MODE") or EXCLUSIVE).lower()
+        self.sort_queue = os.environ.get("SORT_QUEUE") or "sorter"
+        self.partition = os.environ.get("SORTER_PARTITION")
+        self.partition_weight = int(os.environ.get("PARTITION_WEIGHT") or 1)
+        self.partition_by = (os.environ.get("PARTITION_BY") or "id").lower()
+        if self.scale_mode not in SCALE_MODES:
+            raise SorterError(f"Unknown scale mode: {self.scale_mode}")
+        if self.partition_by not in ("id", "color"):
+            raise SorterError(f"Unknown partitioning: {self.partition_by}")
+        if self.scale_mode == PARTITIONED and not self.partition:
+            # a durable queue per host name would be left behind, unconsumed, by every replaced instance
+            raise SorterError("SORTER_PARTITION has to be set in the partitioned mode.")
+        self.blob_store = BlobStore.from_env()
+        self.fsync = (os.environ.get("FSYNC") or writer.BATCH).lower()
+        self.fsync_batch = int(os.environ.get("FSYNC_BATCH") or 32)
+        self.fsync_interval = int(os.environ.get("FSYNC_INTERVAL_MS") or 1000) / 1000
+        try:
+            self.layout = Layout(
+                kind=(os.environ.get("COLOR_LAYOUT") or "flat").lower(),
+                bits=int(os.environ.get("COLOR_BITS") or 8),
+            )
+        except LayoutError as e:
+            raise SorterError(e)
+        self.index_file = os.environ.get("COLOR_INDEX")
+        self.index = ColorIndex(self.index_file) if self.index_file else None
+        self.directories = DirectoryCache(int(os.environ.get("DIRECTORY_CACHE_SIZE") or 65536))
+        self.writer_threads = int(os.environ.get("WRITER_THREADS") or 0)
+        self.writer_queue = int(os.environ.get("WRITER_QUEUE") or max(1, 4 * self.writer_threads))
+        self.blob_retention = float(os.environ.get("BLOB_RETENTION_HOURS") or 24) * 3600
+        self._blob_gc = None  # the running sweep
+        self.blob_copy = (os.environ.get("BLOB_COPY") or "copy").lower()
+        if self.blob_copy not in ("copy", "link"):
+            raise SorterError(f"Unknown blob copy mode: {self.blob_copy}")
+        try:
+            self.writer = FileWriter(
+                fsync=self.fsync, batch_size=self.fsync_batch, link=self.blob_copy == "link"
+            )
+        except WriterError as e:
+            raise SorterError(e)
+        self.storage = (os.environ.get("STORAGE") or "files").lower()
+        if self.storage not in STORAGES:
+            raise SorterError(f"Unknown storage: {self.storage}")
 
         self.setup_target_dir()
+        self.objects = None
+        if self.storage == "dedup":
+            try:
+                self.objects = ObjectStore(os.path.join(self.target_dir, OBJECTS_DIR), self.writer)
+            except ObjectStoreError as e:
+                raise SorterError(e)
 
     def setup_target_dir(self):
         if not self.target_dir:
@@ -54,7 +130,7 @@ class Sorter:
 
     @staticmethod
     def _validate_body(body):
-        required_fields = ("image", "id", "rgb")
+        required_fields = ("id", "rgb")
         try:
             body = json.loads(body)
         except Exception as e:
@@ -63,16 +139,21 @@ class Sorter:
         for field in required_fields:
             if not body.get(field):
                 raise SorterError(f"'{field}' field missing in message body: {body}")
+        if not body.get("image") and not body.get("blob"):
+            raise SorterError(f"Neither 'image' nor 'blob' field in message body: {body}")
         return body
 
     @staticmethod
     def _validate_image(image_data_b64_string) -> Image:
         """Use pillow to verify if the received data is an actual image."""
         image_bytes = base64.b64decode(image_data_b64_string.encode())
-        stream = io.BytesIO(image_bytes)
+        return Sorter._load_image(io.BytesIO(image_bytes))
+
+    @staticmethod
+    def _load_image(stream) -> Image:
+        """Probe the image, only its header is read, the image data is not decoded."""
         try:
-            image = Image.open(stream)
-            image.getexif()
+            image = Image.open(stream)  # lazy, getexif() would decode a whole PNG
         except UnidentifiedImageError as e:
             raise SorterError("Invalid image data", e)
 
@@ -82,51 +163,264 @@ class Sorter:
         log.debug(f"'{image.format}' image loaded: {image.height}x{image.width}")
         return image
 
-    def sort(self, image_name: str, image_color: str, image: Image) -> None:
-        """Sort/save image in a subdir based on the supplied hex color value."""
+    def _write(self, final_path: str, image_data, source_path: str, sha256: str, on_durable,
+               on_failed) -> None:
+        if self.objects is None:
+            self.writer.write(
+                final_path, data=image_data, source_path=source_path,
+                on_durable=on_durable, on_failed=on_failed,
+            )
+            return
+        try:
+            self.objects.write(
+                final_path, data=image_data, source_path=source_path, sha256=sha256,
+                on_durable=on_durable, on_failed=on_failed,
+            )
+        except ObjectStoreError as e:
+            raise SorterError(e)
+
+    def sort(self, image_name: str, image_color: str, image: Image, image_data=None,
+             source_path: str = None, on_durable=None, sha256: str = None, on_failed=None) -> str:
+        """
+        Sort/save image in a subdir based on the supplied hex color value (see Layout).
+        The received bytes (or the source file) are written as they are, the image is never re-encoded.
+        With the 'dedup' storage, an image is stored once per content and linked (see ObjectStore),
+        the sha256 of a source file has to be given.
+        `on_durable` is called once the image is written (see FileWriter), possibly later
+        and by another thread, `on_failed` with the error if writing it fails then.
+        """
         log.debug(f"Sorting image {image.height}x{image.width} with RGB: {image_color}")
-        target_color_dir_path = os.path.join(self.target_dir, image_color)
-        os.makedirs(target_color_dir_path, exist_ok=True)
+        try:
+            target_color_dir_path = os.path.join(self.target_dir, self.layout.directory(image_color))
+        except LayoutError as e:
+            raise SorterError(e)
         final_path = os.path.join(target_color_dir_path, image_name) + f".{image.format}"
         log.info(f"Saving: {final_path}")
-        image.save(final_path)
-
-    def sort_callback(self, body):
-        body = self._validate_body(body)
-        image = self._validate_image(body["image"])
-        self.sort(
-            image_name=body["id"],
-            image_color=body["rgb"],
-            image=image
+        if self.index is not None:
+            size = len(image_data) if image_data is not None else os.path.getsize(source_path)
+            on_durable = functools.partial(
+                self._index_durable, image_name, image_color, final_path, size, image.format, on_durable
+            )
+        self.directories.ensure(target_color_dir_path)
+        try:
+            self._write(final_path, image_data, source_path, sha256, on_durable, on_failed)
+        except FileNotFoundError:
+            # the directory was removed since it was cached
+            self.directories.discard(target_color_dir_path)
+            self.directories.ensure(target_color_dir_path)
+            self._write(final_path, image_data, source_path, sha256, on_durable, on_failed)
+        return final_path
+
+    def _index_durable(self, image_name: str, image_color: str, final_path: str, size: int,
+                       image_format: str, on_durable=None) -> None:
+        """Index a written image, only once it is durable, so the index never lists a lost file."""
+        try:
+            self.index.add(image_name, image_color, os.path.relpath(final_path, self.target_dir), size,
+                           image_format)
+        except ColorIndexError as e:
+            raise SorterError(e)
+        if on_durable is not None:
+            on_durable()
+
+    def _read_message(self, body, properties) -> tuple:
+        """Return (message fields, image bytes or None if it is in the blob store)."""
+        if not envelope.is_envelope(properties):
+            message = self._validate_body(body)
+            image_b64 = message.pop("image", None)
+            return message, base64.b64decode(image_b64.encode()) if image_b64 else None
+
+        try:
+            message, payload = envelope.decode(body, properties)
+        except EnvelopeError as e:
+            raise SorterError(e)
+        if not message.get("rgb"):
+            raise SorterError(f"'rgb' header missing in message: {message}")
+        if not payload and not message.get("blob"):
+            raise SorterError(f"Neither image data nor 'blob' header in message: {message}")
+        return message, payload or None
+
+    def prepare(self, body, properties=None) -> SortJob:
+        """Validate the message and probe the image, nothing is written yet."""
+        message, image_bytes = self._read_message(body, properties)
+        if image_bytes is not None:
+            image = self._load_image(io.BytesIO(image_bytes))
+            return SortJob(message["id"], message["rgb"], image, image_data=image_bytes)
+
+        if self.blob_store is None:
+            raise SorterError("Received a blob reference, but BLOB_STORE_DIR is not configured.")
+        blob = Blob.from_dict(message["blob"])
+        with self.blob_store.open(blob) as data:
+            image = self._load_image(data)  # reads just the header of the mapped blob
+        # copied in the kernel (or hardlinked), the data never passes through the sorter
+        source_path = self.blob_store.path(blob.key)
+        return SortJob(message["id"], message["rgb"], image, source_path=source_path, sha256=blob.sha256)
+
+    def write(self, job: SortJob, on_durable=None, on_failed=None) -> str:
+        return self.sort(
+            job.image_id, job.color, job.image, image_data=job.image_data,
+            source_path=job.source_path, on_durable=on_durable, sha256=job.sha256, on_failed=on_failed,
         )
 
+    def sort_callback(self, body, properties=None, on_durable=None):
+        return self.write(self.prepare(body, properties), on_durable=on_durable)
+
+    def _consume(self, connection, channel):
+        """
+        Return a message callback, the writer pool (None without WRITER_THREADS) and a function
+        syncing the pending files (and the index) when idle.
+        Messages are validated on the connection thread and written by the pool (or right away),
+        each of them is acknowledged - on the connection thread - once its image is durable.
+        """
+        pool = ThreadPoolExecutor(self.writer_threads) if self.writer_threads else None
+
+        def acknowledge(delivery_tag):
+            connection.add_callback_threadsafe(
+                functools.partial(channel.basic_ack, delivery_tag=delivery_tag)
+            )
+
+        def reject(delivery_tag, error: Exception = None):
+            # the message would fail again, drop it
+            connection.add_callback_threadsafe(
+                functools.partial(channel.basic_nack, delivery_tag=delivery_tag, requeue=False)
+            )
+
+        def write(job, delivery_tag):
+            try:
+                self.write(
+                    job,
+                    on_durable=functools.partial(acknowledge, delivery_tag),
+                    on_failed=functools.partial(reject, delivery_tag),  # failed to sync later
+                )
+            except Exception as e:
+                log.error(f"Writing image {job.image_id} failed.", exc_info=e)
+                reject(delivery_tag)
+
+        def callback(chan, method, properties, body):
+            try:
+                job = self.prepare(body, properties)
+            except Exception as e:
+                # log the exception and carry on
+                log.error("Message handling failed.", exc_info=e)
+                reject(method.delivery_tag)
+                return
+            if pool is None:
+                write(job, method.delivery_tag)
+            else:
+                pool.submit(write, job, method.delivery_tag)
+
+        def sync_pending():
+            try:
+                self.writer.sync()
+                if self.index is not None:
+                    self.index.commit()
+            except Exception as e:
+                log.error("Sync failed.", exc_info=e)
+
+        syncing = None
+
+        def sync():
+            # fsyncs would stall the connection thread (and its heartbeats), they run on the pool
+            nonlocal syncing
+            if pool is None:
+                sync_pending()
+            elif syncing is None or syncing.done():
+                syncing = pool.submit(sync_pending)
+
+        return callback, pool, sync
+
+    def collect_blobs(self) -> None:
+        """
+        Sweep the blob store in the background (the sorter is the last to read the blobs),
+        the images of a large store are not walked on the connection thread.
+        """
+        if self.blob_store is None or not self.blob_retention:
+            return
+        if self._blob_gc is not None and self._blob_gc.is_alive():
+            return
+
+        def collect():
+            try:
+                self.blob_store.gc(self.blob_retention)
+            except OSError as e:
+                log.error("Blob store sweep failed.", exc_info=e)
+
+        self._blob_gc = threading.Thread(target=collect, name="blob-gc", daemon=True)
+        self._blob_gc.start()
+
+    def _declare_queue(self, channel) -> str:
+        """
+        Declare and bind the queue to consume, depending on the scale mode:
+        * exclusive: every instance gets all the messages (a single instance setup)
+        * shared: instances compete for the messages of one durable queue
+        * partitioned: a consistent-hash exchange (RabbitMQ plugin) splits the messages by image id
+                       (routing key) or color (the 'rgb' header of the results) between
+                       the instances, each of them has its own durable queue and owns its part
+                       of the ids/colors as long as the set of partitions does not change
+        """
+        channel.exchange_declare(self.input_exchange, exchange_type="topic")
+        if self.scale_mode == EXCLUSIVE:
+            result = channel.queue_declare("", exclusive=True)
+            exchange, routing_key = self.input_exchange, self.topic
+        elif self.scale_mode == SHARED:
+            result = channel.queue_declare(self.sort_queue, durable=True)
+            exchange, routing_key = self.input_exchange, self.topic
+        else:
+            exchange = f"{self.input_exchange}.{self.sort_queue}.partitions"
+            channel.exchange_declare(
+                exchange,
+                exchange_type="x-consistent-hash",
+                durable=True,
+                arguments={"hash-header": "rgb"} if self.partition_by == "color" else None,
+            )
+            channel.exchange_bind(destination=exchange, source=self.input_exchange, routing_key=self.topic)
+            result = channel.queue_declare(f"{self.sort_queue}.{self.partition}", durable=True)
+            routing_key = str(self.partition_weight)  # the share of the hash space
+        channel.queue_bind(exchange=exchange, queue=result.method.queue, routing_key=routing_key)
+        return result.method.queue
+
     def start_listening(self):
         with self.connection() as connection:
             channel = connection.channel()
-            channel.exchange_declare(self.input_exchange, exchange_type="topic")
-            result = channel.queue_declare("", exclusive=True)
-            self.queue_name = result.method.queue
-            channel.queue_bind(
-                exchange=self.input_exchange,
-                queue=self.queue_name,
-                routing_key=self.topic
-            )
+            self.queue_name = self._declare_queue(channel)
+
+            # the messages being written and those waiting for the batch sync are unacknowledged
+            prefetch_count = self.writer_queue + (self.fsync_batch if self.fsync == writer.BATCH else 0)
+            channel.basic_qos(prefetch_count=prefetch_count)
+            callback, pool, sync = self._consume(connection, channel)
+
+            def sync_when_idle():
+                # batched files become visible once synced (and indexed images once committed),
+                # don't keep them waiting when idle
+                sync()
+                connection.call_later(self.fsync_interval, sync_when_idle)
+
+            if self.fsync == writer.BATCH or self.index is not None:
+                connection.call_later(self.fsync_interval, sync_when_idle)
+
+            def collect_blobs():
+                self.collect_blobs()
+                connection.call_later(BLOB_GC_INTERVAL, collect_blobs)
 
-            def callback(chan, method, properties, body):
-                try:
-                    self.sort_callback(body)
-                except Exception as e:
-                    # log the exception and carry on
-                    log.error("Message handling failed.", exc_info=e)
+            collect_blobs()
 
             channel.basic_consume(
                 queue=self.queue_name,
                 on_message_callback=callback,
-                auto_ack=True
+                auto_ack=False
             )
+            if self.fsync == writer.NONE:
+                log.warning("FSYNC=none: images are acknowledged once written, before they are durable.")
             log.info("Waiting for images to be sorted... To exit press CTRL+C")
             log.debug(
                 f"Consuming: exchange={self.input_exchange}, "
-                f"topic={self.topic}, queue={self.queue_name}"
+                f"topic={self.topic}, queue={self.queue_name}, mode={self.scale_mode}, "
+                f"prefetch={prefetch_count}"
             )
-            channel.start_consuming()
+            try:
+                channel.start_consuming()
+            finally:
+                if pool is not None:
+                    pool.shutdown(wait=True)
+                self.writer.close()
+                if self.index is not None:
+                    self.index.commit()
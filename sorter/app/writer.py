@@ -0,0 +1,179 @@
+import errno
+import os
+import shutil
+import threading
+import uuid
+
+from app import get_logger
+
+log = get_logger(__name__)
+
+
+NONE = "none"
+ALWAYS = "always"
+BATCH = "batch"
+FSYNC_MODES = (NONE, ALWAYS, BATCH)
+
+COPY_CHUNK = 64 * 1024 * 1024
+
+
+class WriterError(Exception):
+    pass
+
+
+def fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy(source, target) -> None:
+    """Copy file to file in the kernel (copy_file_range), falls back to a user space copy."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(source.fileno(), target.fileno(), COPY_CHUNK):
+                pass
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            source.seek(0)
+            target.seek(0)
+            target.truncate()
+    shutil.copyfileobj(source, target, COPY_CHUNK)
+
+
+class FileWriter:
+    """
+    Writes files atomically: the data goes to a temporary file next to the target, which is
+    then renamed, so a file under its final name is always complete.
+
+    fsync modes:
+    * none: nothing is synced, the OS writes the data back when it sees fit
+    * always: each file (and its directory) is synced before the write returns
+    * batch: files are synced `batch_size` at a time (or on sync()) and renamed only afterwards,
+             so a file appears under its final name only once its data is durable
+
+    `on_durable` callbacks are called once the file is written as durably as configured,
+    in the batch mode by the thread which syncs the batch. A file of a batch failing to sync
+    is removed and its `on_failed` called with the error instead, the rest of the batch is not affected.
+    Files can be written from several threads.
+    """
+
+    def __init__(self, fsync: str = NONE, batch_size: int = 32, link: bool = False) -> None:
+        if fsync not in FSYNC_MODES:
+            raise WriterError(f"Unknown fsync mode: {fsync}")
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.link = link  # hardlink source files instead of copying them
+        # (temporary path, final path, open file, on_durable, on_failed) waiting for the batch sync
+        self.pending = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _tmp_path(final_path: str) -> str:
+        return os.path.join(os.path.dirname(final_path), f".tmp-{uuid.uuid4().hex}")
+
+    def _link(self, source_path: str, tmp_path: str) -> bool:
+        """Hardlink the source, False if that is not possible (e.g. another filesystem)."""
+        try:
+            os.link(source_path, tmp_path)
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            log.warning(f"Can't link {source_path} ({e.strerror}), copying it instead")
+            self.link = False
+            return False
+
+    def write(self, final_path: str, data=None, source_path: str = None, on_durable=None,
+              on_failed=None) -> None:
+        """Write the bytes (or a bytes-like object, e.g. mmap) or copy/link the source file."""
+        if (data is None) == (source_path is None):
+            raise WriterError("Either data or a source path has to be written.")
+        tmp_path = self._tmp_path(final_path)
+
+        if source_path is not None and self.link and self._link(source_path, tmp_path):
+            file = open(tmp_path, "rb") if self.fsync != NONE else None
+        else:
+            file = open(tmp_path, "wb")
+            try:
+                if data is not None:
+                    file.write(data)
+                else:
+                    with open(source_path, "rb") as source:
+                        _copy(source, file)
+                file.flush()
+            except BaseException:
+                file.close()
+                os.unlink(tmp_path)
+                raise
+
+        if self.fsync == BATCH:
+            with self._lock:
+                self.pending.append((tmp_path, final_path, file, on_durable, on_failed))
+                full = len(self.pending) >= self.batch_size
+            if full:
+                self.sync()
+            return
+        if file is not None:
+            with file:
+                if self.fsync == ALWAYS:
+                    os.fsync(file.fileno())
+        os.replace(tmp_path, final_path)
+        if self.fsync == ALWAYS:
+            fsync_dir(os.path.dirname(final_path))
+        if on_durable is not None:
+            on_durable()
+
+    @staticmethod
+    def _failed(tmp_path: str, final_path: str, on_failed, error: Exception) -> None:
+        log.error(f"Syncing {final_path} failed.", exc_info=error)
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass  # renamed already
+        if on_failed is not None:
+            on_failed(error)
+
+    def sync(self) -> list:
+        """Make the pending files durable and move them to their final paths, return the synced paths."""
+        with self._lock:
+            pending, self.pending = self.pending, []
+        renamed = []
+        for tmp_path, final_path, file, on_durable, on_failed in pending:
+            try:
+                with file:
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, final_path)
+            except Exception as e:
+                self._failed(tmp_path, final_path, on_failed, e)
+                continue
+            renamed.append((tmp_path, final_path, on_durable, on_failed))
+
+        directory_errors = {}
+        for directory in {os.path.dirname(final_path) for _, final_path, _, _ in renamed}:
+            try:
+                fsync_dir(directory)
+            except OSError as e:
+                directory_errors[directory] = e
+        synced = []
+        for tmp_path, final_path, on_durable, on_failed in renamed:
+            try:
+                error = directory_errors.get(os.path.dirname(final_path))
+                if error is not None:
+                    raise error
+                if on_durable is not None:
+                    on_durable()
+            except Exception as e:
+                self._failed(tmp_path, final_path, on_failed, e)
+                continue
+            synced.append(final_path)
+        if pending:
+            log.debug(f"Synced {len(synced)} of {len(pending)} files")
+        return synced
+
+    def close(self) -> None:
+        self.sync()
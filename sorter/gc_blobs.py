@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+"""
+Removes the images of the blob store (claim-check) neither stored nor reused for a while,
+the sorter does the same hourly (BLOB_RETENTION_HOURS).
+
+Usage: gc_blobs.py [--max-age SECONDS] [--dry-run] [BLOB_STORE_DIR]
+
+Uses these environment variables:
+* BLOB_STORE_DIR: the blob store, when it is not given
+* BLOB_RETENTION_HOURS: the default max age (defaults to 24)
+"""
+import argparse
+import os
+import sys
+
+from app import get_logger
+from app.blobstore import BlobStore
+
+log = get_logger("GC")
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description="Remove expired blobs of the blob store.")
+    parser.add_argument("source", nargs="?", default=os.environ.get("BLOB_STORE_DIR"),
+                        help="blob store directory (defaults to BLOB_STORE_DIR)")
+    parser.add_argument("--max-age", type=float,
+                        default=float(os.environ.get("BLOB_RETENTION_HOURS") or 24) * 3600,
+                        help="remove blobs not stored or reused for this many seconds (defaults to 24h)")
+    parser.add_argument("--dry-run", action="store_true", help="only log what would be removed")
+    args = parser.parse_args(args)
+
+    if not args.source or not os.path.isdir(args.source):
+        parser.error(f"Not a blob store: {args.source}")
+
+    BlobStore(args.source).gc(args.max_age, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+"""
+Removes the stored objects (STORAGE=dedup) no sorted image links to anymore,
+e.g. after sorted images were deleted.
+
+Usage: gc_objects.py [--min-age SECONDS] [--dry-run] [SOURCE_DIR]
+
+Uses these environment variables:
+* TARGET_DIR: the output tree, when SOURCE_DIR is not given
+"""
+import argparse
+import os
+import sys
+
+from app import get_logger
+from app.objects import OBJECTS_DIR, ObjectStore
+from app.writer import FileWriter
+
+log = get_logger("GC")
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description="Remove unreferenced objects of a deduplicated output tree.")
+    parser.add_argument("source", nargs="?", default=os.environ.get("TARGET_DIR"),
+                        help="output tree (defaults to TARGET_DIR)")
+    parser.add_argument("--min-age", type=float, default=3600,
+                        help="keep files modified less than this many seconds ago (defaults to 3600)")
+    parser.add_argument("--dry-run", action="store_true", help="only log what would be removed")
+    args = parser.parse_args(args)
+
+    if not args.source or not os.path.isdir(os.path.join(args.source, OBJECTS_DIR)):
+        parser.error(f"Not a deduplicated output tree: {args.source}")
+
+    objects = ObjectStore(os.path.join(args.source, OBJECTS_DIR), FileWriter())
+    objects.gc(min_age=args.min_age, dry_run=args.dry_run)
+    stats = objects.stats()
+    log.info(
+        f"{stats['objects']} objects ({stats['stored_bytes']}B) referenced by {stats['references']} "
+        f"images ({stats['referenced_bytes']}B)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,47 @@
 """
 Sorting component of the sorting system
 * Waits for an image with a computed average RGB
-* Sorts (puts it in a named folder) image file based on the average RGB
+* Sorts (puts it in a named folder) image file based on the average RGB,
+  the received image bytes are written as they are, without re-encoding
+
+Modify behavior using these environment variables:
+* LOG_LEVEL
+* LOG_FILE
+* TARGET_DIR: where to put the sorted images
+* BROKER_HOST
+* BROKER_PORT (defaults to 5672)
+* INPUT_EXCHANGE: where to listen for the computed images
+* BLOB_STORE_DIR: shared directory with images referenced by the messages (claim-check)
+* BLOB_RETENTION_HOURS: blobs neither stored nor reused for this long are removed from the blob store,
+                        it is swept hourly (defaults to 24, 0 keeps them), gc_blobs.py sweeps it on demand
+* COLOR_LAYOUT: 'flat' (default, a directory per color, '#c0c0c0') or 'sharded' (a directory level
+                per channel, 'c0/c0/c0'), migrate.py re-files an existing flat output tree
+* COLOR_BITS: colors are quantized to this many bits per channel (defaults to 8, the exact color)
+* DIRECTORY_CACHE_SIZE: number of directories remembered as existing (defaults to 65536)
+* COLOR_INDEX: SQLite file indexing the sorted images by color (nearest color queries, used by
+               the web app), reindex.py rebuilds it from an existing output tree (by default there is none)
+* BLOB_COPY: 'copy' (default, copied in the kernel) or 'link' (hardlink, the same filesystem
+             as the blob store, falls back to copying) images from the blob store
+* STORAGE: 'files' (default, each image written on its own) or 'dedup': each unique image is stored
+           once (under TARGET_DIR/.objects) and hardlinked into its color directory, gc_objects.py removes
+           the images no longer linked (can't be used with BLOB_COPY=link)
+* WRITER_THREADS: number of threads writing the images (defaults to 0, written on the connection thread),
+                  each message is acknowledged once its image is durable (see FSYNC)
+* WRITER_QUEUE: number of messages being written at a time (defaults to 4 per writer thread),
+                the prefetch count is this plus FSYNC_BATCH in the 'batch' mode
+* FSYNC: 'batch' (default): images are synced FSYNC_BATCH at a time and appear under their final name
+         only once they are durable, 'always' (each image) or 'none': nothing is synced, the images
+         are acknowledged once written but are not durable
+* FSYNC_BATCH: number of images synced together (defaults to 32)
+* FSYNC_INTERVAL_MS: pending images are synced at least this often (defaults to 1000)
+* SCALE_MODE: 'exclusive' (default, a single instance gets all the images), 'shared' (instances compete
+  for the images of the SORT_QUEUE) or 'partitioned' (images are split between the instances by a consistent
+  hash, needs the rabbitmq_consistent_hash_exchange plugin)
+* SORT_QUEUE: name of the shared queue, the prefix of the partition queues (defaults to 'sorter')
+* SORTER_PARTITION: name of the instance's partition, required in the 'partitioned' mode (a stable name,
+  the partition's durable queue keeps its share of the images while the instance is away)
+* PARTITION_WEIGHT: share of the images of the partition, relative to the others (defaults to 1)
+* PARTITION_BY: 'id' (default) or 'color' (images of a color are sorted by the same instance)
 """
 import time
 
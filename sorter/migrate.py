@@ -0,0 +1,46 @@
+#! /usr/bin/env python3
+"""
+Re-files an output tree with one directory per exact color (the original layout, '#c0c0c0/<image>')
+into the layout configured for the sorter.
+
+Usage: migrate.py [--target DIR] [--dry-run] [SOURCE_DIR]
+
+Uses these environment variables:
+* TARGET_DIR: the output tree, when SOURCE_DIR is not given
+* COLOR_LAYOUT: 'flat' or 'sharded' (see main.py)
+* COLOR_BITS: bits per channel (see main.py)
+"""
+import argparse
+import os
+import sys
+
+from app import get_logger
+from app.layout import Layout, LayoutError, migrate
+
+log = get_logger("MIGRATE")
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description="Re-file a flat output tree into the configured layout.")
+    parser.add_argument("source", nargs="?", default=os.environ.get("TARGET_DIR"),
+                        help="output tree to re-file (defaults to TARGET_DIR)")
+    parser.add_argument("--target", help="where to move the files (defaults to the source, in place)")
+    parser.add_argument("--layout", default=os.environ.get("COLOR_LAYOUT") or "flat")
+    parser.add_argument("--bits", type=int, default=int(os.environ.get("COLOR_BITS") or 8))
+    parser.add_argument("--dry-run", action="store_true", help="only log what would be moved")
+    args = parser.parse_args(args)
+
+    if not args.source or not os.path.isdir(args.source):
+        parser.error(f"Not a directory: {args.source}")
+    try:
+        layout = Layout(kind=args.layout.lower(), bits=args.bits)
+    except LayoutError as e:
+        parser.error(str(e))
+
+    log.info(f"Re-filing {args.source} into the {layout.kind} layout, {layout.bits} bits per channel")
+    migrate(args.source, layout, target_root=args.target, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#! /usr/bin/env python3
+"""
+Rebuilds the color index (COLOR_INDEX) from the images in an existing output tree.
+
+Usage: reindex.py [--index FILE] [SOURCE_DIR]
+
+Uses these environment variables:
+* TARGET_DIR: the output tree, when SOURCE_DIR is not given
+* COLOR_INDEX: the index file, when --index is not given
+* COLOR_LAYOUT, COLOR_BITS: layout of the output tree (see main.py)
+"""
+import argparse
+import os
+import sys
+import time
+
+from app import get_logger
+from app.colorindex import ColorIndex
+from app.layout import Layout, LayoutError, sorted_images
+
+log = get_logger("REINDEX")
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild the color index of an output tree.")
+    parser.add_argument("source", nargs="?", default=os.environ.get("TARGET_DIR"),
+                        help="output tree to index (defaults to TARGET_DIR)")
+    parser.add_argument("--index", default=os.environ.get("COLOR_INDEX"),
+                        help="index file (defaults to COLOR_INDEX)")
+    parser.add_argument("--layout", default=os.environ.get("COLOR_LAYOUT") or "flat")
+    parser.add_argument("--bits", type=int, default=int(os.environ.get("COLOR_BITS") or 8))
+    args = parser.parse_args(args)
+
+    if not args.source or not os.path.isdir(args.source):
+        parser.error(f"Not a directory: {args.source}")
+    if not args.index:
+        parser.error("No index file, set COLOR_INDEX or use --index")
+    try:
+        layout = Layout(kind=args.layout.lower(), bits=args.bits)
+    except LayoutError as e:
+        parser.error(str(e))
+
+    started = time.perf_counter()
+    index = ColorIndex(args.index)
+    try:
+        count = index.rebuild(sorted_images(args.source, layout))
+    finally:
+        index.close()
+    log.info(f"Indexed {count} images from {args.source} in {time.perf_counter() - started:.1f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
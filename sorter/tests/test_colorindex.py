@@ -0,0 +1,106 @@
+import math
+import os
+import random
+
+import mock
+import pytest
+
+from app.colorindex import ColorIndex, ColorIndexError, hex_to_rgb, rgb_to_lab
+from app.layout import Layout
+from reindex import main as reindex_main
+
+
+@pytest.fixture(params=[True, False], ids=["rtree", "plain"])
+def index(request, tmp_path):
+    index = ColorIndex(str(tmp_path / "index" / "colors.sqlite"))
+    if not request.param:
+        index.rtree = False
+        index._db.execute("CREATE INDEX images_lab ON images (l, a, b)")
+    yield index
+    index.close()
+
+
+def random_color(rng) -> str:
+    return "#" + "".join(f"{rng.randrange(256):02x}" for _ in range(3))
+
+
+def test_rgb_to_lab():
+    assert rgb_to_lab((255, 255, 255)) == pytest.approx((100, 0, 0), abs=0.1)
+    assert rgb_to_lab((0, 0, 0)) == pytest.approx((0, 0, 0), abs=0.1)
+    assert rgb_to_lab((255, 0, 0)) == pytest.approx((53.24, 80.09, 67.20), abs=0.1)
+
+
+def test_nearest(index):
+    rng = random.Random(1)
+    colors = {f"image-{i}": random_color(rng) for i in range(500)}
+    for image_id, color in colors.items():
+        index.add(image_id, color, f"{color}/{image_id}.JPEG", 100, "JPEG")
+    assert len(index) == 500
+
+    for query in ("#c0c0c0", "#ff0000", "#000000", "#123456"):
+        lab = rgb_to_lab(hex_to_rgb(query))
+        distances = {
+            image_id: round(math.dist(lab, rgb_to_lab(hex_to_rgb(color))), 3)
+            for image_id, color in colors.items()
+        }
+        expected = sorted(colors, key=lambda image_id: (distances[image_id], image_id))[:5]
+        assert [image["id"] for image in index.nearest(query, limit=5)] == expected
+
+
+def test_nearest_max_distance(index):
+    index.add("gray", "#808080", "#808080/gray.PNG", 10, "PNG")
+    index.add("red", "#ff0000", "#ff0000/red.PNG", 10, "PNG")
+    assert [image["id"] for image in index.nearest("#818181", max_distance=10)] == ["gray"]
+    assert [image["id"] for image in index.nearest("#818181")] == ["gray", "red"]
+    assert index.nearest("#818181")[0] == {
+        "id": "gray", "rgb": "#808080", "path": "#808080/gray.PNG", "size": 10, "format": "PNG",
+        "sorted_at": mock.ANY, "distance": mock.ANY,
+    }
+
+
+def test_add_replaces(index):
+    index.add("image", "#000000", "#000000/image.PNG", 10, "PNG")
+    index.add("image", "#ffffff", "#ffffff/image.PNG", 10, "PNG")
+    assert len(index) == 1
+    assert [image["rgb"] for image in index.nearest("#000000")] == ["#ffffff"]
+
+
+def test_invalid_color(index):
+    with pytest.raises(ColorIndexError):
+        index.add("image", "black", "black/image.PNG", 10, "PNG")
+
+
+def test_readonly(tmp_path):
+    path = str(tmp_path / "colors.sqlite")
+    with pytest.raises(ColorIndexError):
+        ColorIndex(path, readonly=True)
+
+    writer = ColorIndex(path, commit_every=2)
+    reader = ColorIndex(path, readonly=True)
+    writer.add("image-1", "#000000", "#000000/image-1.PNG", 10, "PNG")
+    assert len(reader) == 0  # not committed yet
+    writer.add("image-2", "#000000", "#000000/image-2.PNG", 10, "PNG")
+    assert len(reader) == 2
+    assert reader.nearest("#000000", limit=1)[0]["id"] == "image-1"
+
+
+@pytest.mark.parametrize("kind", ["flat", "sharded"])
+def test_reindex(tmp_path, kind):
+    output = tmp_path / "output"
+    layout = Layout(kind)
+    for image_id, color in [("a", "#c0c0c0"), ("b", "#101010"), ("c", "#c1c1c1")]:
+        directory = output / layout.directory(color)
+        os.makedirs(directory, exist_ok=True)
+        (directory / f"{image_id}.JPEG").write_bytes(b"image")
+    (output / ".index").mkdir()
+    (output / "notes.txt").write_text("not an image")
+
+    index_path = str(tmp_path / "colors.sqlite")
+    assert reindex_main([str(output), "--index", index_path, "--layout", kind]) == 0
+    index = ColorIndex(index_path, readonly=True)
+    assert len(index) == 3
+    nearest = index.nearest("#c0c0c0", limit=2)
+    assert [(image["id"], image["format"], image["size"]) for image in nearest] == [
+        ("a", "JPEG", 5), ("c", "JPEG", 5)
+    ]
+    assert nearest[0]["path"] == os.path.join(layout.directory("#c0c0c0"), "a.JPEG")
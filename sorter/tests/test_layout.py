@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from app.layout import DirectoryCache, Layout, LayoutError, migrate
+from migrate import main as migrate_main
+
+
+@pytest.mark.parametrize("kind,bits,color,expected", [
+    ("flat", 8, "#c1c2c3", "#c1c2c3"),
+    ("flat", 4, "#c1c2c3", "#c0c0c0"),
+    ("flat", 5, "#FFFFFF", "#f8f8f8"),
+    ("sharded", 8, "#c1c2c3", os.path.join("c1", "c2", "c3")),
+    ("sharded", 6, "#c1c2c3", os.path.join("c0", "c0", "c0")),
+])
+def test_directory(kind, bits, color, expected):
+    assert Layout(kind, bits).directory(color) == expected
+
+
+@pytest.mark.parametrize("kind,bits,color", [
+    ("nested", 8, "#ffffff"),
+    ("flat", 0, "#ffffff"),
+    ("flat", 9, "#ffffff"),
+    ("flat", 8, "white"),
+])
+def test_invalid_layout(kind, bits, color):
+    with pytest.raises(LayoutError):
+        Layout(kind, bits).directory(color)
+
+
+def test_directory_cache(tmp_path):
+    cache = DirectoryCache(max_entries=2)
+    paths = [str(tmp_path / name) for name in "abc"]
+    for path in paths:
+        cache.ensure(path)
+        assert os.path.isdir(path)
+    assert paths[0] not in cache and len(cache) == 2
+
+    os.rmdir(paths[2])
+    cache.ensure(paths[2])  # still cached, not created again
+    assert not os.path.isdir(paths[2])
+    cache.discard(paths[2])
+    cache.ensure(paths[2])
+    assert os.path.isdir(paths[2])
+
+
+@pytest.fixture
+def flat_tree(tmp_path):
+    for color, name in [("#c1c2c3", "a.JPEG"), ("#c0c0c0", "b.JPEG"), ("#0f0f0f", "c.PNG")]:
+        os.makedirs(tmp_path / color, exist_ok=True)
+        (tmp_path / color / name).write_bytes(name.encode())
+    (tmp_path / "notes.txt").write_text("not an image directory")
+    return tmp_path
+
+
+def tree(root) -> set:
+    return {
+        os.path.relpath(os.path.join(path, name), root)
+        for path, _, names in os.walk(root) for name in names
+    }
+
+
+def test_migrate_sharded(flat_tree):
+    assert migrate(str(flat_tree), Layout("sharded", 8)) == 3
+    assert tree(flat_tree) == {
+        "notes.txt", "c1/c2/c3/a.JPEG", "c0/c0/c0/b.JPEG", "0f/0f/0f/c.PNG",
+    }
+    assert not os.path.exists(flat_tree / "#c0c0c0")
+
+
+def test_migrate_quantized_in_place(flat_tree):
+    assert migrate(str(flat_tree), Layout("flat", 4)) == 2
+    assert tree(flat_tree) == {"notes.txt", "#c0c0c0/a.JPEG", "#c0c0c0/b.JPEG", "#000000/c.PNG"}
+
+
+def test_migrate_dry_run(flat_tree, tmp_path):
+    before = tree(flat_tree)
+    assert migrate_main([str(flat_tree), "--layout", "sharded", "--dry-run"]) == 0
+    assert tree(flat_tree) == before
+
+
+def test_migrate_to_target(flat_tree, tmp_path_factory):
+    target = tmp_path_factory.mktemp("sharded")
+    migrate_main([str(flat_tree), "--target", str(target), "--layout", "sharded", "--bits", "2"])
+    assert tree(target) == {"c0/c0/c0/a.JPEG", "c0/c0/c0/b.JPEG", "00/00/00/c.PNG"}
+    assert tree(flat_tree) == {"notes.txt"}
@@ -0,0 +1,98 @@
+import base64
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+from app import writer
+from app.objects import OBJECTS_DIR, ObjectStore, ObjectStoreError
+from app.sorter import Sorter, SorterError
+from app.writer import FileWriter
+from gc_objects import main as gc_main
+
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_data")
+
+
+@pytest.fixture
+def store(tmp_path):
+    os.makedirs(tmp_path / "#c0c0c0")
+    return ObjectStore(str(tmp_path / OBJECTS_DIR), FileWriter())
+
+
+def test_stored_once(store, tmp_path):
+    sha256 = hashlib.sha256(b"image").hexdigest()
+    for name in ("a.JPEG", "b.JPEG"):
+        assert store.write(str(tmp_path / "#c0c0c0" / name), data=b"image") == store.path(sha256)
+    assert (tmp_path / "#c0c0c0" / "a.JPEG").read_bytes() == b"image"
+    assert os.path.samefile(tmp_path / "#c0c0c0" / "a.JPEG", tmp_path / "#c0c0c0" / "b.JPEG")
+    assert store.references(sha256) == 2 and store.skipped == 1
+
+    os.unlink(tmp_path / "#c0c0c0" / "a.JPEG")
+    assert store.references(sha256) == 1
+    assert store.stats() == {"objects": 1, "references": 1, "stored_bytes": 5, "referenced_bytes": 5}
+
+
+def test_linked_when_durable(tmp_path):
+    os.makedirs(tmp_path / "#c0c0c0")
+    store = ObjectStore(str(tmp_path / OBJECTS_DIR), FileWriter(fsync=writer.BATCH, batch_size=10))
+    durable = []
+    final_path = str(tmp_path / "#c0c0c0" / "a.JPEG")
+    store.write(final_path, data=b"image", on_durable=lambda: durable.append(final_path))
+    assert not os.path.exists(final_path) and not durable
+    store.writer.sync()
+    assert os.path.isfile(final_path) and durable == [final_path]
+
+
+def test_source_needs_hash(store, tmp_path):
+    with pytest.raises(ObjectStoreError):
+        store.write(str(tmp_path / "#c0c0c0" / "a.JPEG"), source_path=__file__)
+
+
+def test_gc(store, tmp_path):
+    store.write(str(tmp_path / "#c0c0c0" / "a.JPEG"), data=b"kept")
+    store.write(str(tmp_path / "#c0c0c0" / "b.JPEG"), data=b"removed")
+    os.unlink(tmp_path / "#c0c0c0" / "b.JPEG")
+    abandoned = tmp_path / OBJECTS_DIR / ".tmp-abandoned"
+    abandoned.write_bytes(b"partial")
+
+    assert store.gc(min_age=60) == (0, 0)  # all too young
+    old = time.time() - 120
+    for path in (abandoned, store.path(hashlib.sha256(b"removed").hexdigest())):
+        os.utime(path, (old, old))
+    assert gc_main([str(tmp_path), "--min-age", "60", "--dry-run"]) == 0
+    assert store.stats()["objects"] == 2
+    assert store.gc(min_age=60) == (2, len(b"partial") + len(b"removed"))
+    assert store.stats()["objects"] == 1
+    assert (tmp_path / "#c0c0c0" / "a.JPEG").read_bytes() == b"kept"
+
+
+def test_sorter_deduplicates(tmp_path, monkeypatch):
+    with open(f"{TEST_DIR}/#c0c0c0.jpg", "rb") as img:
+        image_bytes = img.read()
+    target_dir = str(tmp_path / "sorted")
+    monkeypatch.setenv("TARGET_DIR", target_dir)
+    monkeypatch.setenv("STORAGE", "dedup")
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path / "blobs"))
+    monkeypatch.setenv("FSYNC", "none")  # linked right away
+    sorter = Sorter()
+    image_b64 = base64.b64encode(image_bytes).decode()
+    sorter.sort_callback(json.dumps({"id": "inline", "rgb": "#c0c0c0", "image": image_b64}))
+    blob = sorter.blob_store.put(image_bytes)
+    sorter.sort_callback(json.dumps({"id": "blob", "rgb": "#c0c0c0", "blob": blob.to_dict()}))
+
+    sorted_dir = os.path.join(target_dir, "#c0c0c0")
+    assert os.path.samefile(os.path.join(sorted_dir, "inline.JPEG"), os.path.join(sorted_dir, "blob.JPEG"))
+    assert sorter.objects.references(blob.sha256) == 2 and sorter.objects.skipped == 1
+    assert not os.path.samefile(sorter.blob_store.path(blob.key), os.path.join(sorted_dir, "blob.JPEG"))
+
+
+@pytest.mark.parametrize("variables", [{"STORAGE": "tape"}, {"STORAGE": "dedup", "BLOB_COPY": "link"}])
+def test_invalid_storage(monkeypatch, tmp_path, variables):
+    monkeypatch.setenv("TARGET_DIR", str(tmp_path))
+    for name, value in variables.items():
+        monkeypatch.setenv(name, value)
+    with pytest.raises(SorterError):
+        Sorter()
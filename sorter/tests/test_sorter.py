@@ -1,24 +1,36 @@
 import base64
+import io
 import json
 import os
 import random
+import shutil
+import threading
 
 import mock
 import pytest
+from PIL import Image
 
+from app import envelope
 from app.sorter import Sorter, SorterError
+from gc_blobs import main as gc_blobs_main
 
 
 TEST_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_data")
 
 
 @pytest.fixture(autouse=True)
-def target_dir(monkeypatch):
-    random_dir = f"/tmp/random-dir-{random.randint(1, 1000)}"
+def target_dir(monkeypatch, tmp_path):
+    random_dir = str(tmp_path / f"random-dir-{random.randint(1, 1000)}")
     monkeypatch.setenv("TARGET_DIR", random_dir)
     return random_dir
 
 
+@pytest.fixture(autouse=True)
+def written_right_away(monkeypatch):
+    """The sorted images are checked right away, the tests of the durable writes set FSYNC."""
+    monkeypatch.setenv("FSYNC", "none")
+
+
 @pytest.fixture
 def image():
     """Read test images as bytes."""
@@ -49,6 +61,7 @@ def test_setup_target_dir():
 
 @pytest.mark.parametrize("body", [
     {"id": "uuid-123", "image": "base64image", "rgb": "#ffffff"},
+    {"id": "uuid-123", "blob": {"key": "a" * 64, "size": 1, "sha256": "a" * 64}, "rgb": "#ffffff"},
 ])
 def test_validate_body(body):
     assert Sorter._validate_body(json.dumps(body)) == body
@@ -71,6 +84,14 @@ def test_validate_image(image_asb64):
     assert Sorter._validate_image(image_data_b64_string=image_asb64)
 
 
+def test_load_image_reads_header_only():
+    data = io.BytesIO()
+    Image.new("RGB", (64, 64), "#c0c0c0").save(data, format="PNG")
+    image = Sorter._load_image(io.BytesIO(data.getvalue()))
+    assert image.format == "PNG" and image.size == (64, 64)
+    assert image.tile  # not decoded, decoding consumes the tiles
+
+
 def test_validate_image_negative(invalid_image):
     image_b64 = base64.b64encode(invalid_image).decode()
     with pytest.raises(SorterError):
@@ -91,3 +112,339 @@ def test_sort(mock_conn, image_asb64, target_dir):
     })
     sorter.sort_callback(body)
     assert os.path.isfile(os.path.join(target_dir, computed_avg_rgb, expected_image_file_name))
+
+
+@mock.patch.object(Sorter, "connection")
+def test_sort_blob(mock_conn, image, target_dir, tmp_path, monkeypatch):
+    image_bytes, _ = image
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path))
+    image_id = f"image-{random.randint(1000, 9999)}"
+
+    sorter = Sorter()
+    blob = sorter.blob_store.put(image_bytes)
+    sorter.sort_callback(json.dumps({"id": image_id, "rgb": "#c0c0c0", "blob": blob.to_dict()}))
+    assert os.path.isfile(os.path.join(target_dir, "#c0c0c0", f"{image_id}.JPEG"))
+
+
+@mock.patch.object(Sorter, "connection")
+def test_sort_binary(mock_conn, image, target_dir):
+    image_bytes, _ = image
+    image_id = f"image-{random.randint(1000, 9999)}"
+    body, properties = envelope.encode(image_bytes, id=image_id, rgb="#c0c0c0", format="JPEG")
+
+    Sorter().sort_callback(body, properties)
+    assert os.path.isfile(os.path.join(target_dir, "#c0c0c0", f"{image_id}.JPEG"))
+
+
+@pytest.mark.parametrize("headers", [
+    {"id": "uuid-123"},
+    {"rgb": "#ffffff"},
+])
+def test_sort_binary_negative(headers, image):
+    image_bytes, _ = image
+    body, properties = envelope.encode(image_bytes, **headers)
+    with pytest.raises(SorterError):
+        Sorter().sort_callback(body, properties)
+
+
+@mock.patch.object(Sorter, "connection")
+def test_sort_keeps_original_bytes(mock_conn, image, target_dir):
+    """Test that the image is not re-encoded, the received bytes are written as they are."""
+    image_bytes, _ = image
+    image_id = f"image-{random.randint(1000, 9999)}"
+    body, properties = envelope.encode(image_bytes, id=image_id, rgb="#c0c0c0")
+
+    with mock.patch("PIL.Image.Image.save") as save, mock.patch("PIL.Image.Image.load") as load:
+        Sorter().sort_callback(body, properties)
+    save.assert_not_called()
+    load.assert_not_called()
+    with open(os.path.join(target_dir, "#c0c0c0", f"{image_id}.JPEG"), "rb") as f:
+        assert f.read() == image_bytes
+
+
+@pytest.mark.parametrize("blob_copy", ["copy", "link"])
+@mock.patch.object(Sorter, "connection")
+def test_sort_blob_copy(mock_conn, image, target_dir, tmp_path, monkeypatch, blob_copy):
+    image_bytes, _ = image
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path))
+    monkeypatch.setenv("BLOB_COPY", blob_copy)
+    image_id = f"image-{random.randint(1000, 9999)}"
+
+    sorter = Sorter()
+    blob = sorter.blob_store.put(image_bytes)
+    sorter.sort_callback(json.dumps({"id": image_id, "rgb": "#c0c0c0", "blob": blob.to_dict()}))
+    sorted_path = os.path.join(target_dir, "#c0c0c0", f"{image_id}.JPEG")
+    with open(sorted_path, "rb") as f:
+        assert f.read() == image_bytes
+    linked = os.stat(sorted_path).st_ino == os.stat(sorter.blob_store.path(blob.key)).st_ino
+    assert linked is (blob_copy == "link" and os.stat(target_dir).st_dev == os.stat(tmp_path).st_dev)
+
+
+@mock.patch.object(Sorter, "connection")
+def test_sort_sharded(mock_conn, image, target_dir, monkeypatch):
+    image_bytes, _ = image
+    monkeypatch.setenv("COLOR_LAYOUT", "sharded")
+    monkeypatch.setenv("COLOR_BITS", "4")
+    image_id = f"image-{random.randint(1000, 9999)}"
+    body, properties = envelope.encode(image_bytes, id=image_id, rgb="#c1c2c3")
+
+    sorter = Sorter()
+    sorter.sort_callback(body, properties)
+    assert os.path.isfile(os.path.join(target_dir, "c0", "c0", "c0", f"{image_id}.JPEG"))
+    assert os.path.join(target_dir, "c0", "c0", "c0") in sorter.directories
+
+
+@mock.patch.object(Sorter, "connection")
+def test_sort_directory_removed(mock_conn, image, target_dir):
+    """Test that a cached directory removed behind the sorter's back is created again."""
+    image_bytes, _ = image
+    sorter = Sorter()
+    body, properties = envelope.encode(image_bytes, id="image-1", rgb="#c0c0c0")
+    sorter.sort_callback(body, properties)
+    shutil.rmtree(os.path.join(target_dir, "#c0c0c0"))
+
+    body, properties = envelope.encode(image_bytes, id="image-2", rgb="#c0c0c0")
+    sorter.sort_callback(body, properties)
+    assert os.listdir(os.path.join(target_dir, "#c0c0c0")) == ["image-2.JPEG"]
+
+
+@mock.patch.object(Sorter, "connection")
+def test_sort_indexed(mock_conn, image, target_dir, tmp_path, monkeypatch):
+    image_bytes, _ = image
+    monkeypatch.setenv("COLOR_INDEX", str(tmp_path / "colors.sqlite"))
+    body, properties = envelope.encode(image_bytes, id="image-1", rgb="#c0c0c0")
+
+    sorter = Sorter()
+    sorter.sort_callback(body, properties)
+    sorter.index.commit()
+    assert sorter.index.nearest("#c1c1c1") == [{
+        "id": "image-1", "rgb": "#c0c0c0", "path": os.path.join("#c0c0c0", "image-1.JPEG"),
+        "size": len(image_bytes), "format": "JPEG", "sorted_at": mock.ANY, "distance": mock.ANY,
+    }]
+
+
+@pytest.fixture
+def consumer(monkeypatch):
+    """Return a function setting up the sorter's message callback on a mocked connection."""
+    def consume(**variables):
+        for name, value in variables.items():
+            monkeypatch.setenv(name, value)
+        sorter = Sorter()
+        connection, channel = mock.MagicMock(), mock.MagicMock()
+        scheduled = []
+        connection.add_callback_threadsafe.side_effect = scheduled.append
+        callback, pool, _ = sorter._consume(connection, channel)
+
+        def run_scheduled():
+            if pool is not None:
+                pool.shutdown(wait=True)
+            while scheduled:
+                scheduled.pop(0)()
+        return sorter, channel, callback, run_scheduled
+    return consume
+
+
+def test_ack_after_write(consumer, image, target_dir):
+    image_bytes, _ = image
+    sorter, channel, callback, run_scheduled = consumer()
+    body, properties = envelope.encode(image_bytes, id="image-1", rgb="#c0c0c0")
+    callback(channel, mock.MagicMock(delivery_tag=7), properties, body)
+    channel.basic_ack.assert_not_called()  # only on the connection thread
+
+    run_scheduled()
+    channel.basic_ack.assert_called_once_with(delivery_tag=7)
+    assert os.path.isfile(os.path.join(target_dir, "#c0c0c0", "image-1.JPEG"))
+
+
+def test_ack_after_batch_sync(consumer, image, target_dir):
+    image_bytes, _ = image
+    sorter, channel, callback, run_scheduled = consumer(FSYNC="batch", FSYNC_BATCH="3")
+    for tag in (1, 2):
+        body, properties = envelope.encode(image_bytes, id=f"image-{tag}", rgb="#c0c0c0")
+        callback(channel, mock.MagicMock(delivery_tag=tag), properties, body)
+    run_scheduled()
+    channel.basic_ack.assert_not_called()
+
+    sorter.writer.sync()
+    run_scheduled()
+    assert [call.kwargs["delivery_tag"] for call in channel.basic_ack.call_args_list] == [1, 2]
+
+
+def test_nack_failed_batch_sync(consumer, image, target_dir):
+    image_bytes, _ = image
+    sorter, channel, callback, run_scheduled = consumer(FSYNC="batch", FSYNC_BATCH="3")
+    for tag in (1, 2):
+        body, properties = envelope.encode(image_bytes, id=f"image-{tag}", rgb="#c0c0c0")
+        callback(channel, mock.MagicMock(delivery_tag=tag), properties, body)
+
+    with mock.patch("os.fsync", side_effect=OSError(5, "Input/output error")):
+        assert sorter.writer.sync() == []
+    run_scheduled()
+    channel.basic_ack.assert_not_called()
+    assert [call.kwargs["delivery_tag"] for call in channel.basic_nack.call_args_list] == [1, 2]
+
+
+def test_index_only_durable_images(consumer, image, target_dir, tmp_path):
+    image_bytes, _ = image
+    sorter, channel, callback, run_scheduled = consumer(
+        FSYNC="batch", FSYNC_BATCH="10", COLOR_INDEX=str(tmp_path / "colors.sqlite")
+    )
+    for tag in (1, 2):
+        body, properties = envelope.encode(image_bytes, id=f"image-{tag}", rgb="#c0c0c0")
+        callback(channel, mock.MagicMock(delivery_tag=tag), properties, body)
+        assert len(sorter.index) == 0  # not durable yet
+        if tag == 1:
+            with mock.patch("os.fsync", side_effect=OSError(5, "Input/output error")):
+                sorter.writer.sync()
+
+    sorter.writer.sync()
+    assert [entry["id"] for entry in sorter.index.nearest("#c0c0c0")] == ["image-2"]
+
+
+def test_ack_after_sync_by_default(consumer, image, monkeypatch):
+    monkeypatch.delenv("FSYNC")
+    sorter, channel, callback, run_scheduled = consumer()
+    assert sorter.fsync == "batch"
+    body, properties = envelope.encode(image[0], id="image-1", rgb="#c0c0c0")
+    callback(channel, mock.MagicMock(delivery_tag=1), properties, body)
+    run_scheduled()
+    channel.basic_ack.assert_not_called()
+
+    sorter.writer.sync()
+    run_scheduled()
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+
+def test_idle_sync_on_writer_pool(monkeypatch, image, target_dir):
+    monkeypatch.setenv("FSYNC", "batch")
+    monkeypatch.setenv("WRITER_THREADS", "1")  # the write runs before the sync
+    sorter = Sorter()
+    connection, channel = mock.MagicMock(), mock.MagicMock()
+    callback, pool, sync = sorter._consume(connection, channel)
+    body, properties = envelope.encode(image[0], id="image-1", rgb="#c0c0c0")
+    callback(channel, mock.MagicMock(delivery_tag=1), properties, body)
+
+    synced_by = []
+    writer_sync = sorter.writer.sync
+
+    def recorded_sync():
+        synced_by.append(threading.current_thread())
+        return writer_sync()
+
+    with mock.patch.object(sorter.writer, "sync", recorded_sync):
+        sync()
+        pool.shutdown(wait=True)
+    assert synced_by and synced_by[0] is not threading.current_thread()
+    ack = connection.add_callback_threadsafe.call_args.args[0]
+    assert ack.func == channel.basic_ack and ack.keywords == {"delivery_tag": 1}
+
+
+def test_nack_invalid_message(consumer):
+    sorter, channel, callback, run_scheduled = consumer()
+    callback(channel, mock.MagicMock(delivery_tag=3), None, b"not a valid message")
+    run_scheduled()
+    channel.basic_nack.assert_called_once_with(delivery_tag=3, requeue=False)
+    channel.basic_ack.assert_not_called()
+
+
+def test_nack_failed_write(consumer, image):
+    image_bytes, _ = image
+    sorter, channel, callback, run_scheduled = consumer(WRITER_THREADS="2")
+    body, properties = envelope.encode(image_bytes, id="image-1", rgb="#c0c0c0")
+    with mock.patch.object(sorter.writer, "write", side_effect=OSError(28, "No space left on device")):
+        callback(channel, mock.MagicMock(delivery_tag=3), properties, body)
+        run_scheduled()
+    channel.basic_nack.assert_called_once_with(delivery_tag=3, requeue=False)
+
+
+def test_writer_pool(consumer, image, target_dir):
+    image_bytes, _ = image
+    sorter, channel, callback, run_scheduled = consumer(WRITER_THREADS="4")
+    for tag in range(1, 21):
+        body, properties = envelope.encode(image_bytes, id=f"image-{tag}", rgb="#c0c0c0")
+        callback(channel, mock.MagicMock(delivery_tag=tag), properties, body)
+    run_scheduled()
+    acked = sorted(call.kwargs["delivery_tag"] for call in channel.basic_ack.call_args_list)
+    assert acked == list(range(1, 21))
+    assert len(os.listdir(os.path.join(target_dir, "#c0c0c0"))) == 20
+
+
+@pytest.mark.parametrize("variables,prefetch", [
+    ({}, 1),
+    ({"FSYNC": ""}, 33),  # durable by default, a batch is waiting for its sync
+    ({"WRITER_THREADS": "4"}, 16),
+    ({"WRITER_THREADS": "4", "WRITER_QUEUE": "6", "FSYNC": "batch", "FSYNC_BATCH": "10"}, 16),
+])
+def test_prefetch(monkeypatch, variables, prefetch):
+    for name, value in variables.items():
+        monkeypatch.setenv(name, value)
+    with mock.patch.object(Sorter, "connection") as mocked_connection:
+        with mocked_connection() as conn:
+            channel = conn.channel()
+        Sorter().start_listening()
+    channel.basic_qos.assert_called_once_with(prefetch_count=prefetch)
+    assert channel.basic_consume.call_args.kwargs["auto_ack"] is False
+
+
+def declared_queues(monkeypatch, tmp_path, **variables):
+    monkeypatch.setenv("TARGET_DIR", str(tmp_path))
+    monkeypatch.setenv("INPUT_EXCHANGE", "computed")
+    for name, value in variables.items():
+        monkeypatch.setenv(name, value)
+    channel = mock.MagicMock()
+    channel.queue_declare.return_value.method.queue = "queue"
+    Sorter()._declare_queue(channel)
+    return channel
+
+
+def test_exclusive_queue(monkeypatch, tmp_path):
+    channel = declared_queues(monkeypatch, tmp_path)
+    channel.queue_declare.assert_called_once_with("", exclusive=True)
+    channel.queue_bind.assert_called_once_with(exchange="computed", queue="queue", routing_key="#")
+    channel.exchange_bind.assert_not_called()
+
+
+def test_shared_queue(monkeypatch, tmp_path):
+    channel = declared_queues(monkeypatch, tmp_path, SCALE_MODE="shared", SORT_QUEUE="sorters")
+    channel.queue_declare.assert_called_once_with("sorters", durable=True)
+    channel.queue_bind.assert_called_once_with(exchange="computed", queue="queue", routing_key="#")
+
+
+@pytest.mark.parametrize("partition_by,arguments", [("id", None), ("color", {"hash-header": "rgb"})])
+def test_partitioned_queue(monkeypatch, tmp_path, partition_by, arguments):
+    channel = declared_queues(
+        monkeypatch, tmp_path, SCALE_MODE="partitioned", SORTER_PARTITION="a", PARTITION_WEIGHT="2",
+        PARTITION_BY=partition_by,
+    )
+    partitions = "computed.sorter.partitions"
+    channel.exchange_declare.assert_called_with(
+        partitions, exchange_type="x-consistent-hash", durable=True, arguments=arguments
+    )
+    channel.exchange_bind.assert_called_once_with(destination=partitions, source="computed", routing_key="#")
+    channel.queue_declare.assert_called_once_with("sorter.a", durable=True)
+    channel.queue_bind.assert_called_once_with(exchange=partitions, queue="queue", routing_key="2")
+
+
+@pytest.mark.parametrize("variables", [
+    {"SCALE_MODE": "broadcast"}, {"PARTITION_BY": "size"}, {"SCALE_MODE": "partitioned"},
+])
+def test_invalid_scale_mode(monkeypatch, variables):
+    for name, value in variables.items():
+        monkeypatch.setenv(name, value)
+    with pytest.raises(SorterError):
+        Sorter()
+
+
+def test_collect_blobs(tmp_path, monkeypatch):
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path / "blobs"))
+    monkeypatch.setenv("BLOB_RETENTION_HOURS", "1")
+    sorter = Sorter()
+    expired, kept = sorter.blob_store.put(b"expired"), sorter.blob_store.put(b"kept")
+    os.utime(sorter.blob_store.path(expired.key), (0, 0))
+
+    sorter.collect_blobs()
+    sorter._blob_gc.join(timeout=5)
+    assert not sorter.blob_store.exists(expired.key) and sorter.blob_store.exists(kept.key)
+
+    assert gc_blobs_main([str(tmp_path / "blobs"), "--max-age", "0"]) == 0
+    assert not sorter.blob_store.exists(kept.key)
@@ -0,0 +1,115 @@
+import os
+
+import mock
+import pytest
+
+from app import writer
+from app.writer import FileWriter, WriterError
+
+
+@pytest.mark.parametrize("fsync", writer.FSYNC_MODES)
+def test_write_bytes(tmp_path, fsync):
+    target = str(tmp_path / "image.JPEG")
+    file_writer = FileWriter(fsync=fsync)
+    file_writer.write(target, data=b"image data")
+    file_writer.close()
+    assert open(target, "rb").read() == b"image data"
+    assert os.listdir(tmp_path) == ["image.JPEG"]  # no temporary files left behind
+
+
+def test_copy_file(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(os.urandom(100_000))
+    FileWriter().write(str(tmp_path / "copy"), source_path=str(source))
+    assert (tmp_path / "copy").read_bytes() == source.read_bytes()
+    assert os.stat(source).st_ino != os.stat(tmp_path / "copy").st_ino
+
+
+def test_copy_file_fallback(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"image data")
+    with mock.patch("os.copy_file_range", side_effect=OSError(18, "Invalid cross-device link")):
+        FileWriter().write(str(tmp_path / "copy"), source_path=str(source))
+    assert (tmp_path / "copy").read_bytes() == b"image data"
+
+
+def test_link_file(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"image data")
+    FileWriter(link=True).write(str(tmp_path / "link"), source_path=str(source))
+    assert os.stat(source).st_ino == os.stat(tmp_path / "link").st_ino
+
+
+def test_link_falls_back_to_copy(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"image data")
+    file_writer = FileWriter(link=True)
+    with mock.patch("os.link", side_effect=OSError(18, "Invalid cross-device link")):
+        file_writer.write(str(tmp_path / "copy"), source_path=str(source))
+    assert (tmp_path / "copy").read_bytes() == b"image data"
+    assert not file_writer.link
+
+
+def test_batch_sync(tmp_path):
+    file_writer = FileWriter(fsync=writer.BATCH, batch_size=3)
+    with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+        file_writer.write(str(tmp_path / "1"), data=b"1")
+        file_writer.write(str(tmp_path / "2"), data=b"2")
+        # not durable yet, so not under the final name
+        assert not (tmp_path / "1").exists() and len(file_writer.pending) == 2
+        fsync.assert_not_called()
+
+        file_writer.write(str(tmp_path / "3"), data=b"3")
+        assert sorted(os.listdir(tmp_path)) == ["1", "2", "3"]
+        assert fsync.call_count == 4  # 3 files and 1 directory
+    assert file_writer.sync() == []
+
+
+def test_write_nothing(tmp_path):
+    with pytest.raises(WriterError):
+        FileWriter().write(str(tmp_path / "image"))
+    with pytest.raises(WriterError):
+        FileWriter(fsync="sometimes")
+
+
+@pytest.mark.parametrize("fsync", [writer.NONE, writer.ALWAYS])
+def test_on_durable(tmp_path, fsync):
+    durable = mock.Mock(side_effect=lambda: os.path.isfile(tmp_path / "image"))
+    FileWriter(fsync=fsync).write(str(tmp_path / "image"), data=b"image", on_durable=durable)
+    durable.assert_called_once()
+    assert durable.side_effect() is True
+
+
+def test_on_durable_after_batch_sync(tmp_path):
+    file_writer = FileWriter(fsync=writer.BATCH, batch_size=10)
+    durable = mock.Mock()
+    file_writer.write(str(tmp_path / "image"), data=b"image", on_durable=durable)
+    durable.assert_not_called()
+    file_writer.sync()
+    durable.assert_called_once()
+
+
+def test_batch_sync_failure(tmp_path):
+    file_writer = FileWriter(fsync=writer.BATCH, batch_size=10)
+    callbacks = {name: (mock.Mock(), mock.Mock()) for name in ("1", "2", "3")}
+    for name, (durable, failed) in callbacks.items():
+        file_writer.write(str(tmp_path / name), data=name.encode(), on_durable=durable, on_failed=failed)
+    fsync = os.fsync
+    failing = file_writer.pending[1][2].fileno()
+
+    def fail_second(fd):
+        if fd == failing:
+            raise OSError(5, "Input/output error")
+        fsync(fd)
+
+    with mock.patch("os.fsync", side_effect=fail_second):
+        assert file_writer.sync() == [str(tmp_path / "1"), str(tmp_path / "3")]
+
+    assert sorted(os.listdir(tmp_path)) == ["1", "3"]  # no temporary file left behind
+    for name, (durable, failed) in callbacks.items():
+        if name == "2":
+            durable.assert_not_called()
+            assert isinstance(failed.call_args.args[0], OSError)
+        else:
+            durable.assert_called_once()
+            failed.assert_not_called()
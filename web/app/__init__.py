@@ -1,24 +1,84 @@
-import base64
+import json
+import os
 import secrets
+import threading
+import time
 
-from flask import Flask, request, flash, render_template, redirect
+from flask import Flask, Response, request, flash, render_template, redirect, jsonify, send_file
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 
-from app.connection import Computation
+from app import batch
+from app.colorindex import ColorIndex, ColorIndexError, MAX_DISTANCE
+from app.connection import FINAL_STATES, Computation
 from app.log import get_logger
+from app.results import ResultConsumer
+from app.store import ComputationStore, StoreError
 
 app = Flask(__name__)
 app.secret_key = secrets.token_urlsafe()
 
+# uploads over MAX_UPLOAD_MB (defaults to 64) are refused, before they are read when their size is known,
+# batches (/batches) over MAX_BATCH_MB (defaults to 4096) or MAX_BATCH_ITEMS images (defaults to 10000)
+MAX_UPLOAD_SIZE = int(float(os.environ.get("MAX_UPLOAD_MB") or 64) * 1024 * 1024)
+MAX_BATCH_SIZE = int(float(os.environ.get("MAX_BATCH_MB") or 4096) * 1024 * 1024)
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS") or 10000)
+BATCH_CHUNK = 100  # requests committed to the broker at once
+app.config["MAX_CONTENT_LENGTH"] = max(MAX_UPLOAD_SIZE, MAX_BATCH_SIZE)
+
 
 log = get_logger("SERVER")
 
 
-ACTIVE_COMPUTATIONS = dict()
+# computations by image id, shared with the other web processes (see ComputationStore)
+ACTIVE_COMPUTATIONS = ComputationStore()
+
+# the sorter's index of the sorted images (COLOR_INDEX), opened on first use
+COLOR_INDEX = None
+MAX_SIMILAR = 500
+
+
+# server-sent events: changes made by other processes are looked up this often (seconds),
+# a comment is sent to idle clients every EVENTS_KEEPALIVE seconds, streams end after EVENTS_TIMEOUT
+EVENTS_POLL = 1.0
+EVENTS_KEEPALIVE = 15.0
+EVENTS_TIMEOUT = 300.0
+MAX_EVENT_IDS = 1000
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+)
+
+# one consumer of the results per process, started on the first upload
+RESULT_CONSUMER = None
+RESULT_CONSUMER_LOCK = threading.Lock()
+
+
+def result_consumer() -> ResultConsumer:
+    global RESULT_CONSUMER
+    with RESULT_CONSUMER_LOCK:
+        if RESULT_CONSUMER is None:
+            RESULT_CONSUMER = ResultConsumer().start()
+    RESULT_CONSUMER.wait_ready()
+    return RESULT_CONSUMER
+
+
+def color_index():
+    global COLOR_INDEX
+    if COLOR_INDEX is None and os.environ.get("COLOR_INDEX"):
+        COLOR_INDEX = ColorIndex(os.environ["COLOR_INDEX"], readonly=True)
+    return COLOR_INDEX
 
 
 @app.route("/", methods=["GET", "POST"])
 def home():
     if request.method == "POST":
+        if request.content_length and request.content_length > MAX_UPLOAD_SIZE:
+            raise RequestEntityTooLarge()
         if "file" not in request.files:
             flash("No file parts", "error")
         file = request.files['file']
@@ -26,13 +86,14 @@ def home():
             flash('No selected files', "error")
             return redirect(request.url)
 
-        file_bytes = file.stream.read()
-
         try:
-            computation = Computation(image_bytes=file_bytes)
+            # streamed to a file, the upload is never held in memory whole
+            image_path, blob = ACTIVE_COMPUTATIONS.spool(file.stream, MAX_UPLOAD_SIZE)
+            computation = Computation(image_path=image_path, blob=blob)
+            computation.listen(result_consumer())
             ACTIVE_COMPUTATIONS[computation.image_id] = computation
-            computation.spawn_listener()
             computation.send()
+            ACTIVE_COMPUTATIONS.save(computation)
             return redirect(f"/{computation.image_id}")
         except Exception as e:
             log.error("Unexpected error.", exc_info=e)
@@ -41,15 +102,143 @@ def home():
     return render_template("home.html", computations=ACTIVE_COMPUTATIONS.values())
 
 
+@app.route("/batches", methods=["POST"])
+def create_batch():
+    """
+    Upload many images at once: files of a multipart form (field 'files', zip/tar archives among them
+    are unpacked) or a zip/tar archive as the request body. Replies 202 with the batch id, the number
+    of the accepted images and the rejected ones, the progress is at /batches/<batch_id>.
+    """
+    if request.content_length and request.content_length > MAX_BATCH_SIZE:
+        raise RequestEntityTooLarge()
+    files = request.files.getlist("files")
+    images = batch.uploads(files, None if files else request.stream, request.mimetype)
+    try:
+        summary = batch.submit(
+            images, ACTIVE_COMPUTATIONS, result_consumer(), MAX_UPLOAD_SIZE, MAX_BATCH_ITEMS, BATCH_CHUNK
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.error("Batch upload failed.", exc_info=e)
+        return jsonify(error=str(e)), 500
+    if not summary["accepted"]:
+        return jsonify(summary), 400
+    return jsonify(dict(summary, progress=f"/batches/{summary['batch']}")), 202
+
+
+@app.route("/batches/<batch_id>", methods=["GET"])
+def batch_progress(batch_id):
+    """Aggregated progress of a batch: its computations by state, elapsed seconds and throughput."""
+    progress = ACTIVE_COMPUTATIONS.batch(batch_id)
+    if progress is None:
+        return jsonify(error=f"Unknown batch: {batch_id}"), 404
+    return jsonify(progress)
+
+
 @app.route("/<computation_id>", methods=["GET"])
 def status(computation_id):
     if computation_id not in ACTIVE_COMPUTATIONS:
         return "", 404
 
-    computation = ACTIVE_COMPUTATIONS[computation_id]
-    image_as_b64 = base64.b64encode(computation.image_bytes)
-    return render_template(
-        "status.html",
-        computation=computation,
-        image_bytes=image_as_b64.decode()
-    )
+    # the state is pushed by /events, the image served by /<computation_id>/image
+    return render_template("status.html", computation=ACTIVE_COMPUTATIONS[computation_id])
+
+
+def image_mimetype(head: bytes) -> str:
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+@app.route("/<computation_id>/image", methods=["GET"])
+def image(computation_id):
+    """The uploaded image, streamed from the spool (and cached by the browser, it never changes)."""
+    computation = ACTIVE_COMPUTATIONS.get(computation_id)
+    if computation is None:
+        return "", 404
+    image_path = getattr(computation, "image_path", None)
+    if image_path is None:
+        try:
+            image_bytes = computation.image_bytes
+        except StoreError:
+            return "", 404
+        return Response(image_bytes, mimetype=image_mimetype(image_bytes[:16]))
+    try:
+        with open(image_path, "rb") as f:
+            head = f.read(16)
+    except OSError:
+        return "", 404
+    return send_file(image_path, mimetype=image_mimetype(head), max_age=86400)
+
+
+def state_event(computation_id: str, computation) -> dict:
+    if computation is None:
+        return {"id": computation_id, "state": "unknown"}
+    event = {"id": computation_id, "state": computation.state}
+    if computation.result is not None:
+        event["rgb"] = computation.result
+    if computation.error is not None:
+        event["error"] = computation.error
+    return event
+
+
+@app.route("/events", methods=["GET"])
+def events():
+    """
+    Server-sent 'state' events of the computations (/events?id=...&id=...): their current state
+    and then every change, until all of them are done or failed.
+    """
+    computation_ids = request.args.getlist("id")
+    if not computation_ids or len(computation_ids) > MAX_EVENT_IDS:
+        return jsonify(error=f"Between 1 and {MAX_EVENT_IDS} computation ids expected."), 400
+    store = ACTIVE_COMPUTATIONS
+
+    def stream():
+        started = last_sent = time.monotonic()
+        version = store.version
+        sent = {}
+        while time.monotonic() - started < EVENTS_TIMEOUT:
+            for computation_id in computation_ids:
+                if sent.get(computation_id, {}).get("state") in FINAL_STATES:
+                    continue
+                event = state_event(computation_id, store.get(computation_id))
+                if sent.get(computation_id) != event:
+                    sent[computation_id] = event
+                    last_sent = time.monotonic()
+                    yield f"event: state\ndata: {json.dumps(event)}\n\n"
+            if all(event["state"] in FINAL_STATES + ("unknown",) for event in sent.values()):
+                return
+            if time.monotonic() - last_sent > EVENTS_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            # woken up right away by the results of this process
+            version = store.wait(version, EVENTS_POLL)
+
+    # not cached, not buffered by proxies
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream(), mimetype="text/event-stream", headers=headers)
+
+
+@app.route("/similar", methods=["GET"])
+def similar():
+    """Sorted images closest to a color, e.g. /similar?rgb=c0c0c0&limit=20&max_distance=10"""
+    try:
+        index = color_index()
+    except ColorIndexError as e:
+        log.error("Color index not available.", exc_info=e)
+        index = None
+    if index is None:
+        return jsonify(error="The color index is not available."), 503
+
+    color = request.args.get("rgb", "")
+    limit = min(max(request.args.get("limit", 20, type=int), 1), MAX_SIMILAR)
+    max_distance = request.args.get("max_distance", MAX_DISTANCE, type=float)
+    try:
+        images = index.nearest(color, limit=limit, max_distance=max_distance)
+    except ColorIndexError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(rgb=color, images=images)
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
+
+from app.blobstore import CHUNK_SIZE
+from app.connection import Computation
+from app.log import get_logger
+from app.store import StoreError
+
+log = get_logger(__name__)
+
+
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP_SUFFIXES = (".zip",)
+TAR_TYPES = (
+    "application/x-tar", "application/x-gtar", "application/gzip", "application/x-gzip",
+    "application/x-bzip2", "application/x-xz",
+)
+ZIP_TYPES = ("application/zip", "application/x-zip-compressed")
+
+
+class BatchError(Exception):
+    pass
+
+
+def _skipped(name: str) -> bool:
+    """Hidden files and archivers' metadata (e.g. .DS_Store, __MACOSX/) are not images."""
+    base = os.path.basename(name)
+    return not base or base.startswith(".") or name.startswith("__MACOSX/")
+
+
+def tar_members(stream):
+    """Yield (name, stream) of the files of a (compressed) tar archive, read as it arrives, never seeked."""
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if member.isfile() and not _skipped(member.name):
+                    yield member.name, archive.extractfile(member)
+    except tarfile.TarError as e:
+        raise BatchError(f"Invalid tar archive: {e}")
+
+
+def zip_members(stream):
+    """
+    Yield (name, stream) of the files of a zip archive, one member decompressed at a time.
+    Its directory is at the end, a stream which can't seek (a request body) is spooled to a file first.
+    """
+    spooled = None
+    if not getattr(stream, "seekable", lambda: False)():
+        spooled = tempfile.TemporaryFile()
+        shutil.copyfileobj(stream, spooled, CHUNK_SIZE)
+        spooled.seek(0)
+        stream = spooled
+    try:
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and not _skipped(info.filename):
+                    with archive.open(info) as member:
+                        yield info.filename, member
+    except zipfile.BadZipFile as e:
+        raise BatchError(f"Invalid zip archive: {e}")
+    finally:
+        if spooled is not None:
+            spooled.close()
+
+
+def uploads(files=(), body=None, mimetype: str = None):
+    """
+    Yield (name, stream) of the uploaded images: the files of a multipart form, the archives among
+    them unpacked, or the members of an archive sent as the request body (by its content type).
+    """
+    for file in files:
+        name = (file.filename or "").lower()
+        if name.endswith(TAR_SUFFIXES):
+            yield from tar_members(file.stream)
+        elif name.endswith(ZIP_SUFFIXES):
+            yield from zip_members(file.stream)
+        elif name:
+            yield file.filename, file.stream
+    if files:
+        return
+    if mimetype in TAR_TYPES:
+        yield from tar_members(body)
+    elif mimetype in ZIP_TYPES:
+        yield from zip_members(body)
+    else:
+        raise BatchError(f"Expected image files or a zip/tar archive, got: {mimetype or 'nothing'}")
+
+
+def submit(images, store, consumer, max_size: int, max_items: int, chunk_size: int = 100) -> dict:
+    """
+    Spool, store and send the images (see uploads) as one batch, the requests of `chunk_size`
+    images are committed to the broker at a time (see Computation.send_many), there is no
+    round-trip per image. Each result is awaited from the moment its request is sent, RESULT_TIMEOUT
+    seconds for every chunk up to its own. Returns the batch id, the number of the accepted images,
+    the rejected ones (name and error) and the error which stopped the batch, if any.
+    """
+    batch_id = str(uuid.uuid4())
+    accepted, rejected, pending = 0, [], []
+    summary = {"batch": batch_id}
+
+    def flush():
+        Computation.send_many(pending, consumer)
+        store.save(*pending)
+        pending.clear()
+
+    try:
+        try:
+            for name, stream in images:
+                if accepted >= max_items:
+                    raise BatchError(f"Over the limit of {max_items} images per batch, the rest is ignored.")
+                try:
+                    image_path, blob = store.spool(stream, max_size)
+                except StoreError as e:
+                    rejected.append({"name": name, "error": str(e)})
+                    continue
+                if not (blob.size if blob is not None else os.path.getsize(image_path)):
+                    if blob is None:
+                        os.unlink(image_path)  # blobs are shared, only the own spill is removed
+                    rejected.append({"name": name, "error": "Empty file"})
+                    continue
+                computation = Computation(image_path=image_path, blob=blob, batch_id=batch_id)
+                # compute works through the batch in order, each chunk ahead of the image delays its result
+                computation.listen(consumer, timeout=consumer.timeout * (1 + accepted // chunk_size))
+                store[computation.image_id] = computation
+                pending.append(computation)
+                accepted += 1
+                if len(pending) >= chunk_size:
+                    flush()
+        except BatchError as e:
+            log.warning(f"Batch {batch_id} stopped after {accepted} images: {e}")
+            summary["error"] = str(e)
+        flush()
+    except Exception as e:
+        # e.g. the broker failed, the requests which were not sent would never get a result
+        unsent = [computation for computation in pending if not computation.sent]
+        log.warning(f"Batch {batch_id} failed, {len(unsent)} requests not sent: {e}")
+        for computation in unsent:
+            consumer.cancel(computation.image_id, e)
+        raise
+
+    log.info(f"Batch {batch_id}: {accepted} images sent, {len(rejected)} rejected")
+    summary.update(accepted=accepted, rejected=rejected)
+    return summary
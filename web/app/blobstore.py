@@ -0,0 +1,167 @@
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from app.log import get_logger
+
+log = get_logger(__name__)
+
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStoreError(Exception):
+    pass
+
+
+class Blob(NamedTuple):
+    """A reference to the stored data, this is what travels in the messages."""
+    key: str
+    size: int
+    sha256: str
+
+    def to_dict(self) -> dict:
+        return self._asdict()
+
+    @classmethod
+    def from_dict(cls, data) -> "Blob":
+        try:
+            blob = cls(key=str(data["key"]), size=int(data["size"]), sha256=str(data["sha256"]))
+        except (KeyError, TypeError, ValueError) as e:
+            raise BlobStoreError(f"Invalid blob reference: {data}", e)
+        if not KEY_PATTERN.match(blob.key):
+            raise BlobStoreError(f"Invalid blob key: {blob.key}")
+        return blob
+
+
+class BlobStore:
+    """
+    Content-addressed storage in a directory shared by the services (e.g. a mounted volume).
+    Each blob is written once, under its sha256, and never modified afterwards. Storing it again
+    refreshes its modification time, blobs neither stored nor reused for a while are removed by gc.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """Return the store configured by BLOB_STORE_DIR or None (images travel inline)."""
+        root = os.environ.get("BLOB_STORE_DIR")
+        return cls(root) if root else None
+
+    def path(self, key: str) -> str:
+        if not KEY_PATTERN.match(key):
+            raise BlobStoreError(f"Invalid blob key: {key}")
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def _reuse(self, key: str) -> bool:
+        """Refresh a stored blob, so that it is kept as long as a new one, False if it is not stored."""
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _commit(self, tmp_path: str, sha256: str, size: int) -> Blob:
+        """Move a fully written temporary file to its final, content-addressed path."""
+        final_path = self.path(sha256)
+        if self._reuse(sha256):
+            os.unlink(tmp_path)  # already stored
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+            log.debug(f"Stored blob {sha256}, size={size}B")
+        return Blob(key=sha256, size=size, sha256=sha256)
+
+    def _tmp_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.root, prefix=".tmp-", delete=False)
+
+    def put(self, data: bytes) -> Blob:
+        sha256 = hashlib.sha256(data).hexdigest()
+        if self._reuse(sha256):
+            return Blob(key=sha256, size=len(data), sha256=sha256)
+
+        with self._tmp_file() as tmp:
+            tmp.write(data)
+        return self._commit(tmp.name, sha256, len(data))
+
+    def put_file(self, source_path: str) -> Blob:
+        """Store a file, hashing it while copying, its content is never held in memory."""
+        with open(source_path, "rb") as source:
+            return self.put_stream(source)
+
+    def put_stream(self, stream, max_size: int = None) -> Blob:
+        """Store a stream chunk by chunk, hashing it on the way, fails once it is over max_size."""
+        digest = hashlib.sha256()
+        size = 0
+        with self._tmp_file() as tmp:
+            try:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobStoreError(f"Data over the limit of {max_size}B")
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise
+        return self._commit(tmp.name, digest.hexdigest(), size)
+
+    def gc(self, max_age: float, dry_run: bool = False) -> tuple:
+        """
+        Remove the blobs (and abandoned temporary files) neither stored nor reused in the last
+        `max_age` seconds, the services have to be done with them by then.
+        Returns (number of removed files, bytes freed).
+        """
+        deadline = time.time() - max_age
+        removed, freed = 0, 0
+        for path, _, names in os.walk(self.root):
+            for name in names:
+                file_path = os.path.join(path, name)
+                try:
+                    stat = os.stat(file_path)
+                    if stat.st_mtime > deadline:
+                        continue
+                    if dry_run:
+                        log.info(f"Would remove {file_path}")
+                    else:
+                        os.unlink(file_path)
+                except FileNotFoundError:
+                    continue  # removed meanwhile
+                removed += 1
+                freed += stat.st_size
+        log.info(f"{removed} expired blobs ({freed}B) {'to be ' if dry_run else ''}removed")
+        return removed, freed
+
+    @contextmanager
+    def open(self, blob: Blob) -> mmap.mmap:
+        """Map the blob read-only into memory, nothing is copied until it is read."""
+        path = self.path(blob.key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError as e:
+            raise BlobStoreError(f"Blob {blob.key} not found", e)
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size != blob.size:
+                raise BlobStoreError(f"Blob {blob.key} size mismatch: {size} != {blob.size}")
+            if size == 0:
+                raise BlobStoreError(f"Blob {blob.key} is empty")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield data
+            finally:
+                data.close()
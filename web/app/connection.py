@@ -1,21 +1,31 @@
 import base64
 import json
 import os
-import threading
-import time
 import uuid
+from concurrent.futures import Future
 from contextlib import contextmanager
-from datetime import datetime, timedelta
 
 import pika
 
-from app.log import get_logger
+from app import envelope
+from app.blobstore import Blob, BlobStore
+from app.log import IdLogger, get_logger
+
+
+QUEUED = "queued"
+COMPUTING = "computing"
+DONE = "done"
+FAILED = "error"
+FINAL_STATES = (DONE, FAILED)
+
+log = get_logger("COMPUTATION")
 
 
 class Computation:
     """
     An object representing a single computation request (single image),
-    it is storing the image identifier, connection details as well as the message consumer thread.
+    it is storing the image identifier, connection details and the result once it arrives
+    (delivered by the process' ResultConsumer).
 
     Modify behavior using these environment variables:
     * LOG_LEVEL
@@ -27,37 +37,73 @@ class Computation:
     * INPUT_EXCHANGE: where to consume the result messages
     * INPUT_ROUTING_KEY: a topic suffix (defaults to 'computed'),
                          the actual topic will is in format: "<request_id>.<suffix>"
+    * RESULT_TIMEOUT: seconds to wait for the result (defaults to 30)
+    * REPLY_MODE: 'direct' (default, compute replies straight to the web process, RabbitMQ's
+                  direct reply-to) or 'topic' (results consumed from the INPUT_EXCHANGE)
+    * MESSAGE_FORMAT: 'json' (base64 image) or 'binary' (raw image body, fields in headers),
+                      defaults to 'json', results are accepted in both formats
+    * BLOB_STORE_DIR: shared directory, when set the image is stored there
+                      and only its reference is sent (claim-check)
     """
 
-    def __init__(self, image_bytes) -> None:
+    def __init__(self, image_bytes: bytes = None, image_path: str = None, blob: Blob = None,
+                 batch_id: str = None) -> None:
         self.broker_host = os.environ.get("BROKER_HOST")
         self.broker_port = os.environ.get("BROKER_PORT") or 5672
         self.output_exchange = os.environ.get('OUTPUT_EXCHANGE')
         self.output_routing_key = os.environ.get('OUTPUT_ROUTING_KEY') or "compute"
         self.input_exchange = os.environ.get("INPUT_EXCHANGE")
         self.topic_suffix = os.environ.get('INPUT_ROUTING_KEY') or "computed"
-
-        # Ideally we of course don't want to keep the image bytes in memory,
-        # e.g. we could use a mounted file system shared with the sorting service
-        # and serve image data directly from there.
-        self.image_bytes = image_bytes
+        self.blob_store = BlobStore.from_env()
+        self.message_format = (os.environ.get("MESSAGE_FORMAT") or envelope.JSON).lower()
+
+        # the image is either held in memory or spooled to a file (a streamed upload,
+        # see ComputationStore.spool) and read only when it is needed
+        if (image_bytes is None) == (image_path is None):
+            raise ValueError("Either the image bytes or its file has to be given.")
+        self._image_bytes = image_bytes
+        self.image_path = image_path
+        self.blob = blob  # the image is in the blob store already
+        self.size = len(image_bytes) if image_bytes is not None else os.path.getsize(image_path)
 
         self.image_id = str(uuid.uuid4())  # track the request through the system
-        self.queue_name = None  # ad-hoc queue
-        self.running_thread = None
+        self.batch_id = batch_id  # uploaded together with others (see app.batch)
+        self.future = None  # the pending result
+        self.sent = False
+        self.consumer = None  # delivering the result, requests are published through it
         self.result = None  # store resulting average RGB
         self.error = None  # store any errors
         # TODO: make compute service publish computation-related error messages as well
         # TODO: with "<image-id>.error" topic and display them.
-        self.log = get_logger(self.image_id)
+        self.log = IdLogger(log, {"id": self.image_id})
 
     @property
     def is_running(self):
-        return self.running_thread is not None
+        return self.future is not None and not self.future.done()
+
+    @property
+    def state(self) -> str:
+        if self.error is not None:
+            return FAILED
+        if self.result is not None:
+            return DONE
+        return COMPUTING if self.sent else QUEUED
+
+    @property
+    def image_bytes(self) -> bytes:
+        if self._image_bytes is not None:
+            return self._image_bytes
+        with open(self.image_path, "rb") as f:
+            return f.read()
+
+    @property
+    def memory_size(self) -> int:
+        """Bytes of the image held in memory."""
+        return len(self._image_bytes) if self._image_bytes is not None else 0
 
     @property
     def data_size_kb(self):
-        return len(self.image_bytes) / 1000
+        return self.size / 1000
 
     @contextmanager
     def connection(self) -> pika.BlockingConnection:
@@ -76,82 +122,97 @@ class Computation:
             connection.close()
 
     @staticmethod
-    def _validate_body(body) -> str:
-        body = json.loads(body)
+    def _validate_body(body, properties=None) -> str:
+        if envelope.is_envelope(properties):
+            body, _ = envelope.decode(body, properties)
+        else:
+            body = json.loads(body)
         if "rgb" not in body:
             raise ValueError("'rgb' field is missing.")
         return body["rgb"]
 
-    def _create_queue(self, channel):
-        channel.exchange_declare(self.input_exchange, exchange_type="topic")
-        result = channel.queue_declare("", exclusive=True)
-        self.queue_name = result.method.queue
-        channel.queue_bind(
-            exchange=self.input_exchange,
-            queue=self.queue_name,
-            routing_key=f"{self.image_id}.{self.topic_suffix}"
-        )
-
-    def _is_queue_empty(self, channel):
-        # declaring an already existing queue to query information about it
-        queue = channel.queue_declare(self.queue_name, exclusive=True, passive=True)
-        return queue.method.message_count == 0
-
-    def wait_for_reply(self, timeout=timedelta(seconds=30)) -> None:
-        """Wait and periodically check if there is message in the queue, once there is, quit."""
-        start_time = datetime.now()
-        with self.connection() as connection:
-            channel = connection.channel()
-            self._create_queue(channel)
-
-            is_info = True  # log the first message as info and then debug to reduce clutter
-            while datetime.now() - start_time < timeout:
-                getattr(self.log, "info" if is_info else "debug")(
-                    f"Waiting for message, exchange={self.input_exchange}, "
-                    f"queue={self.queue_name}, "
-                    f"remaining={timeout - (datetime.now() - start_time)}"
-                )
-                is_info = False
-                if not self._is_queue_empty(channel):
-                    method, properties, body = channel.basic_get(self.queue_name)
-                    self.log.debug(f"Received message.")
-                    try:
-                        self.result = self._validate_body(body)
-                        self.log.info(f"Computation done, average RGB: {self.result}")
-                    except Exception as e:
-                        self.log.error("Received message is not valid.", exc_info=e)
-                        self.error = str(e)
-                    finally:
-                        self.running_thread = None
-                        return
-                time.sleep(1)
-
+    def _on_result(self, future: Future) -> None:
+        try:
+            body, properties = future.result()
+            self.log.debug("Received message.")
+            self.result = self._validate_body(body, properties)
+            self.log.info(f"Computation done, average RGB: {self.result}")
+        except TimeoutError:
             self.log.error("Timed-out while waiting for the processed image.")
             self.error = "Wait timed out."
-            self.running_thread = None
+        except Exception as e:
+            self.log.error("Received message is not valid.", exc_info=e)
+            self.error = str(e)
+
+    def listen(self, consumer, timeout: float = None) -> None:
+        """
+        Have the result delivered by the consumer, has to be called before the request is sent.
+        It is awaited `timeout` seconds after sending (defaults to RESULT_TIMEOUT).
+        """
+        self.consumer = consumer
+        self.future = consumer.expect(self.image_id, timeout)
+        self.future.add_done_callback(self._on_result)
+
+    def _message(self) -> tuple:
+        """Return (body, properties) of the computation request in the configured format."""
+        blob = self.blob
+        if blob is None and self.blob_store is not None:
+            if self._image_bytes is not None:
+                blob = self.blob_store.put(self._image_bytes)
+            else:
+                blob = self.blob_store.put_file(self.image_path)  # streamed, never held in memory
+        if self.message_format == envelope.BINARY:
+            return envelope.encode(
+                b"" if blob else self.image_bytes,
+                id=self.image_id,
+                size=self.size,
+                blob=blob.to_dict() if blob else None,
+            )
 
-    def spawn_listener(self) -> None:
-        def target():
-            try:
-                self.wait_for_reply()
-            except Exception as e:
-                self.log.error("Wait thread failed.", exc_info=e)
+        message = {'id': self.image_id}
+        if blob:
+            message['blob'] = blob.to_dict()
+        else:
+            message['image'] = base64.b64encode(self.image_bytes).decode()
+        return json.dumps(message).encode(), None
 
-        self.running_thread = threading.Thread(target=target)
-        self.running_thread.start()
+    def _request(self) -> tuple:
+        """Return (body, properties) of the request, the image id is the correlation id of the reply."""
+        body, properties = self._message()
+        properties = properties or pika.BasicProperties()
+        properties.correlation_id = self.image_id
+        return body, properties
 
     def send(self) -> None:
-        """Send image data to the system for processing."""
-        with self.connection() as conn:
-            channel = conn.channel()
-            channel.exchange_declare(exchange=self.output_exchange, exchange_type='direct')
-            channel.basic_publish(
-                exchange=self.output_exchange,
-                routing_key=self.output_routing_key,
-                body=json.dumps({
-                    'id': self.image_id,
-                    'image': base64.b64encode(self.image_bytes).decode(),
-                }).encode(),
-            )
-            self.log.debug(f"Sending image size={self.data_size_kb}kB")
-            self.log.info(f"Sent, exchange={self.output_exchange}, key={self.output_routing_key}")
+        """
+        Send image data to the system for processing, through the result consumer's channel
+        when listening (see listen).
+        """
+        body, properties = self._request()
+        self.log.debug(f"Sending image size={self.data_size_kb}kB")
+        if self.consumer is not None:
+            self.consumer.publish(self.output_exchange, self.output_routing_key, body, properties)
+        else:
+            with self.connection() as conn:
+                channel = conn.channel()
+                channel.exchange_declare(exchange=self.output_exchange, exchange_type='direct')
+                channel.basic_publish(
+                    exchange=self.output_exchange,
+                    routing_key=self.output_routing_key,
+                    body=body,
+                    properties=properties,
+                )
+        self.sent = True
+        self.log.info(f"Sent, exchange={self.output_exchange}, key={self.output_routing_key}")
+
+    @staticmethod
+    def send_many(computations: list, consumer) -> None:
+        """Send the requests of listening computations at once, committed together (see publish_many)."""
+        if not computations:
+            return
+        first = computations[0]
+        messages = [computation._request() for computation in computations]
+        consumer.publish_many(first.output_exchange, first.output_routing_key, messages)
+        for computation in computations:
+            computation.sent = True
+        first.log.info(f"Sent {len(computations)} requests, exchange={first.output_exchange}")
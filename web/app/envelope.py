@@ -0,0 +1,61 @@
+"""
+Binary message envelope: the raw image bytes are the AMQP message body and everything
+else (id, rgb, format, size, blob reference, ...) travels in the AMQP headers.
+The content type carries the envelope version. Messages without it are the legacy
+JSON messages with a base64 encoded image.
+"""
+import pika
+
+CONTENT_TYPE = "application/x-image-envelope"
+VERSION = 1
+
+JSON = "json"
+BINARY = "binary"
+FORMATS = (JSON, BINARY)
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def is_envelope(properties) -> bool:
+    content_type = getattr(properties, "content_type", None) or ""
+    return content_type.split(";")[0].strip() == CONTENT_TYPE
+
+
+def _version(content_type: str) -> int:
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip() == "version":
+            try:
+                return int(value)
+            except ValueError:
+                raise EnvelopeError(f"Invalid envelope version: {content_type}")
+    return VERSION
+
+
+def encode(payload: bytes = b"", **headers) -> tuple:
+    """Return (body, properties) of a message, headers with None values are left out."""
+    headers = {name: value for name, value in headers.items() if value is not None}
+    properties = pika.BasicProperties(
+        content_type=f"{CONTENT_TYPE}; version={VERSION}",
+        headers=headers,
+    )
+    return payload or b"", properties
+
+
+def decode(body: bytes, properties) -> tuple:
+    """Return (headers, payload) of a binary message."""
+    if not is_envelope(properties):
+        raise EnvelopeError(f"Not an envelope: {getattr(properties, 'content_type', None)}")
+    version = _version(properties.content_type)
+    if version != VERSION:
+        raise EnvelopeError(f"Unsupported envelope version: {version}")
+
+    headers = dict(properties.headers or {})
+    for name, value in headers.items():
+        if isinstance(value, bytes):
+            headers[name] = value.decode()
+    if not headers.get("id"):
+        raise EnvelopeError(f"'id' header missing: {headers}")
+    return headers, body
@@ -24,3 +24,10 @@ def get_logger(name: str):
         file_handler.setFormatter(logging.Formatter(log_format))
         logger.addHandler(file_handler)
     return logger
+
+
+class IdLogger(logging.LoggerAdapter):
+    """Messages prefixed by an id (e.g. of a computation), a logger per id would never be freed."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['id']}] {msg}", kwargs
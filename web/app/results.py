@@ -0,0 +1,209 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import pika
+
+from app.log import get_logger
+
+log = get_logger(__name__)
+
+
+DIRECT = "direct"
+TOPIC = "topic"
+REPLY_MODES = (DIRECT, TOPIC)
+
+REPLY_TO = "amq.rabbitmq.reply-to"  # RabbitMQ's pseudo-queue, no queue is declared for the replies
+
+
+class ResultError(Exception):
+    pass
+
+
+class ResultConsumer:
+    """
+    A single consumer of the computed results per web process, on a long-lived connection
+    and thread. Computations register their image id before the request is sent and get
+    a future, resolved with (body, properties) of the result as soon as it is delivered.
+    Futures not resolved in RESULT_TIMEOUT seconds (counted from publishing the request, see expect)
+    fail with a TimeoutError.
+
+    REPLY_MODE:
+    * direct (default): the requests carry reply_to (direct reply-to) and their image id
+      as the correlation id, compute answers straight to this consumer. The requests have to be
+      published on the consumer's channel (see publish_many).
+    * topic: the queue of the process is bound to the results exchange ('*.computed'),
+      results of other web processes are delivered as well and ignored.
+    """
+
+    def __init__(self) -> None:
+        self.broker_host = os.environ.get("BROKER_HOST")
+        self.broker_port = os.environ.get("BROKER_PORT") or 5672
+        self.input_exchange = os.environ.get("INPUT_EXCHANGE")
+        self.topic_suffix = os.environ.get("INPUT_ROUTING_KEY") or "computed"
+        self.timeout = float(os.environ.get("RESULT_TIMEOUT") or 30)
+        self.reply_mode = (os.environ.get("REPLY_MODE") or DIRECT).lower()
+        if self.reply_mode not in REPLY_MODES:
+            raise ResultError(f"Unknown reply mode: {self.reply_mode}")
+        self.queue_name = None  # exclusive queue of this process (or the reply-to pseudo-queue)
+        self.connection = None
+        self.channel = None
+        self._declared = set()  # exchanges declared on the channel
+        self.pending = {}  # image id -> (future, deadline, timeout), no deadline until published
+        self.ready = threading.Event()  # the queue is bound, results are being delivered
+        self.running_thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self) -> "ResultConsumer":
+        self.running_thread = threading.Thread(target=self._run, name="results", daemon=True)
+        self.running_thread.start()
+        return self
+
+    def wait_ready(self, timeout: float = 10) -> None:
+        """Block until the queue is bound, so that no result of a registered computation is missed."""
+        if not self.ready.wait(timeout):
+            raise ResultError(f"Not consuming results after {timeout}s, is the broker available?")
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def expect(self, image_id: str, timeout: float = None) -> Future:
+        """
+        Register a computation before its request is published, its result is awaited `timeout` seconds
+        (RESULT_TIMEOUT by default) from the moment the request is published (see publish_many).
+        """
+        future = Future()
+        with self._lock:
+            self.pending[image_id] = (future, math.inf, timeout or self.timeout)
+        return future
+
+    def _published(self, image_ids: list) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for image_id in image_ids:
+                if image_id in self.pending:
+                    future, _, timeout = self.pending[image_id]
+                    self.pending[image_id] = (future, now + timeout, timeout)
+
+    def cancel(self, image_id: str, error: Exception) -> None:
+        """Fail a registered computation whose request could not be published."""
+        self._resolve(image_id, error=error)
+
+    def _resolve(self, image_id: str, result=None, error: Exception = None) -> None:
+        with self._lock:
+            future, _, _ = self.pending.pop(image_id, (None, None, None))
+        if future is None:
+            return  # not ours, already timed out or resolved
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def on_message(self, channel, method, properties, body) -> None:
+        if self.reply_mode == DIRECT:
+            image_id = getattr(properties, "correlation_id", None)
+            if not image_id:
+                log.warning("Reply without a correlation id.")
+                return
+        else:
+            image_id, _, suffix = method.routing_key.rpartition(".")
+            if suffix != self.topic_suffix:
+                log.warning(f"Unexpected result routing key: {method.routing_key}")
+                return
+        self._resolve(image_id, (body, properties))
+
+    def publish(self, exchange: str, routing_key: str, body: bytes, properties=None,
+                timeout: float = 10) -> None:
+        self.publish_many(exchange, routing_key, [(body, properties)], timeout)
+
+    def publish_many(self, exchange: str, routing_key: str, messages: list, timeout: float = 10) -> None:
+        """
+        Publish requests, (body, properties) each, on the consumer's channel (from any thread): replies
+        to direct reply-to are delivered only to the channel which published the request.
+        The channel is transactional, the messages are committed together, so a whole batch is
+        acknowledged by the broker in a single round-trip. The (direct) exchange is declared on the first use.
+        """
+        connection, channel = self.connection, self.channel
+        if connection is None:
+            raise ResultError("Not connected to the broker.")
+        if self.reply_mode == DIRECT:
+            messages = [(body, properties or pika.BasicProperties()) for body, properties in messages]
+            for _, properties in messages:
+                properties.reply_to = REPLY_TO
+
+        published = Future()
+
+        def publish():
+            try:
+                if exchange not in self._declared:
+                    channel.exchange_declare(exchange=exchange, exchange_type="direct")
+                    self._declared.add(exchange)
+                for body, properties in messages:
+                    channel.basic_publish(
+                        exchange=exchange, routing_key=routing_key, body=body, properties=properties
+                    )
+                channel.tx_commit()
+                self._published([getattr(properties, "correlation_id", None) for _, properties in messages])
+                published.set_result(None)
+            except Exception as e:
+                published.set_exception(e)
+
+        # the channel may only be used from the connection thread
+        connection.add_callback_threadsafe(publish)
+        published.result(timeout)
+
+    def expire(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = [image_id for image_id, (_, deadline, _) in self.pending.items() if deadline <= now]
+        for image_id in expired:
+            self._resolve(image_id, error=TimeoutError("Wait timed out."))
+
+    def _consume(self, connection) -> None:
+        channel = connection.channel()
+        if self.reply_mode == DIRECT:
+            self.queue_name = REPLY_TO
+        else:
+            channel.exchange_declare(self.input_exchange, exchange_type="topic")
+            result = channel.queue_declare("", exclusive=True)
+            self.queue_name = result.method.queue
+            channel.queue_bind(
+                exchange=self.input_exchange, queue=self.queue_name, routing_key=f"*.{self.topic_suffix}"
+            )
+        # the requests published on the channel are committed (see publish_many)
+        channel.tx_select()
+        # direct reply-to requires auto_ack, the results are not worth redelivering anyway
+        channel.basic_consume(queue=self.queue_name, on_message_callback=self.on_message, auto_ack=True)
+        log.info(f"Consuming results, mode={self.reply_mode}, queue={self.queue_name}")
+        self.connection, self.channel = connection, channel
+        self._declared = set()
+        self.ready.set()
+        while not self._stopped.is_set():
+            # returns as soon as a result is delivered, the time limit only paces the expiry
+            connection.process_data_events(time_limit=1)
+            self.expire()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(
+                        host=self.broker_host,
+                        port=self.broker_port,
+                        connection_attempts=5,
+                        retry_delay=2,
+                    )
+                )
+                try:
+                    self._consume(connection)
+                finally:
+                    self.ready.clear()
+                    self.connection = self.channel = None
+                    connection.close()
+            except Exception as e:
+                log.error("Result consumer failed, reconnecting.", exc_info=e)
+                self.expire()
+                time.sleep(1)
@@ -0,0 +1,301 @@
+import collections
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import NamedTuple
+
+from app.blobstore import CHUNK_SIZE, BlobStore, BlobStoreError
+from app.connection import FINAL_STATES
+from app.log import get_logger
+
+log = get_logger(__name__)
+
+
+RECENT = 100  # computations listed on the home page
+COLUMNS = "id, created, result, error, size, image_path, state"
+
+
+class StoreError(Exception):
+    pass
+
+
+class ComputationRecord(NamedTuple):
+    """A computation evicted from memory, as stored, its image is read from the spill on use."""
+    image_id: str
+    created: float
+    result: str = None
+    error: str = None
+    size: int = 0
+    image_path: str = None
+    state: str = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.result is None and self.error is None
+
+    @property
+    def data_size_kb(self) -> float:
+        return self.size / 1000
+
+    @property
+    def image_bytes(self) -> bytes:
+        try:
+            with open(self.image_path, "rb") as f:
+                return f.read()
+        except (OSError, TypeError) as e:
+            raise StoreError(f"Image of {self.image_id} is not available", e)
+
+
+class ComputationStore:
+    """
+    Computations by their image id, a mapping shared by the web processes (gunicorn workers).
+
+    The state of each computation is in an SQLite file, its image spilled once to the blob store
+    (BLOB_STORE_DIR) or a local directory, so any process can show it. Computations are kept
+    in memory too, the least recently used are dropped once there are more than MEMORY_COMPUTATIONS
+    of them or their images take more than the memory budget, the finished ones with their image
+    in a file right away, afterwards they are served from the file. Computations older than
+    the TTL are removed.
+
+    Modify behavior using these environment variables:
+    * COMPUTATION_STORE: the SQLite file (defaults to one in the temporary directory)
+    * SPILL_DIR: where the images go without a blob store (defaults to 'images' next to the file)
+    * MEMORY_BUDGET_MB: memory for the images of the computations (defaults to 256)
+    * MEMORY_COMPUTATIONS: computations kept in memory (defaults to 1000)
+    * COMPUTATION_TTL: seconds a computation is kept (defaults to 86400)
+    """
+
+    def __init__(self) -> None:
+        self.path = os.environ.get("COMPUTATION_STORE") or os.path.join(
+            tempfile.gettempdir(), "web-computations", "computations.sqlite"
+        )
+        self.blob_store = BlobStore.from_env()
+        self.spill_dir = os.path.abspath(
+            os.environ.get("SPILL_DIR") or os.path.join(os.path.dirname(self.path), "images")
+        )
+        self.memory_budget = int(float(os.environ.get("MEMORY_BUDGET_MB") or 256) * 1024 * 1024)
+        self.max_computations = int(os.environ.get("MEMORY_COMPUTATIONS") or 1000)
+        self.ttl = float(os.environ.get("COMPUTATION_TTL") or 86400)
+        self.memory = 0  # bytes of the images held in memory
+        self._computations = collections.OrderedDict()  # in memory, the least recently used first
+        self._lock = threading.Lock()
+        self.version = 0  # incremented on every change made by this process
+        self._changed = threading.Condition()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS computations ("
+            "id TEXT PRIMARY KEY, created REAL, result TEXT, error TEXT, size INTEGER, image_path TEXT, "
+            "state TEXT, batch_id TEXT, finished REAL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(computations)")}
+        for column, column_type in (("state", "TEXT"), ("batch_id", "TEXT"), ("finished", "REAL")):
+            if column not in columns:
+                # files written by older versions
+                self._db.execute(f"ALTER TABLE computations ADD COLUMN {column} {column_type}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS computations_created ON computations (created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS computations_batch ON computations (batch_id)")
+        self._db.commit()
+
+    def spool(self, stream, max_size: int = None) -> tuple:
+        """
+        Write an upload chunk by chunk to the blob store (hashed on the way) or to the spill directory,
+        so that it is never held in memory whole. Returns (path of the image, Blob or None).
+        """
+        if self.blob_store is not None:
+            try:
+                blob = self.blob_store.put_stream(stream, max_size=max_size)
+            except BlobStoreError as e:
+                raise StoreError(e)
+            return self.blob_store.path(blob.key), blob
+
+        image_path = os.path.join(self.spill_dir, f"upload-{uuid.uuid4().hex}")
+        size = 0
+        with open(image_path, "wb") as f:
+            try:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise StoreError(f"Upload over the limit of {max_size}B")
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                os.unlink(image_path)
+                raise
+        return image_path, None
+
+    def _spill(self, computation) -> str:
+        if computation.image_path is not None:
+            return computation.image_path  # spooled already
+        if self.blob_store is not None:
+            # content-addressed, the request sends the same blob
+            return self.blob_store.path(self.blob_store.put(computation.image_bytes).key)
+        image_path = os.path.join(self.spill_dir, computation.image_id)
+        with open(image_path, "wb") as f:
+            f.write(computation.image_bytes)
+        return image_path
+
+    def _notify(self) -> None:
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait(self, version: int, timeout: float) -> int:
+        """
+        Block until a computation changes in this process (the version differs) or the timeout
+        passes, changes made by other processes are only seen by looking them up again.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def save(self, *computations) -> None:
+        """Save the state of stored computations (e.g. sent, their result arrived), in one transaction."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "UPDATE computations SET result = ?, error = ?, state = ?, finished = COALESCE(finished, ?) "
+                "WHERE id = ?",
+                [(computation.result, computation.error, computation.state,
+                  now if computation.state in FINAL_STATES else None, computation.image_id)
+                 for computation in computations]
+            )
+            self._db.commit()
+            for computation in computations:
+                if computation.state in FINAL_STATES and not computation.memory_size:
+                    # nothing to gain from keeping it, the record has the same
+                    self._computations.pop(computation.image_id, None)
+        self._notify()
+
+    def __setitem__(self, image_id: str, computation) -> None:
+        """Store a computation, its result is saved once it arrives (see Computation.listen)."""
+        image_path = self._spill(computation)
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO computations ({COLUMNS}, batch_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (image_id, time.time(), computation.result, computation.error, computation.size, image_path,
+                 computation.state, getattr(computation, "batch_id", None))
+            )
+            self._db.commit()
+            previous = self._computations.pop(image_id, None)
+            if previous is not None:
+                self.memory -= previous.memory_size
+            self._computations[image_id] = computation
+            self.memory += computation.memory_size
+            self._evict()
+        if computation.future is not None:
+            # added after the computation's own callback, which sets the result
+            computation.future.add_done_callback(lambda _: self.save(computation))
+        self.expire()
+        self._notify()
+
+    def _evict(self) -> None:
+        while len(self._computations) > 1 and (
+            self.memory > self.memory_budget or len(self._computations) > self.max_computations
+        ):
+            image_id, computation = self._computations.popitem(last=False)
+            self.memory -= computation.memory_size
+            log.debug(f"Computation {image_id} evicted from memory")
+
+    def _record(self, image_id: str):
+        row = self._db.execute(
+            f"SELECT {COLUMNS} FROM computations WHERE id = ? AND created > ?",
+            (image_id, time.time() - self.ttl)
+        ).fetchone()
+        return ComputationRecord(*row) if row else None
+
+    def __getitem__(self, image_id: str):
+        with self._lock:
+            computation = self._computations.get(image_id)
+            if computation is not None:
+                self._computations.move_to_end(image_id)
+                return computation
+            record = self._record(image_id)
+        if record is None:
+            raise KeyError(image_id)
+        return record
+
+    def __contains__(self, image_id: str) -> bool:
+        with self._lock:
+            return image_id in self._computations or self._record(image_id) is not None
+
+    def get(self, image_id: str, default=None):
+        try:
+            return self[image_id]
+        except KeyError:
+            return default
+
+    def values(self) -> list:
+        """The most recent computations, the oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {COLUMNS} FROM computations WHERE created > ? ORDER BY created DESC LIMIT ?",
+                (time.time() - self.ttl, RECENT)
+            ).fetchall()
+            return [self._computations.get(row[0]) or ComputationRecord(*row) for row in reversed(rows)]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM computations WHERE created > ?", (time.time() - self.ttl,)
+            ).fetchone()[0]
+
+    def batch(self, batch_id: str):
+        """
+        Aggregated progress of the computations uploaded together: their number by state,
+        seconds since the upload started and the finished computations per second. None if unknown.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*), MIN(created), MAX(finished) FROM computations "
+                "WHERE batch_id = ? AND created > ? GROUP BY state",
+                (batch_id, time.time() - self.ttl)
+            ).fetchall()
+        if not rows:
+            return None
+        states = {state: count for state, count, _, _ in rows}
+        total = sum(states.values())
+        finished = sum(states.get(state, 0) for state in FINAL_STATES)
+        started = min(row[2] for row in rows)
+        ended = max(row[3] or 0 for row in rows) if finished == total else time.time()
+        elapsed = max(ended - started, 0)
+        return {
+            "batch": batch_id,
+            "total": total,
+            "states": states,
+            "finished": finished,
+            "complete": finished == total,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(finished / elapsed, 3) if elapsed else None,
+        }
+
+    def expire(self) -> int:
+        """Remove the computations older than the TTL (and their spilled images), return their number."""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, image_path FROM computations WHERE created <= ?", (deadline,)
+            ).fetchall()
+            if not rows:
+                return 0
+            self._db.execute("DELETE FROM computations WHERE created <= ?", (deadline,))
+            self._db.commit()
+            for image_id, image_path in rows:
+                computation = self._computations.pop(image_id, None)
+                if computation is not None:
+                    self.memory -= computation.memory_size
+                # blobs are shared, content-addressed, only the own spill is removed
+                if image_path and os.path.dirname(image_path) == self.spill_dir:
+                    try:
+                        os.unlink(image_path)
+                    except FileNotFoundError:
+                        pass
+        log.debug(f"{len(rows)} computations expired")
+        return len(rows)
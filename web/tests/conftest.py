@@ -0,0 +1,19 @@
+import pytest
+
+from app.store import ComputationStore
+
+
+@pytest.fixture
+def store_env(tmp_path, monkeypatch):
+    """Keep the computations of a test in its own store file, results consumed from the exchange."""
+    monkeypatch.setenv("COMPUTATION_STORE", str(tmp_path / "computations.sqlite"))
+    monkeypatch.setenv("REPLY_MODE", "topic")
+    return tmp_path
+
+
+@pytest.fixture
+def store(store_env, monkeypatch):
+    """The computation store of the app."""
+    store = ComputationStore()
+    monkeypatch.setattr("app.ACTIVE_COMPUTATIONS", store)
+    return store
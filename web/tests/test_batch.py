@@ -0,0 +1,163 @@
+import io
+import json
+import tarfile
+import time
+import zipfile
+
+import mock
+import pytest
+
+from app import app
+from app.batch import BatchError, submit, uploads
+from app.results import ResultConsumer
+
+
+def tar_archive(files: dict, mode: str = "w:gz") -> bytes:
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=mode) as archive:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def zip_archive(files: dict) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+
+class Unseekable(io.RawIOBase):
+    """A request body, read once."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = io.BytesIO(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self.data.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+@pytest.fixture
+def consumer(monkeypatch):
+    """A direct reply-to consumer 'connected' to a mocked broker, publishing right away."""
+    monkeypatch.setenv("REPLY_MODE", "direct")
+    consumer = ResultConsumer()
+    connection = mock.MagicMock()
+    connection.process_data_events.side_effect = lambda time_limit: consumer.stop()
+    connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    consumer._consume(connection)
+    monkeypatch.setattr("app.result_consumer", lambda: consumer)
+    return consumer
+
+
+def read_all(images) -> dict:
+    return {name: stream.read() for name, stream in images}
+
+
+def test_tar_body_streamed():
+    body = tar_archive({"a.jpg": b"a", "dir/b.png": b"bb", "dir/.hidden": b"x"})
+    assert read_all(uploads(body=Unseekable(body), mimetype="application/gzip")) == {
+        "a.jpg": b"a", "dir/b.png": b"bb"
+    }
+
+
+def test_zip_body_spooled():
+    body = zip_archive({"a.jpg": b"a", "__MACOSX/._a.jpg": b"x", "dir/": b""})
+    assert read_all(uploads(body=Unseekable(body), mimetype="application/zip")) == {"a.jpg": b"a"}
+
+
+def test_files_and_archives():
+    files = [
+        mock.MagicMock(filename="a.jpg", stream=io.BytesIO(b"a")),
+        mock.MagicMock(filename="more.tar", stream=io.BytesIO(tar_archive({"b.jpg": b"b"}, mode="w"))),
+        mock.MagicMock(filename="more.ZIP", stream=io.BytesIO(zip_archive({"c.jpg": b"c"}))),
+    ]
+    assert read_all(uploads(files)) == {"a.jpg": b"a", "b.jpg": b"b", "c.jpg": b"c"}
+
+
+def test_invalid_body():
+    with pytest.raises(BatchError):
+        read_all(uploads(body=io.BytesIO(b"image data"), mimetype="image/jpeg"))
+    with pytest.raises(BatchError):
+        read_all(uploads(body=io.BytesIO(b"not a zip"), mimetype="application/zip"))
+
+
+def test_requests_committed_in_chunks(store, consumer):
+    images = [(f"{i}.jpg", io.BytesIO(b"image %d" % i)) for i in range(5)]
+    images += [("empty.jpg", io.BytesIO(b"")), ("large.jpg", io.BytesIO(b"x" * 100))]
+    summary = submit(iter(images), store, consumer, max_size=50, max_items=10, chunk_size=2)
+
+    assert summary["accepted"] == 5 and [r["name"] for r in summary["rejected"]] == ["empty.jpg", "large.jpg"]
+    channel = consumer.channel
+    assert channel.basic_publish.call_count == 5
+    assert channel.tx_commit.call_count == 3  # 2 + 2 + 1, no round-trip per image
+    assert len(consumer.pending) == 5
+    assert store.batch(summary["batch"])["states"] == {"computing": 5}
+
+
+def test_deadline_from_sending_scaled_by_chunk(store, consumer, monkeypatch):
+    images = [(f"{i}.jpg", io.BytesIO(b"image %d" % i)) for i in range(5)]
+    now = time.monotonic()
+    monkeypatch.setattr("app.results.time.monotonic", lambda: now)
+    submit(iter(images), store, consumer, max_size=50, max_items=10, chunk_size=2)
+
+    deadlines = sorted(deadline - now for _, deadline, _ in consumer.pending.values())
+    assert deadlines == [30, 30, 60, 60, 90]
+    consumer.expire(now + 45)
+    assert len(consumer.pending) == 3
+
+
+def test_batch_limit(store, consumer):
+    images = ((f"{i}.jpg", io.BytesIO(b"image data")) for i in range(5))
+    summary = submit(images, store, consumer, max_size=50, max_items=3)
+    assert summary["accepted"] == 3 and "3 images" in summary["error"]
+    assert consumer.channel.tx_commit.call_count == 1
+
+
+def test_broker_failure(store, consumer):
+    consumer.channel.tx_commit.side_effect = [None, ConnectionError("broker gone")]
+    images = [(f"{i}.jpg", io.BytesIO(b"image %d" % i)) for i in range(5)]
+    with pytest.raises(ConnectionError, match="broker gone"):
+        submit(iter(images), store, consumer, max_size=50, max_items=10, chunk_size=2)
+
+    assert consumer.channel.tx_commit.call_count == 2  # not sent again
+    assert consumer.pending.keys() == {c.kwargs["properties"].correlation_id
+                                       for c in consumer.channel.basic_publish.call_args_list[:2]}
+    batch_id = store.values()[0].batch_id
+    assert store.batch(batch_id)["states"] == {"computing": 2, "error": 2}
+
+
+def test_batch_routes(store, consumer):
+    body = tar_archive({f"{i}.jpg": b"image %d" % i for i in range(3)})
+    with app.test_client() as client:
+        response = client.post("/batches", data=body, content_type="application/x-tar")
+        assert response.status_code == 202
+        summary = response.get_json()
+        assert summary["accepted"] == 3 and summary["rejected"] == []
+
+        for i, properties in enumerate(call.kwargs["properties"]
+                                       for call in consumer.channel.basic_publish.call_args_list):
+            reply = json.dumps({"rgb": "#c0c0c0"} if i < 2 else {})
+            consumer.on_message(consumer.channel, None, properties, reply)
+
+        progress = client.get(summary["progress"]).get_json()
+        assert progress["total"] == 3 and progress["finished"] == 3 and progress["complete"]
+        assert progress["states"] == {"done": 2, "error": 1}
+        assert progress["elapsed_s"] >= 0
+
+        assert client.get("/batches/unknown").status_code == 404
+
+
+def test_batch_without_images(store, consumer):
+    with app.test_client() as client:
+        response = client.post("/batches", data={"files": (io.BytesIO(b""), "a.jpg")})
+    assert response.status_code == 400
+    assert response.get_json()["rejected"] == [{"name": "a.jpg", "error": "Empty file"}]
@@ -1,3 +1,57 @@
-"""
-TODO: Tests for the connection module would go here.
-"""
+import base64
+import json
+
+import mock
+import pytest
+
+from app import envelope
+from app.connection import Computation
+
+
+@pytest.fixture
+def published():
+    """Capture message bodies sent by Computation.send."""
+    with mock.patch.object(Computation, "connection") as mocked_connection:
+        with mocked_connection() as conn:
+            channel = conn.channel()
+        yield channel.basic_publish
+
+
+def test_send_inline(published):
+    computation = Computation(image_bytes=b"image data")
+    computation.send()
+    body = json.loads(published.call_args.kwargs["body"])
+    assert body == {
+        "id": computation.image_id,
+        "image": base64.b64encode(b"image data").decode(),
+    }
+
+
+def test_send_blob_reference(published, tmp_path, monkeypatch):
+    monkeypatch.setenv("BLOB_STORE_DIR", str(tmp_path))
+    computation = Computation(image_bytes=b"image data")
+    computation.send()
+    body = json.loads(published.call_args.kwargs["body"])
+    assert body["id"] == computation.image_id
+    assert "image" not in body
+    assert body["blob"]["size"] == len(b"image data")
+    assert computation.blob_store.exists(body["blob"]["key"])
+
+
+def test_send_binary(published, monkeypatch):
+    monkeypatch.setenv("MESSAGE_FORMAT", "binary")
+    computation = Computation(image_bytes=b"image data")
+    computation.send()
+    sent = published.call_args.kwargs
+    headers, payload = envelope.decode(sent["body"], sent["properties"])
+    assert headers == {"id": computation.image_id, "size": len(b"image data")}
+    assert payload == b"image data"
+
+
+def test_validate_body_both_formats():
+    assert Computation._validate_body(json.dumps({"id": "1", "rgb": "#ffffff"})) == "#ffffff"
+    body, properties = envelope.encode(b"image data", id="1", rgb="#ffffff")
+    assert Computation._validate_body(body, properties) == "#ffffff"
+    body, properties = envelope.encode(b"image data", id="1")
+    with pytest.raises(ValueError):
+        Computation._validate_body(body, properties)
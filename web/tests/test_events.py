@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+
+import pytest
+
+from app import app
+from app.connection import Computation
+from app.results import ResultConsumer
+from app.store import ComputationStore
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"image data"
+
+
+@pytest.fixture
+def pending(store):
+    """A sent computation, waiting for its result from the consumer."""
+    consumer = ResultConsumer()
+    computation = Computation(image_bytes=PNG)
+    computation.listen(consumer)
+    store[computation.image_id] = computation
+    computation.sent = True
+    store.save(computation)
+    return computation, consumer
+
+
+def deliver(consumer, computation, rgb="#c0c0c0"):
+    body = json.dumps({"id": computation.image_id, "rgb": rgb})
+    method = type("Method", (), {"routing_key": f"{computation.image_id}.computed"})
+    consumer.on_message(None, method, None, body)
+
+
+def read_events(response) -> list:
+    events = []
+    for chunk in response.response:
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith("event: state"):
+            events.append((json.loads(chunk.split("data: ", 1)[1]), time.monotonic()))
+    return events
+
+
+def test_events_pushed(pending):
+    computation, consumer = pending
+    with app.test_client() as client:
+        response = client.get(f"/events?id={computation.image_id}&id=unknown-id", buffered=False)
+        assert response.mimetype == "text/event-stream"
+        timer = threading.Timer(0.1, deliver, (consumer, computation))
+        started = time.monotonic()
+        timer.start()
+        events = read_events(response)
+
+    assert [event for event, _ in events] == [
+        {"id": computation.image_id, "state": "computing"},
+        {"id": "unknown-id", "state": "unknown"},
+        {"id": computation.image_id, "state": "done", "rgb": "#c0c0c0"},
+    ]
+    # woken up by the result, not by the poll interval
+    assert events[-1][1] - started < 0.9
+
+
+def test_events_of_finished_computation(pending, store):
+    computation, consumer = pending
+    deliver(consumer, computation)
+    other = ComputationStore()  # as seen by another process
+    assert other[computation.image_id].state == "done"
+    with app.test_client() as client:
+        events = read_events(client.get(f"/events?id={computation.image_id}", buffered=False))
+    assert [event["state"] for event, _ in events] == ["done"]
+
+
+def test_events_without_ids(store):
+    with app.test_client() as client:
+        assert client.get("/events").status_code == 400
+
+
+def test_status_page(pending):
+    computation, _ = pending
+    with app.test_client() as client:
+        response = client.get(f"/{computation.image_id}")
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert f'new EventSource("/events?id={computation.image_id}")' in page
+    assert f'src="/{computation.image_id}/image"' in page and "base64" not in page
+
+
+@pytest.mark.parametrize("evicted", [False, True])
+def test_image(store, monkeypatch, evicted):
+    computation = Computation(image_bytes=PNG)
+    store[computation.image_id] = computation
+    if evicted:
+        store._computations.clear()
+    with app.test_client() as client:
+        response = client.get(f"/{computation.image_id}/image")
+        assert response.status_code == 200
+        assert response.mimetype == "image/png" and response.data == PNG
+        assert client.get("/unknown-id/image").status_code == 404
+
+
+def test_gevent_worker():
+    """The server of the image (see the Dockerfile): the app served by gunicorn's evented workers."""
+    pytest.importorskip("gevent")
+    from gunicorn.config import Config
+    from gunicorn.util import import_app
+
+    config = Config()
+    config.set("worker_class", "gevent")
+    assert config.worker_class.__name__ == "GeventWorker"
+    assert import_app("app:app") is app
@@ -0,0 +1,142 @@
+import io
+import json
+import time
+
+import mock
+import pika
+import pytest
+
+from app import app
+from app.connection import Computation
+from app.results import ResultConsumer, ResultError
+from app.store import ComputationStore
+
+
+def delivery(routing_key: str):
+    return mock.MagicMock(routing_key=routing_key)
+
+
+@pytest.fixture
+def consumer(monkeypatch):
+    monkeypatch.setenv("REPLY_MODE", "topic")
+    return ResultConsumer()
+
+
+def test_result_delivered(consumer):
+    computation = Computation(image_bytes=b"image data")
+    computation.listen(consumer)
+    assert computation.is_running
+
+    consumer.on_message(None, delivery("other-id.computed"), None, b"{}")
+    assert computation.is_running and not computation.result
+
+    body = json.dumps({"id": computation.image_id, "rgb": "#c0c0c0"})
+    consumer.on_message(None, delivery(f"{computation.image_id}.computed"), None, body)
+    assert not computation.is_running
+    assert computation.result == "#c0c0c0" and computation.error is None
+    assert consumer.pending == {}
+
+
+def test_invalid_result(consumer):
+    computation = Computation(image_bytes=b"image data")
+    computation.listen(consumer)
+    consumer.on_message(None, delivery(f"{computation.image_id}.computed"), None, json.dumps({}))
+    assert computation.result is None and "'rgb'" in computation.error
+
+
+def test_result_timeout(monkeypatch):
+    monkeypatch.setenv("RESULT_TIMEOUT", "5")
+    consumer = ResultConsumer()
+    computation = Computation(image_bytes=b"image data")
+    computation.listen(consumer)
+    consumer.expire(time.monotonic() + 60)
+    assert computation.is_running  # not sent yet
+
+    consumer._published([computation.image_id])
+    consumer.expire(time.monotonic() + 1)
+    assert computation.is_running
+    consumer.expire(time.monotonic() + 6)
+    assert computation.error == "Wait timed out." and consumer.pending == {}
+
+
+def test_consumer_bound_to_all_results(monkeypatch):
+    monkeypatch.setenv("INPUT_EXCHANGE", "processed")
+    monkeypatch.setenv("REPLY_MODE", "topic")
+    consumer = ResultConsumer()
+    connection = mock.MagicMock()
+    connection.process_data_events.side_effect = lambda time_limit: consumer.stop()
+    consumer._consume(connection)
+    channel = connection.channel()
+    channel.queue_bind.assert_called_once_with(
+        exchange="processed", queue=consumer.queue_name, routing_key="*.computed"
+    )
+    assert consumer.ready.is_set()
+
+
+def test_upload_registers_before_sending(monkeypatch, tmp_path):
+    monkeypatch.setenv("COMPUTATION_STORE", str(tmp_path / "computations.sqlite"))
+    consumer = ResultConsumer()
+    consumer.ready.set()
+    monkeypatch.setattr("app.RESULT_CONSUMER", consumer)
+    monkeypatch.setattr("app.ACTIVE_COMPUTATIONS", ComputationStore())
+
+    def send(computation):
+        assert computation.image_id in consumer.pending
+
+    with mock.patch.object(Computation, "send", autospec=True, side_effect=send) as sent:
+        with app.test_client() as client:
+            response = client.post("/", data={"file": (io.BytesIO(b"image data"), "a.jpg")})
+    assert response.status_code == 302
+    sent.assert_called_once()
+
+
+@pytest.fixture
+def direct_consumer():
+    """A direct reply-to consumer 'connected' to a mocked broker, publishing right away."""
+    consumer = ResultConsumer()
+    connection = mock.MagicMock()
+    connection.process_data_events.side_effect = lambda time_limit: consumer.stop()
+    connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+    consumer._consume(connection)
+    return consumer
+
+
+def test_direct_reply_to(direct_consumer):
+    channel = direct_consumer.channel
+    channel.basic_consume.assert_called_once_with(
+        queue="amq.rabbitmq.reply-to", on_message_callback=direct_consumer.on_message, auto_ack=True
+    )
+    channel.queue_declare.assert_not_called()
+
+    computation = Computation(image_bytes=b"image data")
+    computation.listen(direct_consumer)
+    computation.send()
+    sent = channel.basic_publish.call_args.kwargs
+    assert sent["properties"].reply_to == "amq.rabbitmq.reply-to"
+    assert sent["properties"].correlation_id == computation.image_id
+
+    reply = pika.BasicProperties(correlation_id=computation.image_id)
+    direct_consumer.on_message(channel, delivery("amq.gen-reply"), reply, json.dumps({"rgb": "#c0c0c0"}))
+    assert computation.result == "#c0c0c0"
+
+
+def test_publish_declares_exchange_once(direct_consumer):
+    for _ in range(3):
+        direct_consumer.publish("to_be_processed", "compute", b"{}")
+    direct_consumer.channel.exchange_declare.assert_called_once_with(
+        exchange="to_be_processed", exchange_type="direct"
+    )
+    assert direct_consumer.channel.basic_publish.call_count == 3
+    direct_consumer.channel.tx_select.assert_called_once()
+    assert direct_consumer.channel.tx_commit.call_count == 3
+
+
+def test_publish_not_connected():
+    with pytest.raises(ResultError):
+        ResultConsumer().publish("to_be_processed", "compute", b"{}")
+
+
+def test_invalid_reply_mode(monkeypatch):
+    monkeypatch.setenv("REPLY_MODE", "fanout")
+    with pytest.raises(ResultError):
+        ResultConsumer()
@@ -4,6 +4,7 @@ import mock
 import pytest
 
 from app import app
+from app.colorindex import ColorIndex
 
 
 @pytest.fixture
@@ -32,22 +33,54 @@ def test_home_get(mock_render_template, mock_computations):
     assert list(mock_call.kwargs.get("computations")) == list(mock_computations.values())
 
 
-@mock.patch("app.base64.b64encode")
-def test_status(mock_base64, mock_computations, mock_render_template):
+def test_status(mock_computations, mock_render_template):
     c_id = random.choice(list(mock_computations.keys()))
-    mock_base64.return_value = "some_bytes_as_b_64".encode()
 
     with app.test_client() as client:
         response = client.get(f"/{c_id}")
         assert response._status_code == 200
 
     mock_render_template.assert_called_once()
-    mock_render_template.assert_called_with(
-        "status.html", computation=mock_computations[c_id], image_bytes="some_bytes_as_b_64"
-    )
+    mock_render_template.assert_called_with("status.html", computation=mock_computations[c_id])
 
 
 def test_status_404():
     with app.test_client() as client:
         response = client.get("/non_existant_id}")
         assert response._status_code == 404
+
+
+@pytest.fixture
+def color_index(tmp_path, monkeypatch):
+    path = str(tmp_path / "colors.sqlite")
+    index = ColorIndex(path)
+    index.add("gray", "#808080", "#808080/gray.JPEG", 10, "JPEG")
+    index.add("red", "#ff0000", "#ff0000/red.JPEG", 10, "JPEG")
+    index.commit()
+    monkeypatch.setenv("COLOR_INDEX", path)
+    monkeypatch.setattr("app.COLOR_INDEX", None)
+    yield index
+    index.close()
+
+
+def test_similar(color_index):
+    with app.test_client() as client:
+        response = client.get("/similar?rgb=%23818181&limit=1")
+    assert response.status_code == 200
+    assert [image["id"] for image in response.json["images"]] == ["gray"]
+
+    with app.test_client() as client:
+        response = client.get("/similar?rgb=ff0101&max_distance=5")
+    assert [image["id"] for image in response.json["images"]] == ["red"]
+
+
+def test_similar_invalid_color(color_index):
+    with app.test_client() as client:
+        assert client.get("/similar?rgb=red").status_code == 400
+
+
+def test_similar_no_index(monkeypatch):
+    monkeypatch.delenv("COLOR_INDEX", raising=False)
+    monkeypatch.setattr("app.COLOR_INDEX", None)
+    with app.test_client() as client:
+        assert client.get("/similar?rgb=808080").status_code == 503
@@ -0,0 +1,142 @@
+import io
+import os
+import time
+
+import mock
+
+import pytest
+
+from app import app
+from app.connection import Computation
+from app.results import ResultConsumer
+from app.store import ComputationRecord, ComputationStore, StoreError
+
+
+def computation(consumer=None, image_bytes=b"image data") -> Computation:
+    computation = Computation(image_bytes=image_bytes)
+    if consumer is not None:
+        computation.listen(consumer)
+    return computation
+
+
+def test_store_and_lookup(store_env):
+    store = ComputationStore()
+    stored = computation()
+    store[stored.image_id] = stored
+    assert stored.image_id in store and store[stored.image_id] is stored
+    assert "unknown" not in store and store.get("unknown") is None
+    with pytest.raises(KeyError):
+        store["unknown"]
+    assert store.values() == [stored] and len(store) == 1
+
+
+def test_shared_between_processes(store_env):
+    """Test that the state saved by one process (its result consumer) is seen by another."""
+    consumer = ResultConsumer()
+    store, other = ComputationStore(), ComputationStore()
+    stored = computation(consumer)
+    store[stored.image_id] = stored
+
+    record = other[stored.image_id]
+    assert isinstance(record, ComputationRecord) and record.is_running
+    assert record.image_bytes == b"image data" and record.data_size_kb == 0.01
+
+    consumer._published([stored.image_id])
+    consumer.expire(time.monotonic() + consumer.timeout)  # times out
+    assert other[stored.image_id].error == "Wait timed out."
+
+
+def test_memory_budget(store_env, monkeypatch):
+    monkeypatch.setenv("MEMORY_BUDGET_MB", str(25 / 1024 / 1024))  # 25 bytes, two images of 10
+    store = ComputationStore()
+    first, second, third = computation(), computation(), computation()
+    for stored in (first, second):
+        store[stored.image_id] = stored
+    store[first.image_id]  # used, the second one is the least recently used now
+    store[third.image_id] = third
+    assert store.memory == 20
+    assert store[first.image_id] is first and store[third.image_id] is third
+    evicted = store[second.image_id]
+    assert isinstance(evicted, ComputationRecord) and evicted.image_bytes == b"image data"
+    assert [c.image_id for c in store.values()] == [first.image_id, second.image_id, third.image_id]
+
+
+def test_spooled_uploads_bounded(store_env, monkeypatch):
+    monkeypatch.setenv("MEMORY_BUDGET_MB", "0.001")
+    monkeypatch.setenv("MEMORY_COMPUTATIONS", "10")
+    store, consumer = ComputationStore(), ResultConsumer()
+    spooled = []
+    for _ in range(200):
+        image_path, blob = store.spool(io.BytesIO(b"image data"))
+        stored = Computation(image_path=image_path, blob=blob)
+        stored.listen(consumer)
+        store[stored.image_id] = stored
+        spooled.append(stored)
+    assert store.memory == 0 and len(store._computations) == 10 and len(store) == 200
+
+    finished = spooled[-1]
+    consumer.on_message(None, mock.MagicMock(routing_key=f"{finished.image_id}.computed"), None,
+                        '{"rgb": "#c0c0c0"}')
+    assert finished.image_id not in store._computations  # served from its record
+    assert store[finished.image_id].result == "#c0c0c0" and len(store._computations) == 9
+
+
+def test_ttl(store_env, monkeypatch):
+    monkeypatch.setenv("COMPUTATION_TTL", "60")
+    store = ComputationStore()
+    old, new = computation(), computation()
+    store[old.image_id] = old
+    store._db.execute("UPDATE computations SET created = ?", (time.time() - 120,))
+    store[new.image_id] = new  # expires the old one
+    assert old.image_id not in store and new.image_id in store
+    assert os.listdir(store.spill_dir) == [new.image_id]
+    assert store.memory == len(b"image data")
+
+
+def test_spilled_to_blob_store(store_env, monkeypatch):
+    monkeypatch.setenv("BLOB_STORE_DIR", str(store_env / "blobs"))
+    monkeypatch.setenv("MEMORY_BUDGET_MB", "0")
+    store = ComputationStore()
+    first, second = computation(), computation()
+    store[first.image_id] = first
+    store[second.image_id] = second
+    record = store[first.image_id]
+    assert record.image_path.startswith(str(store_env / "blobs"))
+    assert record.image_bytes == b"image data" and os.listdir(store.spill_dir) == []
+
+
+@pytest.mark.parametrize("blob_store", [False, True])
+def test_spool(store_env, monkeypatch, blob_store):
+    if blob_store:
+        monkeypatch.setenv("BLOB_STORE_DIR", str(store_env / "blobs"))
+    store = ComputationStore()
+    image_path, blob = store.spool(io.BytesIO(b"x" * 3_000_000), max_size=3_000_000)
+    assert (blob is not None) is blob_store and os.path.getsize(image_path) == 3_000_000
+
+    spooled = Computation(image_path=image_path, blob=blob)
+    store[spooled.image_id] = spooled
+    assert spooled.memory_size == 0 and store.memory == 0
+    assert store[spooled.image_id].data_size_kb == 3000
+
+    with pytest.raises(StoreError):
+        store.spool(io.BytesIO(b"x" * 3_000_001), max_size=3_000_000)
+    assert len(os.listdir(store.spill_dir)) == (0 if blob_store else 1)
+
+
+def test_upload_streamed(store_env, monkeypatch):
+    monkeypatch.setattr("app.ACTIVE_COMPUTATIONS", ComputationStore())
+    monkeypatch.setattr("app.result_consumer", mock.MagicMock())
+    with mock.patch.object(Computation, "send", autospec=True) as sent:
+        with app.test_client() as client:
+            response = client.post("/", data={"file": (io.BytesIO(b"image data"), "a.jpg")})
+    assert response.status_code == 302
+    computation = sent.call_args.args[0]
+    assert computation.memory_size == 0 and computation.image_bytes == b"image data"
+
+
+def test_upload_too_large(store_env, monkeypatch):
+    monkeypatch.setattr("app.ACTIVE_COMPUTATIONS", ComputationStore())
+    monkeypatch.setitem(app.config, "MAX_CONTENT_LENGTH", 1000)
+    with app.test_client() as client:
+        response = client.post("/", data={"file": (io.BytesIO(b"x" * 2000), "a.jpg")})
+    assert response.status_code == 413